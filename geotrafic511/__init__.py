@@ -0,0 +1 @@
+default_app_config = 'geotrafic511.apps.GeoTraficConfig'
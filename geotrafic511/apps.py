@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
+
+
+class GeoTraficConfig(AppConfig):
+    name = 'geotrafic511'
+
+    def ready(self):
+        from open511_server.models import RoadEvent
+        from . import response_cache
+        # So that events changed outside of the importer invalidate cached responses
+        post_save.connect(response_cache.event_changed, sender=RoadEvent)
+        post_delete.connect(response_cache.event_changed, sender=RoadEvent)
@@ -0,0 +1,382 @@
+# coding: utf-8
+"""
+Offline benchmarks for the Geo-Trafic converter, run on synthetic feeds.
+
+    python benchmarks.py --events 2000 --links 3 --output results.json
+    python benchmarks.py timestamps
+    python benchmarks.py --generate feed.xml --events 10000
+
+Geometries are reprojected locally, so neither a network nor a database is needed.
+Results are written as JSON, so that they can be compared between commits.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import dateutil.parser
+from lxml import etree
+
+try:
+    from . import converter, daemon, metrics
+except ImportError:
+    # Run as a script
+    import converter
+    import daemon
+    import metrics
+
+STREET_NAMES = [
+    'rue Sherbrooke Est', 'rue Sherbrooke Ouest', 'boulevard Saint-Laurent', 'rue Saint-Denis',
+    'avenue du Parc', 'rue Notre-Dame Ouest', 'boulevard René-Lévesque', 'rue de la Montagne',
+    'avenue Papineau', 'rue Jean-Talon Est', 'boulevard Pie-IX', 'chemin de la Côte-des-Neiges',
+    'rue Wellington', 'boulevard Décarie', 'avenue Christophe-Colomb', 'rue Ontario Est',
+]
+
+# Bounds of the synthetic link coordinates, in MTM zone 8: roughly the island of Montreal
+MTM_BOUNDS = (280000.0, 5030000.0, 305000.0, 5055000.0)
+
+RECURRENCES = ['07001900', '09001500', '19000600', '00002359', '22000530']
+
+
+def _milliseconds_isoformat(dt):
+    # isoformat(timespec='milliseconds'), which needs Python 3.6
+    offset = dt.strftime('%z')
+    return '{}.{:03d}{}:{}'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), dt.microsecond // 1000,
+        offset[:3], offset[3:])
+
+def _timestamp(dt):
+    # In the Geo-Trafic format, e.g. 2015-11-16T13:56:59.320-05:00
+    return _milliseconds_isoformat(converter.TIMEZONE.localize(dt))
+
+def _valid_itis_codes():
+    # The ITIS codes whose Open511 subtypes are all allowed by the schema
+    import open511.validator
+    schema = etree.parse(os.path.join(os.path.dirname(open511.validator.__file__),
+        'schema', 'open511.rng'))
+    allowed = set(schema.xpath('//rng:element[@name="event_subtype"]//rng:value/text()',
+        namespaces={'rng': 'http://relaxng.org/ns/structure/1.0'}))
+    return sorted(code for code, category in converter.ITIS_CATEGORIES.items()
+        if all(subtype.strip() in allowed
+            for subtype in category['open511_subtype'].split(',') if subtype.strip()))
+
+def _sub(parent, tag, text=None):
+    el = etree.SubElement(parent, tag)
+    if text is not None:
+        el.text = text
+    return el
+
+def _link(parent, rand, link_id, ended):
+    location = _sub(parent, 'event-location')
+    lol = _sub(location, 'location-on-link')
+    street = rand.choice(STREET_NAMES)
+    from_street, to_street = rand.sample(STREET_NAMES, 2)
+    left = rand.choice(converter.ARRONDISSEMENTS)[0]
+    right = left if rand.random() < 0.9 else rand.choice(converter.ARRONDISSEMENTS)[0]
+    _sub(lol, 'link-id', str(link_id))
+    _sub(lol, 'link-name', street + ' ')
+    _sub(lol, 'link-left-jurisdiction-name', left)
+    _sub(lol, 'link-right-jurisdiction-name', right)
+    _sub(lol, 'cross-street-name-from', from_street + ' ')
+    _sub(lol, 'cross-street-name-to', to_street + ' ')
+    _sub(lol, 'effective-start-date', '2010-04-08T00:00:00.000-04:00')
+    _sub(lol, 'effective-end-date', '2014-01-01T00:00:00.000-05:00' if ended else None)
+    x = rand.uniform(MTM_BOUNDS[0], MTM_BOUNDS[2])
+    y = rand.uniform(MTM_BOUNDS[1], MTM_BOUNDS[3])
+    coords = []
+    for _ in range(rand.randint(2, 6)):
+        coords.append('{:.3f} {:.3f}'.format(x, y))
+        x += rand.uniform(-150, 150)
+        y += rand.uniform(-150, 150)
+    line = _sub(_sub(lol, 'link-geometry'), 'LineString')
+    _sub(line, 'posList', ' '.join(coords))
+
+def generate_feed(events=1000, links=2, recurrence_rate=0.3, ended_link_rate=0.05, seed=0):
+    """
+    Returns the bytes of a synthetic Geo-Trafic XML document with the given number of
+    events, each with links LineString link-geometries (plus, occasionally, an
+    ended link, which the converter drops). A recurrence_rate fraction of events
+    have daily schedule-times. ITIS codes and arrondissement names are drawn from
+    the ones the converter knows (and, for ITIS codes, maps to valid subtypes).
+    The same seed always produces the same document.
+    """
+    rand = random.Random(seed)
+    if not converter.ITIS_CATEGORIES:
+        converter._load_categories()
+    itis_codes = _valid_itis_codes()
+    root = etree.Element('Events', nsmap={None: converter.SOURCE_NAMESPACE})
+    base = datetime.datetime(2015, 1, 1)
+    link_id = 1000000
+    for i in range(events):
+        ev = _sub(root, 'Event')
+        _sub(ev, 'event-sid', str(7000000 + i))
+        _sub(ev, 'event-name', 'Travaux {} {}'.format(rand.choice(STREET_NAMES), i))
+        _sub(ev, 'event-status-tmdd-id', rand.choice(['8', '8', '8', '5', '6', '11']))
+        _sub(ev, 'event-flag-tmdd-id', rand.choice(['1', '1', '1', '2']))
+        _sub(ev, 'event-severity-tmdd-id', rand.choice(['1', '2', '3', '4']))
+        _sub(ev, 'event-planned-event-class-id', rand.choice(['1', '2', '2', '3']))
+        recurring = rand.random() < recurrence_rate
+        start = base + datetime.timedelta(days=rand.randrange(365))
+        if recurring:
+            end = start + datetime.timedelta(days=rand.randrange(1, 120), hours=23, minutes=59)
+        else:
+            start += datetime.timedelta(minutes=rand.randrange(0, 24 * 60, 15))
+            end = start + datetime.timedelta(minutes=rand.randrange(15, 90 * 24 * 60, 15))
+        _sub(ev, 'expected-start-time', _timestamp(start))
+        _sub(ev, 'expected-end-time', _timestamp(end))
+        _sub(ev, 'event-update-count', str(rand.randint(1, 20)))
+        _sub(ev, 'last-update-time', _timestamp(start - datetime.timedelta(
+            seconds=rand.randrange(30 * 86400), milliseconds=rand.randrange(1000))))
+        if recurring:
+            recurrent_times = _sub(ev, 'recurent-times')
+            for r in rand.sample(RECURRENCES, rand.choice([1, 1, 2])):
+                _sub(_sub(recurrent_times, 'recurent-time'), 'schedule-times', r)
+        if rand.random() < 0.5:
+            _sub(_sub(ev, 'project_references'), 'project-description',
+                'Description du projet {}\r\nEntrave partielle'.format(i))
+        descriptions = _sub(ev, 'event-descriptions')
+        for code in rand.sample(itis_codes, rand.choice([1, 1, 2])):
+            _sub(_sub(descriptions, 'event-cause'), 'ITIS-event-category-id', code)
+        locations = _sub(ev, 'event-locations')
+        for _ in range(links):
+            link_id += 1
+            _link(locations, rand, link_id, ended=False)
+        if rand.random() < ended_link_rate:
+            link_id += 1
+            _link(locations, rand, link_id, ended=True)
+    return etree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+def _source_events(feed):
+    return list(converter.iter_geotrafic_events(io.BytesIO(feed)))
+
+def _best_of(func, repeat):
+    # Best of repeat runs: (seconds, result of the last run)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def _peak_python_memory(func):
+    # Peak bytes allocated by Python while func runs. libxml2's own allocations
+    # aren't traced, which is why max_rss_kb is reported too.
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def synthetic_timestamps(count, seed=0):
+    """
+    Returns count timestamps in the Geo-Trafic format, spread over a few
+    years so that both -04:00 and -05:00 offsets appear.
+    """
+    rand = random.Random(seed)
+    start = converter.TIMEZONE.localize(datetime.datetime(2013, 1, 1))
+    timestamps = []
+    for _ in range(count):
+        dt = (start + datetime.timedelta(seconds=rand.randrange(4 * 365 * 86400))).astimezone(
+            converter.TIMEZONE)
+        dt = converter.TIMEZONE.normalize(dt).replace(microsecond=rand.randrange(1000) * 1000)
+        timestamps.append(_milliseconds_isoformat(dt))
+    return timestamps
+
+def benchmark_timestamps(args, feed):
+    count = 20000
+    timestamps = synthetic_timestamps(count)
+    for ts in timestamps[:1000]:
+        assert converter.parse_timestamp(ts) == dateutil.parser.parse(ts), ts
+    results = {}
+    for name, func in (('dateutil', dateutil.parser.parse),
+            ('parse_timestamp', converter.parse_timestamp)):
+        seconds, _ = _best_of(lambda: [func(ts) for ts in timestamps], args.repeat)
+        results[name] = {'seconds': seconds, 'per_second': count / seconds}
+    results['speedup'] = results['dateutil']['seconds'] / results['parse_timestamp']['seconds']
+    return results
+
+def _convert_event_stages(feed):
+    # Converts the feed as convert_events does, timing each stage with
+    # converter.instrument(). Returns the number of events converted, and
+    # the seconds spent in each stage.
+    enabled = metrics.enabled
+    converter.instrument()
+    before = dict((labels, total) for labels, (_, total) in metrics.TASK_SECONDS.values.items())
+    try:
+        converted = sum(1 for _ in converter.convert_events(_source_events(feed), None,
+            converter.LocalReprojector()))
+    finally:
+        if not enabled:
+            converter.uninstrument()
+    stages = {}
+    for labels, (_, total) in metrics.TASK_SECONDS.values.items():
+        if total > before.get(labels, 0.0):
+            stages[labels[0]] = total - before.get(labels, 0.0)
+    return converted, stages
+
+def benchmark_convert_event(args, feed):
+    results = {}
+    # Events are reparsed for every run, since conversion modifies them
+    seconds, converted = _best_of(lambda: [converter.convert_event(src, None,
+        converter.LocalReprojector()) for src in _source_events(feed)], args.repeat)
+    results['seconds'] = seconds
+    results['events_per_second'] = len(converted) / seconds
+
+    results['converted'], stages = _convert_event_stages(feed)
+    results['stages'] = dict((name, {'seconds': s, 'fraction': s / sum(stages.values())})
+        for name, s in stages.items())
+    return results
+
+def benchmark_geotrafic_to_xml(args, feed):
+    def _convert():
+        reprojector = converter.LocalReprojector()
+        return converter.geotrafic_to_xml(io.BytesIO(feed), None,
+            batch_size=args.batch_size, reprojector=reprojector)
+    seconds, doc = _best_of(_convert, args.repeat)
+    converted = len(doc.xpath('events/event'))
+    return {
+        'seconds': seconds,
+        'converted': converted,
+        'events_per_second': converted / seconds,
+        'peak_python_bytes': _peak_python_memory(_convert),
+    }
+
+def benchmark_geotrafic_to_json(args, feed):
+    # Conversion to a JSON document, as written by converter.py -f json
+    def _convert():
+        reprojector = converter.LocalReprojector()
+        events = converter.convert_events(converter.iter_geotrafic_events(io.BytesIO(feed)), None,
+            reprojector, args.batch_size, format='json')
+        out = io.StringIO()
+        converter.write_json_document(events, out)
+        return out.getvalue()
+    seconds, _ = _best_of(_convert, args.repeat)
+    converted = len(converter.geotrafic_to_json(io.BytesIO(feed), None, args.batch_size,
+        converter.LocalReprojector())['events'])
+    return {
+        'seconds': seconds,
+        'converted': converted,
+        'events_per_second': converted / seconds,
+        'peak_python_bytes': _peak_python_memory(_convert),
+    }
+
+def benchmark_daemon(args, feed):
+    # Latency for a small document: converter.py started from scratch every time,
+    # against the daemon, called from its command-line client or directly
+    small_feed = generate_feed(events=10, links=args.links, seed=args.seed)
+    my_dir = os.path.dirname(os.path.realpath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'feed.xml')
+        with open(filename, 'wb') as f:
+            f.write(small_feed)
+        socket_path = os.path.join(tmp, 'converter.sock')
+
+        def _run(script, *options):
+            subprocess.check_call([sys.executable, os.path.join(my_dir, script)] + list(options),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        cold, _ = _best_of(lambda: _run('converter.py', '--reprojection', 'local', filename),
+            args.repeat)
+
+        server = subprocess.Popen([sys.executable, os.path.join(my_dir, 'daemon.py'), '--serve',
+            '--reprojection', 'local', '--socket', socket_path], stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(socket_path):
+                if server.poll() is not None:
+                    raise Exception("The conversion daemon didn't start")
+                time.sleep(0.05)
+            warm_client, _ = _best_of(lambda: _run('daemon.py', '--socket', socket_path, filename),
+                args.repeat)
+            warm_request, response = _best_of(lambda: daemon.request([('feed.xml', small_feed)],
+                socket_path=socket_path), args.repeat)
+            assert 'output' in response, response.get('error')
+        finally:
+            server.terminate()
+            server.wait()
+    return {
+        'events': 10,
+        'cold_seconds': cold,
+        'warm_client_seconds': warm_client,
+        'warm_request_seconds': warm_request,
+        'speedup': cold / warm_client,
+    }
+
+BENCHMARKS = {
+    'timestamps': benchmark_timestamps,
+    'convert_event': benchmark_convert_event,
+    'geotrafic_to_xml': benchmark_geotrafic_to_xml,
+    'geotrafic_to_json': benchmark_geotrafic_to_json,
+    'daemon': benchmark_daemon,
+}
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Mesurer la performance du convertisseur sur un flux Geo-Trafic synthetique")
+    parser.add_argument('benchmarks', nargs='*', metavar='MESURE',
+        help="Mesures a effectuer: {} (toutes par defaut)".format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--events', type=int, default=1000, help="Nombre d'evenements")
+    parser.add_argument('--links', type=int, default=2, help="Nombre de liens par evenement")
+    parser.add_argument('--recurrence-rate', type=float, default=0.3,
+        help="Fraction des evenements avec un horaire recurrent")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=converter.REPROJECTION_BATCH_SIZE)
+    parser.add_argument('--repeat', type=int, default=3,
+        help="Nombre d'executions de chaque mesure; la meilleure est gardee")
+    parser.add_argument('--output', metavar='FICHIER', help="Fichier JSON ou ecrire les resultats")
+    parser.add_argument('--generate', metavar='FICHIER',
+        help="Ecrire le flux synthetique dans ce fichier, sans rien mesurer")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Mesure inconnue: {}".format(name))
+
+    feed = generate_feed(args.events, args.links, args.recurrence_rate, seed=args.seed)
+    if args.generate:
+        with open(args.generate, 'wb') as f:
+            f.write(feed)
+        return
+
+    results = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'parameters': {
+            'events': args.events,
+            'links': args.links,
+            'recurrence_rate': args.recurrence_rate,
+            'seed': args.seed,
+            'batch_size': args.batch_size,
+            'repeat': args.repeat,
+        },
+        'feed_bytes': len(feed),
+    }
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        sys.stderr.write("{}...\n".format(name))
+        results[name] = BENCHMARKS[name](args, feed)
+    results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+A feed of the changes to events, so that consumers can fetch only the
+events that changed rather than polling the whole events list.
+
+After each cycle that saved events, once it's committed, the importer appends
+the ID and change type (created, updated or archived) of each of them to
+EventChange. Entries are appended by one importer at a time, so that their
+IDs, which clients use as cursors, are committed in order: a client that has
+read up to a cursor never misses an entry committed later with a lower one.
+Entries older than GEOTRAFIC511_CHANGE_FEED_RETENTION_DAYS are pruned;
+clients with an older cursor must fetch the events list again.
+
+Clients waiting for changes don't hold a database connection: they check
+the generation counter of GEOTRAFIC511_GENERATION_FILE, which the importer
+increments after appending, every POLL_INTERVAL seconds, and only query the
+database once it's changed (or every DB_POLL_INTERVAL seconds without it).
+With the eventlet workers of gunicorn_settings.py, waiting clients each take
+a green thread, not a worker.
+
+Nothing is recorded unless GEOTRAFIC511_CHANGE_FEED is set.
+"""
+
+import datetime
+import json
+import time
+
+from django import db
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from . import response_cache
+from .models import EventChange
+
+POLL_INTERVAL = 1
+DB_POLL_INTERVAL = 5
+# Most entries returned at once
+PAGE_SIZE = 500
+# How long a client is told to wait before reconnecting to the stream, in milliseconds
+STREAM_RETRY = 3000
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def enabled():
+    return bool(getattr(settings, 'GEOTRAFIC511_CHANGE_FEED', False))
+
+def change_type(xml_event, created):
+    """The change type of a saved Open511 <event> Element."""
+    if xml_event.findtext('status') == 'ARCHIVED':
+        return EventChange.ARCHIVED
+    return EventChange.CREATED if created else EventChange.UPDATED
+
+def append(changes):
+    """Appends a list of (event ID, change type) to the feed, and prunes old entries."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Released on commit; reads aren't blocked
+            cursor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(
+                connection.ops.quote_name(EventChange._meta.db_table)))
+        EventChange.objects.bulk_create([EventChange(event_id=event_id, change_type=change_type)
+            for event_id, change_type in changes])
+        # Never the entries just appended, so that the latest cursor is kept
+        days = getattr(settings, 'GEOTRAFIC511_CHANGE_FEED_RETENTION_DAYS', 7)
+        EventChange.objects.filter(
+            time__lt=timezone.now() - datetime.timedelta(days=days)).delete()
+
+def current_cursor():
+    return EventChange.objects.aggregate(cursor=Max('id'))['cursor'] or 0
+
+def check_cursor(since):
+    """Raises CursorExpired if entries after since have been pruned, or since is unknown."""
+    bounds = EventChange.objects.aggregate(oldest=Min('id'), newest=Max('id'))
+    if bounds['newest'] is None:
+        if since:
+            raise CursorExpired
+    elif since < bounds['oldest'] - 1 or since > bounds['newest']:
+        raise CursorExpired
+
+def read(since, limit=PAGE_SIZE):
+    """The entries after cursor since, oldest first, up to limit."""
+    return list(EventChange.objects.filter(id__gt=since).order_by('id')[:limit])
+
+def wait(since, timeout, limit=PAGE_SIZE):
+    """Returns the entries after since, waiting up to timeout seconds for there to be some."""
+    deadline = time.time() + timeout
+    filename = getattr(settings, 'GEOTRAFIC511_GENERATION_FILE', None)
+    while True:
+        # Before reading, so that entries appended in between aren't missed
+        generation = response_cache.get_generation(filename) if filename else None
+        entries = read(since, limit)
+        if entries or time.time() >= deadline:
+            return entries
+        db.connection.close()
+        while time.time() < deadline:
+            time.sleep(min(POLL_INTERVAL if filename else DB_POLL_INTERVAL,
+                max(0, deadline - time.time())))
+            if not filename or response_cache.get_generation(filename) != generation:
+                break
+
+def as_json(entry):
+    return {
+        'cursor': entry.id,
+        'id': entry.event_id,
+        'type': entry.change_type,
+        'time': entry.time.isoformat(),
+    }
+
+def stream(since, duration, heartbeat=15):
+    """
+    Yields the Server-Sent Events of the entries after since, as they're
+    appended, for duration seconds, after which the client reconnects with
+    the Last-Event-ID of the last one. Comments are sent every heartbeat
+    seconds without changes, so that proxies keep the connection open.
+    """
+    deadline = time.time() + duration
+    yield 'retry: {}\n\n'.format(STREAM_RETRY)
+    while time.time() < deadline:
+        entries = wait(since, min(heartbeat, max(0, deadline - time.time())))
+        if not entries:
+            yield ':\n\n'
+            continue
+        yield ''.join('id: {}\ndata: {}\n\n'.format(entry.id,
+            json.dumps(as_json(entry), separators=(',', ':'))) for entry in entries)
+        since = entries[-1].id
+    db.connection.close()
@@ -1,26 +1,56 @@
 # coding: utf-8
 
 import argparse
+import collections
+import contextlib
+import copy
 import csv
 import datetime
+import functools
+import glob
+import hashlib
+import io
+import itertools
 import json
 import logging
 import os
 import re
+import multiprocessing
+import queue
+import random
+import sqlite3
 import sys
+import threading
+import time
 
 import dateutil.parser
 from lxml import etree
 import pytz
 
 from open511.converter.o5xml import json_struct_to_xml
-from open511.converter.o5json import xml_to_json
-from open511.utils.serialization import get_base_open511_element
-from open511.validator import validate_single_item
+from open511.converter.o5json import pluralize, xml_to_json
+from open511.utils.schedule import Schedule
+from open511.utils.serialization import NS_GML, get_base_open511_element
+from open511.validator import Open511ValidationError, validate, validate_single_item
+
+try:
+    from . import metrics, projection
+except ImportError:
+    # Run as a script, or from tests.py
+    import metrics
+    import projection
 
 JURISDICTION = 'ville.montreal.qc.ca'
 TIMEZONE = pytz.timezone('America/Montreal')
 SOURCE_SRID = 32188
+SOURCE_NAMESPACE = 'GeoTrafic'
+
+# Number of events whose link-geometries are reprojected in a single query
+REPROJECTION_BATCH_SIZE = 500
+# Default maximum number of geometries kept in a ReprojectionCache
+REPROJECTION_CACHE_SIZE = 20000
+# Default fraction of events validated in the 'sampled' validation mode
+VALIDATION_SAMPLE_RATE = 0.05
 
 logger = logging.getLogger(__name__)
 
@@ -33,30 +63,114 @@ def task(f):
     conv_funcs.append(f)
     return f
 
+def field_task(f):
+    """
+    Like task, but the function is passed an EventFields record, read from
+    the source Event in a single pass, instead of the Event element itself.
+    """
+    f.provide_fields = True
+    return task(f)
+
+# Business logic: if link has an effective-end-date, we should ignore it
+_ENDED_LOCATIONS = etree.XPath('event-locations/event-location[location-on-link/effective-end-date/text()]')
+_IS_ENDED_LOCATION = etree.XPath('boolean(location-on-link/effective-end-date/text())')
+_LINK_GEOMETRIES = etree.XPath(
+    'event-locations/event-location[not(location-on-link/effective-end-date/text())]'
+    '/location-on-link/link-geometry')
+_ITIS_CODES = etree.XPath('event-cause/ITIS-event-category-id/text()')
+_SCHEDULE_TIMES = etree.XPath('recurent-time/schedule-times/text()')
+_ROAD_LINKS = etree.XPath('event-locations/event-Location/location-on-link')
+
+class LinkFields(object):
+    """The values conversion tasks use from a <location-on-link>."""
+    __slots__ = ('geometries', 'left_jurisdiction_name', 'right_jurisdiction_name')
+
+    def __init__(self, location_on_link):
+        self.geometries = []
+        self.left_jurisdiction_name = self.right_jurisdiction_name = None
+        for child in location_on_link:
+            tag = child.tag
+            if tag == 'link-geometry':
+                self.geometries.append(child)
+            elif tag == 'link-left-jurisdiction-name':
+                if self.left_jurisdiction_name is None:
+                    self.left_jurisdiction_name = child.text
+            elif tag == 'link-right-jurisdiction-name':
+                if self.right_jurisdiction_name is None:
+                    self.right_jurisdiction_name = child.text
+
+class EventFields(object):
+    """
+    The values conversion tasks use from a Geo-Trafic Event, read in a single
+    pass over its children. Text fields follow findtext() semantics: None if
+    the element is missing, '' if it's empty. Links from event-locations with
+    an effective-end-date are left out.
+    """
+    __slots__ = ('sid', 'name', 'description', 'status_id', 'flag_id', 'severity_id',
+        'planned_event_class_id', 'last_update_time', 'expected_start_time', 'expected_end_time',
+        'itis_codes', 'schedule_times', 'links')
+
+    TEXT_FIELDS = {
+        'event-sid': 'sid',
+        'event-name': 'name',
+        'event-status-tmdd-id': 'status_id',
+        'event-flag-tmdd-id': 'flag_id',
+        'event-severity-tmdd-id': 'severity_id',
+        'event-planned-event-class-id': 'planned_event_class_id',
+        'last-update-time': 'last_update_time',
+        'expected-start-time': 'expected_start_time',
+        'expected-end-time': 'expected_end_time',
+    }
+
+    def __init__(self, src):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+        self.itis_codes = []
+        self.schedule_times = []
+        self.links = []
+        for child in src:
+            tag = child.tag
+            slot = self.TEXT_FIELDS.get(tag)
+            if slot:
+                if getattr(self, slot) is None:
+                    setattr(self, slot, child.text or '')
+            elif tag == 'project_references':
+                if self.description is None:
+                    self.description = child.findtext('project-description')
+            elif tag == 'event-descriptions':
+                self.itis_codes.extend(_ITIS_CODES(child))
+            elif tag == 'recurent-times':
+                self.schedule_times.extend(_SCHEDULE_TIMES(child))
+            elif tag == 'event-locations':
+                for location in child:
+                    if location.tag == 'event-location' and not _IS_ENDED_LOCATION(location):
+                        self.links.extend(LinkFields(lol) for lol in location
+                            if lol.tag == 'location-on-link')
+
 @task
 def _prune_links(src, ev):
-    # Business logic: if link has an effective-end-date, we should ignore it
-    for bad_location in src.xpath('event-locations/event-location[location-on-link/effective-end-date/text()]'):
+    # Keeps the source element consistent with EventFields, for tasks that read it directly
+    for bad_location in _ENDED_LOCATIONS(src):
         bad_location.getparent().remove(bad_location)
 
-@task
-def _id(src, ev):
-    ev['id'] = JURISDICTION + '/' + src.findtext('event-sid')
+@field_task
+def _id(fields, ev):
+    ev['id'] = JURISDICTION + '/' + fields.sid
     # ev['url'] = BASE_URL + ev['id']
 
-@task
-def _headline(src, ev):
-    ev['headline'] = src.findtext('event-name')
+@field_task
+def _headline(fields, ev):
+    ev['headline'] = fields.name
 
-@task
-def _description(src, ev):
-    descr = src.findtext('project_references/project-description')
+@field_task
+def _description(fields, ev):
+    descr = fields.description
     if descr:
         ev['description'] = descr.replace("\r", '')
 
-@task
-def _status_id(src, ev):
-    status_id = src.findtext('event-status-tmdd-id')
+@field_task
+def _status_id(fields, ev):
+    status_id = fields.status_id
     if status_id and status_id.isdigit():
         if status_id in ('11', '12', '13'):
             # ended/deleted/cancelled
@@ -68,15 +182,15 @@ def _status_id(src, ev):
             # confirmed
             ev['certainty'] = 'OBSERVED'
 
-@task
-def _active_flag(src, ev):
+@field_task
+def _active_flag(fields, ev):
     ev.setdefault('status', 'ACTIVE')
-    if src.findtext('event-flag-tmdd-id') == '2':
+    if fields.flag_id == '2':
         ev['status'] = 'ARCHIVED'
 
-@task
-def _severity(src, ev):
-    sev = src.findtext('event-severity-tmdd-id')
+@field_task
+def _severity(fields, ev):
+    sev = fields.severity_id
     if sev in ('1', '2'):
         ev['severity'] = 'MINOR'
     elif sev in ('3', '4'):
@@ -84,9 +198,9 @@ def _severity(src, ev):
     else:
         ev['severity'] = 'UNKNOWN'
 
-@task
-def _event_type(src, ev):
-    code = src.findtext('event-planned-event-class-id')
+@field_task
+def _event_type(fields, ev):
+    code = fields.planned_event_class_id
     if code == '2':
         ev['event_type'] = 'CONSTRUCTION'
     elif code == '3':
@@ -94,6 +208,33 @@ def _event_type(src, ev):
     else:
         ev['event_type'] = 'INCIDENT'
 
+_TIMESTAMP_RE = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?(Z|[+-]\d\d:?\d\d)?$')
+_TZ_OFFSETS = {'Z': datetime.timezone.utc}
+
+def _tz_offset(offset):
+    try:
+        return _TZ_OFFSETS[offset]
+    except KeyError:
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tz = datetime.timezone(datetime.timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+        _TZ_OFFSETS[offset] = tz
+        return tz
+
+def parse_timestamp(s):
+    """
+    Parses a timestamp in the format used by Geo-Trafic, e.g. 2015-11-16T13:56:59.320-05:00,
+    much faster than dateutil.parser.parse, which is still used for any other format.
+    Like dateutil, returns a naive datetime if there's no UTC offset.
+    """
+    m = _TIMESTAMP_RE.match(s)
+    if not m:
+        return dateutil.parser.parse(s)
+    year, month, day, hour, minute, second, fraction, offset = m.groups()
+    return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+        int(second) if second else 0, int(fraction.ljust(6, '0')) if fraction else 0,
+        _tz_offset(offset) if offset else None)
+
 ITIS_CATEGORIES = dict()
 def _load_categories():
     my_dir = os.path.dirname(os.path.realpath(__file__))
@@ -102,9 +243,9 @@ def _load_categories():
         for row in reader:
             ITIS_CATEGORIES[row['id']] = row
 
-@task
-def _event_subtypes(src, ev):
-    codes = set(src.xpath('event-descriptions/event-cause/ITIS-event-category-id/text()'))
+@field_task
+def _event_subtypes(fields, ev):
+    codes = set(fields.itis_codes)
     if codes and not ITIS_CATEGORIES:
         _load_categories()
     subtypes = set()
@@ -124,11 +265,11 @@ def _event_subtypes(src, ev):
     #     ev['+itis_categories'] = list(itis_category_names)
 
 
-@task
-def _last_update(src, ev):
-    timestring = src.findtext('last-update-time')
+@field_task
+def _last_update(fields, ev):
+    timestring = fields.last_update_time
     if timestring:
-        timestamp = dateutil.parser.parse(timestring)
+        timestamp = parse_timestamp(timestring)
         if not timestamp.tzinfo:
             timestamp = TIMEZONE.localize(timestamp) # make timezone-aware
     else:
@@ -139,7 +280,7 @@ def _last_update(src, ev):
 @task
 def _roads(src, ev):
     roads = []
-    for lol in src.xpath('event-locations/event-Location/location-on-link'):
+    for lol in _ROAD_LINKS(src):
         name = lol.findtext('link-name')
         if not name:
             continue
@@ -169,10 +310,9 @@ def _roads(src, ev):
     if roads:
         ev['roads'] = roads
 
-@task
-def _geography(src, ev, db_conn):
-    geoms = [reproject_geometry(g, db_conn) for g in
-        src.xpath('event-locations/event-location/location-on-link/link-geometry')]
+@field_task
+def _geography(fields, ev, reprojector):
+    geoms = [reprojector.reproject(g) for link in fields.links for g in link.geometries]
     if not geoms:
         raise DataError("Event is missing link-geometry")
     if len(geoms) == 1:
@@ -187,23 +327,22 @@ def _geography(src, ev, db_conn):
             'coordinates': [g['coordinates'] for g in geoms]
         }
     ev['geography'] = geom
-_geography.provide_db_connection = True
+_geography.provide_reprojector = True
 
 INTERVALS_FORMAT = '%Y-%m-%dT%H:%M'
-@task
-def _schedule(src, ev):
-    start_dt = src.findtext('expected-start-time')
-    start_dt = dateutil.parser.parse(start_dt) if start_dt else datetime.datetime.now()
+@field_task
+def _schedule(fields, ev):
+    start_dt = fields.expected_start_time
+    start_dt = parse_timestamp(start_dt) if start_dt else datetime.datetime.now()
     start_dt = start_dt.replace(tzinfo=None)
-    end_dt = src.findtext('expected-end-time')
-    end_dt = dateutil.parser.parse(end_dt) if end_dt else None
+    end_dt = fields.expected_end_time
+    end_dt = parse_timestamp(end_dt) if end_dt else None
     if end_dt:
         end_dt = end_dt.replace(tzinfo=None)
     if end_dt and end_dt <= start_dt:
         raise Exception("End DT %s before start %s" % (end_dt, start_dt))
 
-    recurrences = src.xpath('recurent-times/recurent-time/schedule-times/text()')
-    recurrences = [r for r in recurrences
+    recurrences = [r for r in fields.schedule_times
         if r not in ('00012359', '00002359')] # unnecessary to specify if it's all-day
 
     if recurrences:
@@ -300,17 +439,34 @@ ARRONDISSEMENTS = [
     ('Villeray–Saint-Michel–Parc-Extension', 6174349),
 ]
 
+def schedule_intervals(schedule_el, start, end):
+    """
+    Returns a list of the (start, end) periods during which an Open511
+    <schedule> element is in effect between the aware datetimes start and end,
+    as aware datetimes. The end of a period is None if it doesn't have one.
+    Long periods may be split in several consecutive ones.
+    """
+    is_intervals = schedule_el.find('intervals') is not None
+    periods = []
+    for period_start, period_end in Schedule.from_element(schedule_el, TIMEZONE).intervals(
+            start, end):
+        if is_intervals:
+            # These get the zone's LMT offset, since they're made aware with replace(tzinfo=)
+            period_start = TIMEZONE.localize(period_start.replace(tzinfo=None))
+            if period_end is not None:
+                period_end = TIMEZONE.localize(period_end.replace(tzinfo=None))
+        periods.append((period_start, period_end))
+    return periods
+
 def _normalize_arrondissement(s):
     return re.sub(r'[\s–-]', '', s.lower())
 
 ARRONDISSEMENTS_LOOKUP = {_normalize_arrondissement(name): (name, geo_id) for name, geo_id in ARRONDISSEMENTS}
 
-@task
-def _areas(src, ev):
-    area_names = set(
-        src.xpath('event-locations/event-location/location-on-link/link-left-jurisdiction-name/text()') +
-        src.xpath('event-locations/event-location/location-on-link/link-right-jurisdiction-name/text()')
-    )
+@field_task
+def _areas(fields, ev):
+    area_names = set(name for link in fields.links
+        for name in (link.left_jurisdiction_name, link.right_jurisdiction_name) if name)
     areas = []
     for area_name in area_names:
         area_name_normalized = _normalize_arrondissement(area_name)
@@ -324,79 +480,939 @@ def _areas(src, ev):
     if areas:
         ev['areas'] = areas
 
+def _gml(link_geometry):
+    return etree.tostring(link_geometry[0], encoding='unicode')
+
+def _reproject_gml(gml_strings, db_conn):
+    """
+    Reprojects a list of GML strings into WGS84 with a single query.
+    Returns a dict mapping each GML string to a GeoJSON string.
+    """
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT gml, ST_AsGeoJSON(ST_Transform(ST_GeomFromGML(gml, %s), 4326)) "
+        "FROM unnest(%s) AS gml;", (SOURCE_SRID, list(gml_strings)))
+    result = dict(cursor.fetchall())
+    cursor.close()
+    return result
+
 def reproject_geometry(link_geometry, db_conn):
     """
     Argument: an etree Element for the <link-geometry> tag.
     Returns a GeoJSON dict, reprojected into WGS84.
     """
-    src = etree.tostring(link_geometry[0], encoding='unicode')
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT ST_AsGeoJSON(ST_Transform(ST_GeomFromGML(%s, %s), 4326));",
-        (src, SOURCE_SRID))
-    result = cursor.fetchone()[0]
-    cursor.close()
-    return json.loads(result)
+    src = _gml(link_geometry)
+    return json.loads(_reproject_gml([src], db_conn)[src])
+
+def link_geometries(srcevents):
+    """
+    Returns all the <link-geometry> elements that will need to be reprojected
+    to convert the provided Geo-Trafic Events (i.e. ignoring pruned links).
+    """
+    return [g for src in srcevents for g in _LINK_GEOMETRIES(src)]
 
+class ReprojectionCache(object):
+    """
+    A bounded cache of reprojected geometries, keyed by link-id and a hash of
+    the source GML, which evicts the least recently used entries.
 
-def convert_event(src, db_conn):
+    If a filename is provided, the cache is loaded from that SQLite file,
+    and written back to it by save(). It can be shared between threads.
+    """
+
+    def __init__(self, max_size=REPROJECTION_CACHE_SIZE, filename=None):
+        self.max_size = max_size
+        self.filename = filename
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(link_geometry, gml):
+        location = link_geometry.getparent()
+        link_id = location.findtext('link-id') if location is not None else None
+        return (link_id or '') + ':' + hashlib.sha1(gml.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached GeoJSON string for key, or None."""
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self):
+        # The connection's own context manager only commits; it doesn't close it
+        with contextlib.closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS geometries (key TEXT PRIMARY KEY, geojson TEXT, position INTEGER)")
+            for key, value in conn.execute("SELECT key, geojson FROM geometries ORDER BY position"):
+                self.set(key, value)
+
+    def save(self):
+        if not self.filename:
+            return
+        with contextlib.closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS geometries (key TEXT PRIMARY KEY, geojson TEXT, position INTEGER)")
+            conn.execute("DELETE FROM geometries")
+            conn.executemany("INSERT INTO geometries VALUES (?, ?, ?)",
+                ((key, value, i) for i, (key, value) in enumerate(self.entries.items())))
+
+    def stats(self):
+        return "{} hits, {} misses, {} geometries cached".format(self.hits, self.misses, len(self))
+
+class BaseReprojector(object):
+    """
+    Reprojects <link-geometry> elements into WGS84 GeoJSON.
+
+    Geometries passed to prefetch() are reprojected together in a single batch,
+    and kept until the next prefetch(), so that later calls to reproject() can
+    be answered directly without results accumulating over a whole feed.
+    If a ReprojectionCache is provided, it's consulted before reprojecting anything.
+    Subclasses implement reproject_batch().
+    """
+
+    def __init__(self, cache=None):
+        self.results = {}
+        self.cache = cache
+
+    def reproject_batch(self, gml_strings):
+        """Returns a dict mapping each provided GML string to a GeoJSON string."""
+        raise NotImplementedError
+
+    def _fetch(self, link_geometries):
+        to_reproject = {}
+        for link_geometry in link_geometries:
+            src = _gml(link_geometry)
+            if src in self.results or src in to_reproject:
+                continue
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(link_geometry, src)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.results[src] = cached
+                    continue
+            to_reproject[src] = key
+        if not to_reproject:
+            return
+        reprojected = self.reproject_batch(list(to_reproject))
+        self.results.update(reprojected)
+        if self.cache is not None:
+            for src, key in to_reproject.items():
+                self.cache.set(key, reprojected[src])
+
+    def prefetch(self, link_geometries):
+        # Only the current batch's geometries are kept
+        self.results = {}
+        try:
+            self._fetch(link_geometries)
+        except Exception:
+            # Fall back to reprojecting one geometry at a time, so that
+            # a single bad geometry only affects its own event
+            logger.exception("Error reprojecting a batch of geometries")
+
+    def reproject(self, link_geometry):
+        src = _gml(link_geometry)
+        if src not in self.results:
+            self._fetch([link_geometry])
+        return json.loads(self.results[src])
+
+class PostGISReprojector(BaseReprojector):
+    """Reprojects geometries using PostGIS, one query per batch."""
+
+    def __init__(self, db_conn, cache=None):
+        super(PostGISReprojector, self).__init__(cache=cache)
+        self.db_conn = db_conn
+
+    def reproject_batch(self, gml_strings):
+        return _reproject_gml(gml_strings, self.db_conn)
+
+class LocalReprojector(BaseReprojector):
+    """Reprojects geometries in-process, without a database."""
+
+    def reproject_batch(self, gml_strings):
+        try:
+            return projection.reproject_gml(gml_strings)
+        except ValueError as e:
+            raise DataError(str(e))
+
+REPROJECTION_METHODS = ('postgis', 'local')
+
+def get_reprojector(method, db_conn=None, cache=None):
+    """Returns a new reprojector for one of the REPROJECTION_METHODS."""
+    if method == 'local':
+        return LocalReprojector(cache=cache)
+    elif method == 'postgis':
+        return PostGISReprojector(db_conn, cache=cache)
+    raise ValueError("Unknown reprojection method %s" % method)
+
+VALIDATION_MODES = ('per-event', 'batch', 'sampled')
+
+class EventValidator(object):
+    """
+    Validates converted events against the Open511 schemas. Depending on mode:
+
+    per-event: each event is validated on its own as it's converted
+    batch: each batch of converted events is validated as a single document;
+        if that fails, its events are validated one by one to find the invalid ones
+    sampled: a random sample_rate fraction of events is validated as they're converted
+
+    Keeps count of the events validated and the time spent doing so.
+    """
+
+    def __init__(self, mode='per-event', sample_rate=VALIDATION_SAMPLE_RATE):
+        if mode not in VALIDATION_MODES:
+            raise ValueError("Unknown validation mode %s" % mode)
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.validated = 0
+        self.seconds = 0.0
+
+    def _validate_single(self, xml_ev):
+        start = time.time()
+        try:
+            validate_single_item(xml_ev, ignore_missing_urls=True)
+        finally:
+            self.validated += 1
+            self.seconds += time.time() - start
+
+    def _select(self):
+        # Whether to validate the next event on its own
+        return self.mode == 'per-event' or (
+            self.mode == 'sampled' and random.random() < self.sample_rate)
+
+    def validate_event(self, xml_ev):
+        """Raises Open511ValidationError if the event is to be validated now, and is invalid."""
+        if self._select():
+            self._validate_single(xml_ev)
+
+    def validate_struct(self, ev):
+        """
+        Like validate_event, for an event in the dict form built by the conversion
+        tasks, which is only serialized to XML if it's to be validated now.
+        """
+        if self._select():
+            self._validate_single(_serialize(ev))
+
+    def validate_batch(self, xml_events):
+        """
+        Returns the events from the provided list that are valid. Outside of
+        batch mode, they've already been validated, so that's all of them.
+        """
+        if self.mode != 'batch' or not xml_events:
+            return xml_events
+        start = time.time()
+        doc = get_base_open511_element(version='v1')
+        container = etree.SubElement(doc, 'events')
+        for xml_ev in xml_events:
+            xml_ev = copy.deepcopy(xml_ev)
+            # As in validate_single_item(ignore_missing_urls=True)
+            etree.SubElement(xml_ev, 'link', rel='self', href='/fake/data')
+            etree.SubElement(xml_ev, 'link', rel='jurisdiction',
+                href='http://example.com/fake/jurisdiction')
+            container.append(xml_ev)
+        try:
+            validate(doc)
+            self.validated += len(xml_events)
+            return xml_events
+        except Open511ValidationError:
+            pass
+        finally:
+            self.seconds += time.time() - start
+            if metrics.enabled:
+                metrics.TASK_SECONDS.observe(time.time() - start, 'batch_validation')
+        valid = []
+        for xml_ev in xml_events:
+            try:
+                self._validate_single(xml_ev)
+                valid.append(xml_ev)
+            except Open511ValidationError:
+                logger.exception("Invalid event %s", xml_ev.findtext('id'))
+        return valid
+
+    def stats(self):
+        return "{} events validated ({}) in {:.2f} s".format(self.validated, self.mode, self.seconds)
+
+def batches(iterable, size):
+    """Splits an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _strip_namespace(el):
+    prefix = '{%s}' % SOURCE_NAMESPACE
+    for child in el.iter():
+        if isinstance(child.tag, str) and child.tag.startswith(prefix):
+            child.tag = child.tag[len(prefix):]
+    etree.cleanup_namespaces(el)
+
+def iter_geotrafic_events(source):
+    """
+    Incrementally parses a Geo-Trafic XML document from source, a filename or
+    a binary file-like object, and yields each Event as soon as it's complete.
+
+    Events are returned without the GeoTrafic namespace, and are detached from
+    the document once read, so memory use doesn't grow with the document's size.
+    """
+    for _, srcevent in etree.iterparse(source, events=('end',), tag='{*}Event'):
+        srcevent.getparent().remove(srcevent)
+        _strip_namespace(srcevent)
+        yield srcevent
+
+def convert_event(src, db_conn, reprojector=None, validator=None):
     """
     Convert a single lxml Event from the Geo-Trafic source file into an lxml
     Element for an Open511 <event>
+
+    The result is validated, unless an EventValidator provided says otherwise.
+    """
+    xml_ev = _serialize(_convert_struct(src, db_conn, reprojector))
+    _validate(xml_ev, validator)
+    return xml_ev
+
+def convert_event_json(src, db_conn, reprojector=None, validator=None):
     """
+    Like convert_event, but returns the event in the Open511 JSON format: the
+    same dict that converting the XML from convert_event with xml_to_json
+    would produce, without going through XML. Validation is the same.
+    """
+    ev = _convert_struct(src, db_conn, reprojector)
+    _validate_struct(ev, validator)
+    return _open511_json(ev)
+
+def _convert_struct(src, db_conn, reprojector):
+    # Runs the conversion tasks, returning the JSON-like dict they build
+    if reprojector is None:
+        reprojector = PostGISReprojector(db_conn)
+    fields = _event_fields(src)
     ev = {}
     for conv_func in conv_funcs:
-        if getattr(conv_func, 'provide_db_connection', None):
-            conv_func(src, ev, db_conn)
+        source = fields if getattr(conv_func, 'provide_fields', None) else src
+        if getattr(conv_func, 'provide_reprojector', None):
+            conv_func(source, ev, reprojector)
+        elif getattr(conv_func, 'provide_db_connection', None):
+            conv_func(source, ev, db_conn)
         else:
-            conv_func(src, ev)
-    xml_ev = json_struct_to_xml(ev, root='event',
+            conv_func(source, ev)
+    return ev
+
+def _event_fields(src):
+    return EventFields(src)
+
+def _serialize(ev):
+    # The gml prefix is declared on the event, so that it's used even when
+    # the event is serialized on its own
+    return json_struct_to_xml(ev, root=etree.Element('event', nsmap={'gml': NS_GML}),
         custom_namespace='http://ville.montreal.qc.ca/open511-extensions')
-    validate_single_item(xml_ev, ignore_missing_urls=True)
-    return xml_ev
 
-def geotrafic_to_xml(xml_string, db_conn):
+def _validate(xml_ev, validator):
+    if validator is None:
+        validate_single_item(xml_ev, ignore_missing_urls=True)
+    else:
+        validator.validate_event(xml_ev)
+
+def _validate_struct(ev, validator):
+    if validator is None:
+        validate_single_item(_serialize(ev), ignore_missing_urls=True)
+    else:
+        validator.validate_struct(ev)
+
+# What json_struct_to_xml followed by xml_to_json does to an event dict, without the XML.
+# Strings of digits become ints, None values and empty dicts and lists become null,
+# lists only stay lists if their items' singular tag pluralizes back to their key,
+# and geometries go through GML, leaving only floats in their coordinates.
+
+def _intify(text):
+    return int(text) if text is not None and text.isdigit() else text
+
+def _singular(tag):
+    # As in json_struct_to_xml
+    if tag.endswith('ies'):
+        return tag[:-3] + 'y'
+    elif tag.endswith('s'):
+        return tag[:-1]
+    return tag
+
+def _is_geometry(value):
+    return isinstance(value, dict) and value.keys() == {'type', 'coordinates'}
+
+def _geometry_json(geom):
+    geom_type = geom['type']
+    coordinates = geom['coordinates']
+    point = lambda c: (float(c[0]), float(c[1]))
+    if geom_type == 'Point':
+        coordinates = point(coordinates)
+    elif geom_type in ('LineString', 'MultiPoint'):
+        coordinates = [point(c) for c in coordinates]
+    elif geom_type in ('Polygon', 'MultiLineString'):
+        coordinates = [[point(c) for c in part] for part in coordinates]
+    elif geom_type == 'MultiPolygon':
+        coordinates = [[[point(c) for c in ring] for ring in part] for part in coordinates]
+    else:
+        raise NotImplementedError("Unsupported geometry type %s" % geom_type)
+    return {'type': geom_type, 'coordinates': coordinates}
+
+def _children(tag, value):
+    # The (tag, value) of the child elements json_struct_to_xml would create
+    if isinstance(value, dict):
+        return [(k, v) for k, v in value.items() if v is not None]
+    child_tag = _singular(tag)
+    return [(child_tag, v) for v in value if v is not None]
+
+def _element_json(tag, value):
+    # As xml_to_json(json_struct_to_xml(value, tag))
+    if isinstance(value, str):
+        return _intify(value)
+    if isinstance(value, (int, float)):
+        return _intify(str(value))
+    if _is_geometry(value):
+        return _geometry_json(value)
+    children = _children(tag, value)
+    if not children:
+        return None
+    j = {}
+    for child_tag, child_value in children:
+        if child_tag not in j:
+            j[child_tag] = _child_json(child_tag, child_value)
+    return j
+
+def _child_json(tag, value):
+    # What xml_to_json makes of a child element built from value
+    if isinstance(value, (dict, list)) and not _is_geometry(value):
+        if tag == 'url' or tag.endswith('_url') or tag in (
+                'attachments', 'grouped_events', 'media_files'):
+            # Links aren't produced by our tasks; let open511 deal with them
+            return xml_to_json(json_struct_to_xml({tag: value}, 'event'))[tag]
+        children = _children(tag, value)
+        if children and all(tag == pluralize(child_tag) for child_tag, _ in children):
+            return [_element_json(child_tag, child_value) for child_tag, child_value in children]
+    return _element_json(tag, value)
+
+def _open511_json(ev):
+    return _element_json('event', ev)
+
+def _timed(name, func):
+    # Wraps func so that its duration is observed in metrics.TASK_SECONDS.
+    # functools.wraps also copies attributes like provide_fields.
+    observe = metrics.TASK_SECONDS.observe
+    @functools.wraps(func)
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            observe(time.perf_counter() - start, name)
+    return timed
+
+# What instrument() replaced, for uninstrument()
+_uninstrumented = {}
+
+def instrument():
     """
-    Converts a string containing a Geo-Trafic XML document into an lxml Element
-    containing an open511 document.
+    Turns on metrics for this process: the time taken by reprojection, each
+    of conv_funcs, serialization and validation, and counts of converted and
+    failed events. Otherwise, the conversion tasks aren't touched, and cost
+    nothing extra.
     """
-    xml_string = xml_string.replace('<Events xmlns="GeoTrafic">', '<Events>') # simpler
-    srcdoc = etree.fromstring(xml_string)
-    srcevents = srcdoc.xpath('Event')
-    root = get_base_open511_element(lang='fr', version='v1')
-    events = etree.Element('events')
-    root.append(events)
+    global _event_fields, _serialize, _validate, _validate_struct, _open511_json
+    if metrics.enabled:
+        return
+    metrics.enabled = True
+    _uninstrumented.update(conv_funcs=list(conv_funcs), _event_fields=_event_fields,
+        _serialize=_serialize, _validate=_validate, _validate_struct=_validate_struct,
+        _open511_json=_open511_json)
+    conv_funcs[:] = [_timed(f.__name__.lstrip('_'), f) for f in conv_funcs]
+    _event_fields = _timed('fields', _event_fields)
+    _serialize = _timed('serialization', _serialize)
+    _validate = _timed('validation', _validate)
+    _validate_struct = _timed('validation', _validate_struct)
+    _open511_json = _timed('json_serialization', _open511_json)
+
+def uninstrument():
+    """Undoes instrument(), e.g. once a benchmark or a test is done with it."""
+    if not metrics.enabled:
+        return
+    conv_funcs[:] = _uninstrumented.pop('conv_funcs')
+    globals().update(_uninstrumented)
+    _uninstrumented.clear()
+    metrics.enabled = False
+
+def convert_batch(srcevents, db_conn, reprojector, validator=None, format='xml'):
+    """
+    Converts a list of Geo-Trafic Events, reprojecting all their geometries at once.
+    Returns a list of (source Event, Open511 <event>) pairs, in which the
+    Open511 element is None if the event couldn't be converted or is invalid.
+    With format='json', Open511 JSON dicts are returned instead of Elements.
+    """
+    if validator is None:
+        validator = EventValidator()
+    convert = convert_event_json if format == 'json' else convert_event
+    start = time.perf_counter()
+    reprojector.prefetch(link_geometries(srcevents))
+    if metrics.enabled:
+        metrics.TASK_SECONDS.observe(time.perf_counter() - start, 'reprojection')
+    results = []
     for srcevent in srcevents:
         try:
-            ev = convert_event(srcevent, db_conn)
-            events.append(ev)
+            results.append((srcevent, convert(srcevent, db_conn, reprojector, validator)))
         except:
             logger.exception("Error processing event %s" % srcevent.findtext('event-sid'))
-            continue
+            results.append((srcevent, None))
+    converted = [ev for _, ev in results if ev is not None]
+    if format == 'json' and validator.mode == 'batch':
+        # Only serialized to XML to be validated
+        xml_events = [json_struct_to_xml(ev, 'event') for ev in converted]
+        valid_xml = set(id(xml_ev) for xml_ev in validator.validate_batch(xml_events))
+        valid = set(id(ev) for ev, xml_ev in zip(converted, xml_events) if id(xml_ev) in valid_xml)
+    else:
+        valid = set(id(ev) for ev in validator.validate_batch(converted))
+    if metrics.enabled:
+        metrics.EVENTS_CONVERTED.inc(len(valid))
+        metrics.EVENTS_FAILED.inc(len(results) - len(valid))
+    return [(srcevent, ev if id(ev) in valid else None) for srcevent, ev in results]
+
+def convert_events(srcevents, db_conn, reprojector=None, batch_size=REPROJECTION_BATCH_SIZE,
+        validator=None, format='xml'):
+    """
+    Converts an iterable of Geo-Trafic Events, batch_size events at a time,
+    yielding Open511 <event> Elements, or JSON dicts with format='json'.
+    Events that can't be converted are logged and skipped.
+    """
+    if reprojector is None:
+        reprojector = PostGISReprojector(db_conn)
+    for batch in batches(srcevents, batch_size):
+        for _, ev in convert_batch(batch, db_conn, reprojector, validator, format):
+            if ev is not None:
+                yield ev
+
+# State for each process of a parallel conversion pool; see init_worker
+_worker = {}
+
+def init_worker(reprojection, postgres_dsn=None, cache_file=None,
+        validation='per-event', sample_rate=VALIDATION_SAMPLE_RATE, cache_size=None):
+    """
+    Initializer for a multiprocessing Pool used by convert_events_parallel:
+    each worker process gets its own database connection (if reprojecting
+    with PostGIS) and reprojection cache, loaded from cache_file. Workers
+    never write the file: the geometries they reprojected are sent back with
+    their results, for the parent's cache.
+    """
+    _worker['reprojection'] = reprojection
+    _worker['db_conn'] = _connect(postgres_dsn) if reprojection == 'postgis' else None
+    _worker['cache'] = None
+    if cache_file or cache_size:
+        _worker['cache'] = ReprojectionCache(cache_size or REPROJECTION_CACHE_SIZE,
+            filename=cache_file)
+    _worker['validation'] = (validation, sample_rate)
+
+def _convert_serialized(event_strings, format='xml'):
+    srcevents = [etree.fromstring(s) for s in event_strings]
+    cache = _worker['cache']
+    missing = []
+    if cache is not None:
+        missing = set(cache.key(g, _gml(g)) for g in link_geometries(srcevents))
+        missing = [key for key in missing if key not in cache.entries]
+    reprojector = get_reprojector(_worker['reprojection'], _worker['db_conn'], cache=cache)
+    validator = EventValidator(*_worker['validation'])
+    converted = [ev for _, ev in convert_batch(srcevents, _worker['db_conn'], reprojector,
+        validator, format) if ev is not None]
+    if format == 'xml':
+        # JSON dicts can be pickled as they are
+        converted = [etree.tostring(ev) for ev in converted]
+    reprojected = [(key, cache.entries[key]) for key in missing if key in cache.entries]
+    return converted, validator.validated, validator.seconds, reprojected
+
+def convert_events_parallel(srcevents, pool, batch_size=REPROJECTION_BATCH_SIZE, max_pending=8,
+        validator=None, format='xml', cache=None):
+    """
+    Like convert_events, but spreads batches of events across the processes of pool,
+    a multiprocessing Pool initialized with init_worker. Results are yielded in source order.
+    At most max_pending batches are in flight at once. If a validator is provided,
+    the workers' validation counts and times are added to it; if a ReprojectionCache
+    is, the geometries the workers reprojected are added to it.
+    """
+    def _results(async_result):
+        converted, validated, seconds, reprojected = async_result.get()
+        if validator is not None:
+            validator.validated += validated
+            validator.seconds += seconds
+        if cache is not None:
+            for key, value in reprojected:
+                cache.set(key, value)
+        if format == 'xml':
+            return [etree.fromstring(ev) for ev in converted]
+        return converted
+
+    pending = collections.deque()
+    for batch in batches(srcevents, batch_size):
+        pending.append(pool.apply_async(_convert_serialized,
+            ([etree.tostring(ev) for ev in batch], format)))
+        while len(pending) > max_pending:
+            for ev in _results(pending.popleft()):
+                yield ev
+    while pending:
+        for ev in _results(pending.popleft()):
+            yield ev
+
+def threaded_map(func, iterable, workers=4, max_pending=8, setup=None, teardown=None):
+    """
+    Like map(func, iterable), but calls func in a pool of worker threads while
+    another thread takes the next items from iterable, so that fetching,
+    converting and whatever the caller does with the results overlap.
+    Results are yielded in order. At most max_pending items are taken from
+    iterable and not yet yielded, so that memory stays bounded when the
+    caller or one item is slow.
+
+    setup(), if provided, is called in each worker thread, and its result
+    passed as func's first argument; teardown(state) is called when the
+    worker exits. Exceptions raised by iterable or func are raised here.
+    """
+    tasks = queue.Queue()
+    results = queue.Queue()
+    slots = threading.Semaphore(max_pending)
+    stop = threading.Event()
+    # A result for the end of iterable; doesn't compare equal to any index
+    end = object()
+
+    def produce():
+        count = 0
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                tasks.put((count, item))
+                count += 1
+            results.put((end, count))
+        except BaseException as e:
+            results.put((end, e))
+        finally:
+            for _ in range(workers):
+                tasks.put(None)
+            # So that a generator's cleanup runs in this thread
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def work():
+        state = setup() if setup else None
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                if stop.is_set():
+                    continue
+                index, item = task
+                try:
+                    result = func(state, item) if setup else func(item)
+                except BaseException as e:
+                    results.put((index, e))
+                    stop.set()
+                else:
+                    results.put((index, result))
+        finally:
+            if teardown:
+                teardown(state)
+
+    threads = [threading.Thread(target=produce, name='threaded_map-producer')]
+    threads.extend(threading.Thread(target=work, name='threaded_map-worker-%d' % i)
+        for i in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    pending = {}
+    next_index = 0
+    count = None
+    try:
+        while count is None or next_index < count:
+            index, result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            if index is end:
+                count = result
+                continue
+            pending[index] = result
+            while next_index in pending:
+                result = pending.pop(next_index)
+                next_index += 1
+                slots.release()
+                yield result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def _open511_document(events):
+    root = get_base_open511_element(lang='fr', version='v1')
+    events_el = etree.Element('events')
+    root.append(events_el)
+    for ev in events:
+        events_el.append(ev)
     return root
 
+def geotrafic_to_xml(source, db_conn, batch_size=REPROJECTION_BATCH_SIZE, reprojector=None,
+        validator=None):
+    """
+    Converts a Geo-Trafic XML document into an lxml Element containing an
+    open511 document. source is either a string containing the XML, or a
+    binary file-like object, which is parsed as a stream.
+
+    Geometries are reprojected with PostGIS unless another reprojector is provided,
+    and each event is validated unless another validator is provided.
+    """
+    if isinstance(source, str):
+        source = io.BytesIO(source.encode('utf8'))
+    return _open511_document(convert_events(iter_geotrafic_events(source),
+        db_conn, reprojector, batch_size, validator))
+
+_XML_NAMESPACE = '{http://www.w3.org/XML/1998/namespace}'
+
+def write_xml_document(events, out):
+    """
+    Writes an open511 XML document containing an iterable of <event> Elements to
+    the binary file out, with lxml's incremental writer, writing each event as
+    soon as it's produced, so that it can be freed. The result is formatted like
+    etree.tostring(..., pretty_print=True) of the whole document, except that,
+    written on its own, each event also declares the gml namespace.
+    """
+    base = get_base_open511_element(lang='fr', version='v1')
+    # xmlfile doesn't recognize the xml namespace, but accepts its prefix
+    attrib = collections.OrderedDict((name.replace(_XML_NAMESPACE, 'xml:'), value)
+        for name, value in base.attrib.items())
+    events = iter(events)
+    with etree.xmlfile(out, encoding='utf-8') as xf:
+        with xf.element(base.tag, attrib, nsmap=base.nsmap):
+            xf.write('\n  ')
+            first = next(events, None)
+            if first is None:
+                xf.write(etree.Element('events'))
+            else:
+                with xf.element('events'):
+                    for ev in itertools.chain([first], events):
+                        xf.write('\n    ')
+                        etree.indent(ev, space='  ', level=2)
+                        ev.tail = None
+                        xf.write(ev)
+                    xf.write('\n  ')
+            xf.write('\n')
+    out.write(b'\n')
+
+def _open511_json_document(events):
+    return {'meta': {'version': 'v1'}, 'events': list(events)}
+
+def geotrafic_to_json(source, db_conn, batch_size=REPROJECTION_BATCH_SIZE, reprojector=None,
+        validator=None):
+    """
+    Like geotrafic_to_xml, but returns a dict containing an open511 JSON document,
+    the same one xml_to_json would make of geotrafic_to_xml's result.
+    """
+    if isinstance(source, str):
+        source = io.BytesIO(source.encode('utf8'))
+    return _open511_json_document(convert_events(iter_geotrafic_events(source),
+        db_conn, reprojector, batch_size, validator, format='json'))
+
+def write_json_document(events, out):
+    """
+    Writes an open511 JSON document containing an iterable of JSON events to
+    the text file out, one event at a time as they're produced. The result is
+    identical to json.dumps(document, indent=4).
+    """
+    out.write('{\n    "meta": ' + json.dumps({'version': 'v1'}, indent=4).replace('\n', '\n    ')
+        + ',\n    "events": [')
+    empty = True
+    for ev in events:
+        out.write(('\n' if empty else ',\n') + '        '
+            + json.dumps(ev, indent=4).replace('\n', '\n        '))
+        empty = False
+    out.write(']\n}' if empty else '\n    ]\n}')
+
+def _connect(postgres_dsn):
+    import psycopg2
+    db_conn = psycopg2.connect(postgres_dsn)
+    db_conn.autocommit = True # an error in one query shouldn't abort the following ones
+    return db_conn
+
+def _input_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(glob.glob(os.path.join(path, '*.xml'))):
+                yield filename
+        else:
+            yield path
+
+def _throughput_line(name, read, converted, seconds):
+    return "{}: {} evenements convertis, {} erreurs, {:.2f} s, {:.1f} evenements/s\n".format(
+        name, converted, read - converted, seconds, read / seconds if seconds else 0)
+
+class ConversionSession(object):
+    """
+    Everything needed to convert Geo-Trafic documents that can be kept from
+    one document to the next: a database connection or pool of worker
+    processes, and a reprojection cache. Used for a single run by main(),
+    and kept warm between requests by the conversion daemon.
+    """
+
+    def __init__(self, reprojection='postgis', postgres_dsn=None, cache_file=None, jobs=1,
+            validation='per-event', sample_rate=VALIDATION_SAMPLE_RATE,
+            batch_size=REPROJECTION_BATCH_SIZE, cache_size=None):
+        self.reprojection = reprojection
+        self.postgres_dsn = postgres_dsn
+        self.jobs = jobs
+        self.validation = (validation, sample_rate)
+        self.batch_size = batch_size
+        self.db_conn = self.pool = self.cache = None
+        if cache_file or cache_size:
+            # With jobs, it gets the geometries reprojected by the workers, and is what's saved
+            self.cache = ReprojectionCache(cache_size or REPROJECTION_CACHE_SIZE,
+                filename=cache_file)
+        if jobs > 1:
+            self.pool = multiprocessing.Pool(jobs, init_worker,
+                (reprojection, postgres_dsn, cache_file, validation, sample_rate, cache_size))
+        elif reprojection == 'postgis':
+            self.db_conn = _connect(postgres_dsn)
+
+    def convert_files(self, sources, log=sys.stderr, format='xml'):
+        """
+        Converts an iterable of (name, binary file-like object) Geo-Trafic
+        documents, writing throughput and validation stats to log.
+        Returns a list of the converted Open511 <event> Elements, or JSON dicts.
+        """
+        return list(self.iter_files(sources, log, format))
+
+    def iter_files(self, sources, log=sys.stderr, format='xml'):
+        """Like convert_files, but yields each event as soon as it's converted."""
+        validator = EventValidator(*self.validation)
+        if self.db_conn is not None and self.db_conn.closed:
+            self.db_conn = _connect(self.postgres_dsn)
+        if not self.pool:
+            # For the connection, which may just have been reopened
+            reprojector = get_reprojector(self.reprojection, self.db_conn, cache=self.cache)
+
+        total_read = total_converted = 0
+        total_start = time.time()
+        for name, f in sources:
+            start = time.time()
+            srcevents = iter_geotrafic_events(f)
+            read = [0]
+            def _count(srcevents):
+                for srcevent in srcevents:
+                    read[0] += 1
+                    yield srcevent
+            if self.pool:
+                events = convert_events_parallel(_count(srcevents), self.pool,
+                    self.batch_size, max_pending=2 * self.jobs, validator=validator, format=format,
+                    cache=self.cache)
+            else:
+                events = convert_events(_count(srcevents), self.db_conn, reprojector,
+                    self.batch_size, validator, format)
+            file_converted = 0
+            for ev in events:
+                file_converted += 1
+                yield ev
+            total_read += read[0]
+            total_converted += file_converted
+            log.write(_throughput_line(name, read[0], file_converted, time.time() - start))
+        log.write(_throughput_line('Total', total_read, total_converted, time.time() - total_start))
+        log.write("Validation: {}\n".format(validator.stats()))
+        if self.cache is not None:
+            log.write("Reprojection cache: {}\n".format(self.cache.stats()))
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        if self.cache is not None:
+            self.cache.save()
+        if self.db_conn is not None:
+            self.db_conn.close()
+
+def _file_sources(paths):
+    for filename in _input_files(paths):
+        with open(filename, 'rb') as f:
+            yield os.path.basename(filename), f
+
+def render_document(events, format='xml'):
+    """
+    Returns the text of an Open511 document containing the provided events:
+    <event> Elements, or JSON dicts if format is 'json'.
+    """
+    if format == 'json':
+        out = io.StringIO()
+        write_json_document(events, out)
+        return out.getvalue()
+    out = io.BytesIO()
+    write_xml_document(events, out)
+    return out.getvalue().decode('utf8')
+
+def add_session_arguments(parser):
+    """Adds the command-line options for a ConversionSession to an ArgumentParser."""
+    parser.add_argument('--postgres-dsn',
+        default=os.environ.get('POSTGRES_DSN', 'dbname=open511 user=postgres'))
+    parser.add_argument('--batch-size', type=int, default=REPROJECTION_BATCH_SIZE,
+        help="Nombre d'evenements dont les geometries sont reprojetees en une seule requete")
+    parser.add_argument('--reprojection', choices=REPROJECTION_METHODS, default='postgis',
+        help="Reprojeter les geometries avec PostGIS, ou localement sans BD")
+    parser.add_argument('--reprojection-cache', metavar='FICHIER',
+        help="Fichier SQLite ou garder les geometries deja reprojetees")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="Nombre de processus pour la conversion")
+    parser.add_argument('--validation', choices=VALIDATION_MODES, default='per-event',
+        help="Valider chaque evenement, chaque lot d'evenements, ou un echantillon")
+    parser.add_argument('--validation-sample-rate', type=float, default=VALIDATION_SAMPLE_RATE,
+        help="Fraction des evenements a valider en mode sampled")
+
+def session_from_arguments(args, **kwargs):
+    return ConversionSession(args.reprojection, args.postgres_dsn, args.reprojection_cache,
+        args.jobs, args.validation, args.validation_sample_rate, args.batch_size, **kwargs)
+
 def main():
     logging.basicConfig()
 
     parser = argparse.ArgumentParser(description="Convertir XML Geo-Trafic en format Open511")
-    parser.add_argument('fichier', metavar='FICHIER_XML',
-        type=str, help="Nom du fichier contenant l'XML Geo-Trafic")
+    parser.add_argument('fichiers', metavar='FICHIER_XML', nargs='+',
+        type=str, help="Fichiers contenant l'XML Geo-Trafic, ou repertoires de fichiers .xml")
     parser.add_argument('-f', '--format', choices=('xml', 'json'), default='xml',
         help='Format du resultat')
-    parser.add_argument('--postgres-dsn',
-        default=os.environ.get('POSTGRES_DSN', 'dbname=open511 user=postgres'))
+    add_session_arguments(parser)
+    parser.add_argument('--metrics', metavar='FICHIER',
+        help="Fichier ou ecrire les metriques (format Prometheus) de la conversion")
     args = parser.parse_args()
+    if args.metrics:
+        instrument()
 
-    import psycopg2
-    db_conn = psycopg2.connect(args.postgres_dsn)
-
-    with open(args.fichier, encoding='utf8') as f:
-        data = f.read()
-    result = geotrafic_to_xml(data, db_conn)
-    if args.format == 'json':
-        result = json.dumps(xml_to_json(result), indent=4)
-    else:
-        result = etree.tostring(result, encoding='unicode', pretty_print=True)
-    sys.stdout.write(result)
+    session = session_from_arguments(args)
+    try:
+        # Written out as each event is converted
+        events = session.iter_files(_file_sources(args.fichiers), format=args.format)
+        if args.format == 'json':
+            write_json_document(events, sys.stdout)
+        else:
+            write_xml_document(events, sys.stdout.buffer)
+    finally:
+        session.close()
+    if args.metrics:
+        metrics.write(args.metrics)
 
 if __name__ == '__main__':
     main()
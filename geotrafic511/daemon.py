@@ -0,0 +1,189 @@
+# coding: utf-8
+"""
+A long-running conversion daemon, which keeps a warm ConversionSession
+(imported modules, ITIS categories, compiled schemas, database connection
+or worker pool, reprojection cache) between documents, and a thin client that
+behaves like converter.py.
+
+    python geotrafic511/daemon.py --serve --reprojection local &
+    python geotrafic511/daemon.py -f json input.xml > open511_output.json
+
+The protocol is one JSON object per line, both ways. A request is
+{"documents": [{"name": ..., "data": base64 of the file}], "format": "xml" or "json"};
+the response is {"output": ..., "log": ...}, or {"error": ..., "log": ...}.
+The daemon listens on a Unix socket, or with --stdio reads requests from
+stdin and writes responses to stdout.
+
+Only the standard library is imported until the daemon starts, so that the
+client starts quickly.
+"""
+
+import argparse
+import base64
+import binascii
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+DEFAULT_SOCKET = os.environ.get('GEOTRAFIC511_SOCKET', '/tmp/geotrafic511-converter.sock')
+
+logger = logging.getLogger(__name__)
+
+
+def _converter():
+    try:
+        from . import converter
+    except ImportError:
+        # Run as a script
+        import converter
+    return converter
+
+def _handle(session, line):
+    # Returns the response to a request line
+    from lxml import etree
+    converter = _converter()
+
+    log = io.StringIO()
+    try:
+        request = json.loads(line.decode('utf8'))
+        sources = [(doc['name'], io.BytesIO(base64.b64decode(doc['data'])))
+            for doc in request['documents']]
+        format = request.get('format', 'xml')
+        output = converter.render_document(session.convert_files(sources, log, format), format)
+        return {'output': output, 'log': log.getvalue()}
+    except (ValueError, KeyError, TypeError, binascii.Error, etree.XMLSyntaxError) as e:
+        return {'error': 'Invalid request: {}'.format(e), 'log': log.getvalue()}
+    except Exception as e:
+        logger.exception("Error converting documents")
+        return {'error': '{}: {}'.format(type(e).__name__, e), 'log': log.getvalue()}
+
+def _respond(session, line):
+    return (json.dumps(_handle(session, line)) + '\n').encode('utf8')
+
+def serve(session, socket_path=None, stdio=False):
+    """
+    Answers requests with session until interrupted: from stdin if stdio
+    is True, otherwise from clients connecting to a Unix socket at socket_path.
+    Requests are handled one at a time, since the session isn't thread-safe.
+    """
+    if stdio:
+        for line in sys.stdin.buffer:
+            if line.strip():
+                sys.stdout.buffer.write(_respond(session, line))
+                sys.stdout.buffer.flush()
+        return
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(8)
+    sys.stderr.write("En attente de requetes sur {}\n".format(socket_path))
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile('rb') as requests:
+                for line in requests:
+                    if line.strip():
+                        conn.sendall(_respond(session, line))
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+def request(documents, format='xml', socket_path=DEFAULT_SOCKET):
+    """
+    Sends a list of (name, XML bytes) documents to the daemon listening at
+    socket_path. Returns its response as a dict.
+    """
+    message = json.dumps({
+        'documents': [{'name': name, 'data': base64.b64encode(data).decode('ascii')}
+            for name, data in documents],
+        'format': format,
+    }) + '\n'
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(message.encode('utf8'))
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf8'))
+    finally:
+        client.close()
+
+def _input_files(paths):
+    # As in converter._input_files, which can't be imported without lxml
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith('.xml'):
+                    yield os.path.join(path, filename)
+        else:
+            yield path
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convertir XML Geo-Trafic en format Open511, avec un convertisseur "
+            "qui reste en memoire entre les conversions")
+    parser.add_argument('fichiers', metavar='FICHIER_XML', nargs='*',
+        help="Fichiers contenant l'XML Geo-Trafic, ou repertoires de fichiers .xml")
+    parser.add_argument('-f', '--format', choices=('xml', 'json'), default='xml',
+        help='Format du resultat')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+        help="Socket Unix du convertisseur")
+    parser.add_argument('--serve', action='store_true',
+        help="Demarrer le convertisseur, plutot que de lui envoyer des fichiers")
+    parser.add_argument('--stdio', action='store_true',
+        help="Avec --serve, lire les requetes sur stdin plutot que sur le socket")
+    parser.add_argument('--timing', action='store_true',
+        help="Afficher la duree de la requete sur stderr")
+    if '--serve' in sys.argv[1:]:
+        # The client doesn't need the converter's options, nor to wait for it to be imported
+        converter = _converter()
+        converter.add_session_arguments(
+            parser.add_argument_group("Options du convertisseur (avec --serve)"))
+    args = parser.parse_args()
+
+    if args.serve:
+        logging.basicConfig()
+        # So that the socket is cleaned up
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # Warm everything up before accepting requests
+        converter._load_categories()
+        session = converter.session_from_arguments(args,
+            cache_size=converter.REPROJECTION_CACHE_SIZE)
+        try:
+            serve(session, args.socket, args.stdio)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            session.close()
+        return
+
+    if not args.fichiers:
+        parser.error("Aucun fichier a convertir")
+    start = time.time()
+    documents = []
+    for filename in _input_files(args.fichiers):
+        with open(filename, 'rb') as f:
+            documents.append((os.path.basename(filename), f.read()))
+    try:
+        response = request(documents, args.format, args.socket)
+    except socket.error as e:
+        sys.stderr.write("Le convertisseur n'est pas disponible sur {} ({}); "
+            "demarrez-le avec --serve\n".format(args.socket, e))
+        sys.exit(2)
+    sys.stderr.write(response.get('log', ''))
+    if args.timing:
+        sys.stderr.write("Requete: {:.3f} s\n".format(time.time() - start))
+    if 'error' in response:
+        sys.stderr.write(response['error'] + '\n')
+        sys.exit(1)
+    sys.stdout.write(response['output'])
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,7 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'geotrafic511.response_cache.EventsCacheMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -225,6 +226,11 @@ OPEN511_IMPORTER_LOGGING = {
             'level': 'INFO',
             'handlers': ['logfile', 'mail_admins'],
             'propagate': False
+        },
+        'geotrafic511.scheduler': {
+            'level': 'INFO',
+            'handlers': ['logfile', 'mail_admins'],
+            'propagate': False
         }
     },
     'root': {
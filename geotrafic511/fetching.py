@@ -0,0 +1,91 @@
+"""
+HTTP fetching for the Geo-Trafic feed: a persistent session, compressed and
+conditional requests, and retries with exponential backoff.
+"""
+
+import random
+import time
+
+import requests
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+
+class FeedFetcher(object):
+    """
+    Fetches feed URLs over a persistent, keep-alive requests Session.
+
+    If the same URL is fetched twice in a row (i.e. nothing changed since
+    the last poll, so the updated-since timestamp is the same), the request is
+    made conditional on the ETag and Last-Modified headers of the previous
+    response, provided that response was marked as processed with mark_processed().
+    """
+
+    def __init__(self, timeout=30, retries=2, backoff=1.0, max_backoff=30.0, session=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # requests already asks for gzip or deflate compressed responses
+        self.session = session or requests.Session()
+        self.last_url = self.etag = self.last_modified = None
+
+    def _conditional_headers(self, url):
+        headers = {}
+        if url == self.last_url:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def backoff_delay(self, attempt):
+        """Seconds to wait before retry number attempt (from 0): exponential, with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, stream=False):
+        """
+        Returns a Response, or None if the server says nothing has changed
+        since the last processed response for this URL (HTTP 304).
+        """
+        headers = self._conditional_headers(url)
+        attempt = 0
+        while True:
+            start = time.time()
+            resp = None
+            try:
+                resp = self.session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+                if resp.status_code == 304:
+                    resp.close()
+                    return None
+                resp.raise_for_status()
+            except (ConnectionError, HTTPError, Timeout):
+                if resp is not None:
+                    # Streamed responses otherwise keep their pooled connection
+                    resp.close()
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+                continue
+            resp.fetch_url = url
+            resp.fetch_started = start
+            return resp
+
+    def mark_processed(self, resp):
+        """
+        Records that resp was successfully processed, so that the next
+        request for the same URL can be conditional on it.
+        """
+        self.last_url = resp.fetch_url
+        self.etag = resp.headers.get('ETag')
+        self.last_modified = resp.headers.get('Last-Modified')
+
+    @staticmethod
+    def stats(resp):
+        """
+        Describes a response whose body has been read: status, latency (time to
+        the response headers), total time, and bytes transferred over the wire.
+        """
+        return "HTTP {}, {:.2f} s latency, {:.2f} s total, {} bytes".format(
+            resp.status_code, resp.elapsed.total_seconds(),
+            time.time() - resp.fetch_started, resp.raw.tell())
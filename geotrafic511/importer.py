@@ -1,62 +1,419 @@
+import datetime
 import logging
-from time import sleep
+import time
+import urllib.parse
 
 from django import db
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.conf import settings
 
-import dateutil.parser
 from lxml import etree
-import requests
-from requests.exceptions import ConnectionError, HTTPError, Timeout
+from psycopg2.extras import DateTimeTZRange
+import pytz
 
 from open511_server.importer import BaseImporter
-from . import converter
+from open511_server.models import RoadEvent
+from . import change_feed, converter, metrics, persistence, response_cache, snapshots
+from .incremental import (BackfillSpool, Watermark, backfill_spool_path, changed_events,
+    finish_backfill_part, parse_aware_timestamp, start_backfill, url_timestamp)
+from .fetching import FeedFetcher
+from .models import EventInterval, EventSourceHash
 
 logger = logging.getLogger(__name__)
 
+# How long before the end of the materialized in-effect intervals they're rebuilt
+INTERVALS_REFRESH = datetime.timedelta(days=1)
+
 class GeoTraficImporter(BaseImporter):
 
     default_language = 'fr'
 
+    reprojector = None
+    validator = None
+
+    # Shared by all instances, so that they last as long as the importer process
+    reprojection_cache = None
+    fetcher = None
+
+    def __init__(self, *args, **kwargs):
+        super(GeoTraficImporter, self).__init__(*args, **kwargs)
+        # Source Event to the Open511 <event> fetch() converted it to (None if it failed),
+        # until convert() passes it on to BaseImporter
+        self.converted = {}
+        # Open511 ID to (event-sid, <event>) of the events passed on, until BaseImporter saves them
+        self.unsaved = {}
+
+    def run(self):
+        # The bookkeeping of each event saved by BaseImporter is done once it's saved
+        post_save.connect(self._event_saved, sender=RoadEvent)
+        try:
+            # The events saved by BaseImporter don't each increment the generation:
+            # fetch() does it once they're all saved
+            with response_cache.deferred_bumps():
+                return super(GeoTraficImporter, self).run()
+        finally:
+            post_save.disconnect(self._event_saved, sender=RoadEvent)
+
     def fetch(self):
         url = self.opts['URL']
-        if self.status.get('max_updated'):
-            updated_timestamp = dateutil.parser.parse(self.status['max_updated'])
-            # The Geo-Trafic API has a very particular timestamp format
-            url_timestamp = (updated_timestamp.replace(tzinfo=None, microsecond=0).isoformat()
-                .replace('T', '%20').replace(':', '%3A'))
-            url += url_timestamp
-        else:
-            url += '2000-01-01'
-        print('Fetching URL: {}'.format(url))
-        resp = self._get_url(url)
+        start_time = time.time()
+        # Read by the scheduler, also after a 304
+        self.saved_count = 0
+        metrics_file = self.opts.get('METRICS_FILE',
+            getattr(settings, 'GEOTRAFIC511_METRICS_FILE', None))
+        if metrics_file:
+            converter.instrument()
+        self._intervals_horizon()
+        # With BACKFILL, a full import is downloaded once, then imported a part at a time
+        spool = None
+        if self.status.get('backfill'):
+            spool = BackfillSpool(self.status['backfill']['spool'])
+            if not spool.exists():
+                logger.warning("Backfill spool %s is missing; starting over", spool.filename)
+                del self.status['backfill']
+                spool = None
+        # On a full import, e.g. after ImportTaskStatus has been deleted, convert everything
+        full_import = not self.status.get('max_updated')
+        fetcher = resp = self.recording = None
+        if spool is None:
+            backfilling = full_import and bool(self.opts.get('BACKFILL'))
+            if self.status.get('max_updated'):
+                updated_since = url_timestamp(parse_aware_timestamp(self.status['max_updated']))
+            else:
+                updated_since = '2000-01-01'
+            url += updated_since
+            print('Fetching URL: {}'.format(url))
+            fetcher = self._get_fetcher()
+            resp = fetcher.get(url, stream=bool(self.opts.get('STREAMING')) or backfilling)
+            # With RECORD_DIR, responses are saved for load tests (see loadtest.py)
+            if resp is not None and self.opts.get('RECORD_DIR'):
+                # Only needed for recording
+                from . import loadtest
+                self.recording = loadtest.Recorder(self.opts['RECORD_DIR']).start(url,
+                    urllib.parse.unquote(updated_since))
+            if resp is None:
+                print('Not modified since last poll')
+                if self.rebuild_intervals:
+                    self._rebuild_intervals()
+                if metrics_file:
+                    self._write_metrics(metrics_file, start_time)
+                return
+            if self.opts.get('STREAMING') or backfilling:
+                events = self._stream_events(resp, watermark=not backfilling)
+            else:
+                events = self._parse_events(resp)
+            if backfilling:
+                spool = BackfillSpool(backfill_spool_path(self.opts))
+                count, max_updated = spool.write(events)
+                start_backfill(self.status, spool, count, max_updated)
+                print('Backfill: {} events downloaded to {}'.format(count, spool.filename))
+        if spool is not None:
+            part_start = time.time()
+            events = spool.read(self.status['backfill']['done'],
+                self.opts.get('BACKFILL_TARGET_EVENTS', 2000))
+            part_count = len(events)
+            full_import = True
+
+        batch_size = self.opts.get('REPROJECTION_BATCH_SIZE', converter.REPROJECTION_BATCH_SIZE)
+        if self.opts.get('SKIP_UNCHANGED', True):
+            events = self._skip_unchanged(events, batch_size, full_import)
 
+        # Events are converted a batch at a time, so that their link-geometries
+        # can be reprojected, and the results validated, in a single operation
+        cache = self._get_reprojection_cache()
+        self.reprojector = converter.get_reprojector(self.opts.get('REPROJECTION', 'postgis'),
+            db.connection, cache=cache)
+        self.validator = converter.EventValidator(self.opts.get('VALIDATION', 'per-event'),
+            self.opts.get('VALIDATION_SAMPLE_RATE', converter.VALIDATION_SAMPLE_RATE))
+        self.converted = {}
+        self.unsaved = {}
+        # (Open511 ID, change type) of the events saved, for the change feed
+        self.changes = [] if change_feed.enabled() else None
+        # With BULK_SAVE, events are saved here a batch at a time, and none are yielded
+        writer = None
+        if self.opts.get('BULK_SAVE'):
+            writer = persistence.BulkEventWriter(self.default_language)
+        for converted_batch in self._converted_batches(events, batch_size, cache):
+            if writer is not None:
+                self.saved_count += self._bulk_save(writer, converted_batch)
+                continue
+            for ev, converted in converted_batch:
+                self.converted[ev] = converted
+                if converted is not None:
+                    self.unsaved[converted.findtext('id')] = (ev.findtext('event-sid'), converted)
+                yield ev
+
+        if resp is not None:
+            fetcher.mark_processed(resp)
+            print('Fetched: {}'.format(fetcher.stats(resp)))
+        if spool is not None:
+            print(finish_backfill_part(self.status, part_count, time.time() - part_start))
+        print('Validation: {}'.format(self.validator.stats()))
+        if cache is not None:
+            cache.save()
+            print('Reprojection cache: {}'.format(cache.stats()))
+        if writer is not None:
+            print('Bulk save: {}'.format(writer.stats()))
+        if self.unsaved:
+            # Their source hashes weren't stored, so they'll be converted again next time
+            logger.warning("%d converted events weren't saved", len(self.unsaved))
+        if self.rebuild_intervals:
+            self._rebuild_intervals()
+        if self.opts.get('SKIP_UNCHANGED', True):
+            print('Change detection: {} changed events, {} unchanged events skipped'.format(
+                self.changed_count, self.unchanged_count))
+        if self.changes:
+            # Before the generation is incremented, which wakes up waiting clients
+            transaction.on_commit(lambda: change_feed.append(self.changes))
+        generation_file = getattr(settings, 'GEOTRAFIC511_GENERATION_FILE', None)
+        if generation_file and self.saved_count:
+            # Only once the events are visible to the web server, i.e. immediately
+            # unless BaseImporter saves them in a transaction
+            transaction.on_commit(lambda: response_cache.bump_generation(generation_file))
+        snapshot_dir = getattr(settings, 'GEOTRAFIC511_SNAPSHOT_DIR', None)
+        if snapshot_dir and (self.saved_count or not snapshots.exist(snapshot_dir)):
+            transaction.on_commit(lambda: self._write_snapshots(snapshot_dir))
+        if metrics_file:
+            self._write_metrics(metrics_file, start_time)
+
+    def _converted_batches(self, events, batch_size, cache):
+        """
+        Yields the results of convert_batch() for each batch of events.
+
+        With the PIPELINE option, events are fetched, parsed and filtered in one
+        thread, and batches converted in PIPELINE_WORKERS others, each with its
+        own database connection, reprojector and validator, while the previous
+        batches are being saved. At most PIPELINE_DEPTH batches are in flight.
+        """
+        batches = converter.batches(events, batch_size)
+        if not self.opts.get('PIPELINE'):
+            for batch in batches:
+                yield converter.convert_batch(batch, db.connection, self.reprojector,
+                    self.validator)
+            return
+
+        def fetch_batches():
+            try:
+                for batch in batches:
+                    yield batch
+            finally:
+                # Opened in this thread by _skip_unchanged
+                db.connection.close()
+
+        validators = []
+        def setup():
+            validator = converter.EventValidator(self.validator.mode, self.validator.sample_rate)
+            validators.append(validator)
+            # db.connection is a different connection in each thread
+            return converter.get_reprojector(self.opts.get('REPROJECTION', 'postgis'),
+                db.connection, cache=cache), validator
+
+        def convert(state, batch):
+            reprojector, validator = state
+            return converter.convert_batch(batch, db.connection, reprojector, validator)
+
+        workers = self.opts.get('PIPELINE_WORKERS', 4)
+        try:
+            for converted_batch in converter.threaded_map(convert, fetch_batches(), workers,
+                    self.opts.get('PIPELINE_DEPTH', 2 * workers), setup,
+                    lambda state: db.connection.close()):
+                yield converted_batch
+        finally:
+            for validator in validators:
+                self.validator.validated += validator.validated
+                self.validator.seconds += validator.seconds
+
+    def _parse_events(self, resp):
+        if self.recording is not None:
+            self.recording.write(resp.content)
+            self.recording.finish()
         xml_string = resp.content.decode('utf8').replace('<Events xmlns="GeoTrafic">', '<Events>')
         root = etree.fromstring(xml_string)
 
-        try:
-            self.status['max_updated'] = max(root.xpath('Event/last-update-time/text()'))
-        except ValueError:
-            # Empty list of events, presumably
-            pass
+        watermark = Watermark()
+        for updated in root.xpath('Event/last-update-time/text()'):
+            watermark.update(updated)
+        if watermark.value:
+            self.status['max_updated'] = watermark.value
 
-        for ev in root.xpath('Event'):
-            yield ev
+        return root.xpath('Event')
 
-    def _get_url(self, url, retries=2):
+    def _stream_events(self, resp, watermark=True):
+        """
+        Parses events from the response as it's downloaded, rather than
+        holding the whole document in memory, updating max_updated as we go
+        (unless watermark is false).
+        """
+        resp.raw.decode_content = True
+        source = resp.raw
+        if self.recording is not None:
+            from . import loadtest
+            source = loadtest.TeeReader(resp.raw, self.recording)
+        max_updated = Watermark()
         try:
-            resp = requests.get(url)
-            resp.raise_for_status()
-            return resp
-        except (ConnectionError, HTTPError, Timeout):
-            if not retries:
-                raise
-            sleep(2)
-            return self._get_url(url, retries=retries - 1)
+            for ev in converter.iter_geotrafic_events(source):
+                updated = ev.findtext('last-update-time') if watermark else None
+                if updated:
+                    max_updated.update(updated)
+                    self.status['max_updated'] = max_updated.value
+                yield ev
+            if self.recording is not None:
+                self.recording.finish()
+        finally:
+            if self.recording is not None:
+                # If the response wasn't read to the end
+                self.recording.discard()
+            resp.close()
+
+    def _skip_unchanged(self, events, batch_size, full_import):
+        """
+        Filters out events whose source_hash matches the one stored when they
+        were last imported. Hashes of the other events are kept in
+        self.source_hashes, to be stored once they've been converted.
+        """
+        self.source_hashes = {}
+        self.changed_count = self.unchanged_count = 0
+        for batch in converter.batches(events, batch_size):
+            stored = {}
+            if not full_import:
+                stored = dict(EventSourceHash.objects.filter(
+                    event_sid__in=[ev.findtext('event-sid') for ev in batch])
+                    .values_list('event_sid', 'content_hash'))
+            changed, unchanged = changed_events(batch, stored, full_import)
+            self.unchanged_count += unchanged
+            self.changed_count += len(changed)
+            for ev, content_hash in changed:
+                self.source_hashes[ev.findtext('event-sid')] = content_hash
+                yield ev
+
+    def _bulk_save(self, writer, converted_batch):
+        # As BaseImporter and _event_saved() do for each event, but for a whole batch
+        xml_events, hashes = [], {}
+        for ev, converted in converted_batch:
+            if converted is None:
+                continue
+            xml_events.append(converted)
+            sid = ev.findtext('event-sid')
+            content_hash = getattr(self, 'source_hashes', {}).pop(sid, None)
+            if content_hash:
+                hashes[sid] = content_hash
+        writer.write(xml_events, hashes)
+        if self.changes is not None:
+            self.changes.extend((xml_event.findtext('id'), change_feed.change_type(xml_event,
+                xml_event.findtext('id') in writer.created_ids)) for xml_event in xml_events)
+        if self.intervals_until:
+            self._index_intervals(xml_events)
+        return len(xml_events)
+
+    def _intervals_horizon(self):
+        """
+        With the IN_EFFECT_HORIZON_DAYS option, the periods during which each
+        active event is in effect are expanded from its schedule into
+        EventInterval, up to self.intervals_until: a day before that is reached,
+        the whole table is rebuilt up to IN_EFFECT_HORIZON_DAYS from now.
+        """
+        self.intervals_until = None
+        self.rebuild_intervals = False
+        days = self.opts.get('IN_EFFECT_HORIZON_DAYS')
+        if not days:
+            return
+        now = datetime.datetime.now(pytz.utc)
+        until = self.status.get('intervals_until')
+        if until and parse_aware_timestamp(until) - INTERVALS_REFRESH > now:
+            self.intervals_until = parse_aware_timestamp(until)
+        else:
+            self.intervals_until = now + datetime.timedelta(days=days)
+            self.rebuild_intervals = True
+
+    def _expand_intervals(self, xml_events, now):
+        for xml_ev in xml_events:
+            if xml_ev.findtext('status') != 'ACTIVE' or xml_ev.find('schedule') is None:
+                continue
+            for start, end in converter.schedule_intervals(xml_ev.find('schedule'), now,
+                    self.intervals_until):
+                yield EventInterval(event_id=xml_ev.findtext('id'),
+                    period=DateTimeTZRange(start, end, '[]'))
+
+    def _index_intervals(self, xml_events):
+        # Replaces the intervals of events that have just been saved
+        intervals = list(self._expand_intervals(xml_events, datetime.datetime.now(pytz.utc)))
+        with transaction.atomic():
+            EventInterval.objects.filter(
+                event_id__in=[xml_ev.findtext('id') for xml_ev in xml_events]).delete()
+            EventInterval.objects.bulk_create(intervals)
+
+    def _rebuild_intervals(self):
+        start = time.time()
+        count = 0
+        now = datetime.datetime.now(pytz.utc)
+        with transaction.atomic():
+            EventInterval.objects.all().delete()
+            for batch in converter.batches(self._expand_intervals(
+                    snapshots.load_active_events(), now), 1000):
+                EventInterval.objects.bulk_create(batch)
+                count += len(batch)
+        self.status['intervals_until'] = self.intervals_until.isoformat()
+        self.rebuild_intervals = False
+        print('In-effect intervals: {} intervals until {}, {:.2f} s'.format(
+            count, self.intervals_until, time.time() - start))
+
+    def _write_snapshots(self, directory):
+        start = time.time()
+        events = list(snapshots.load_active_events())
+        sizes = snapshots.write_snapshots(directory, events)
+        print('Snapshots: {} active events, {}, {:.2f} s'.format(len(events),
+            ', '.join('{} {} bytes'.format(name, size) for name, size in sorted(sizes.items())),
+            time.time() - start))
+
+    def _write_metrics(self, filename, start_time):
+        # Called once all events have been saved, at the end of the cycle
+        now = time.time()
+        metrics.CYCLE_SECONDS.observe(now - start_time)
+        metrics.LAST_CYCLE.set(now)
+        if self.status.get('max_updated'):
+            max_updated = parse_aware_timestamp(self.status['max_updated'])
+            metrics.FEED_LAG.set(now - max_updated.timestamp())
+        metrics.write(filename)
+
+    def _get_reprojection_cache(self):
+        max_size = self.opts.get('REPROJECTION_CACHE_SIZE', converter.REPROJECTION_CACHE_SIZE)
+        if not max_size:
+            return None
+        cls = type(self)
+        if cls.reprojection_cache is None:
+            cls.reprojection_cache = converter.ReprojectionCache(max_size,
+                filename=self.opts.get('REPROJECTION_CACHE_FILE'))
+        return cls.reprojection_cache
+
+    def _get_fetcher(self):
+        cls = type(self)
+        if cls.fetcher is None:
+            cls.fetcher = FeedFetcher(timeout=self.opts.get('TIMEOUT', 60),
+                retries=self.opts.get('RETRIES', 2))
+        return cls.fetcher
 
     def convert(self, input_document):
-        try:
-            yield converter.convert_event(input_document, db.connection)
-        except Exception as e:
-            logger.exception("{} importing event-sid {}".format(e.__class__.__name__,
-                input_document.findtext('event-sid')))
+        # Converted by fetch(); None if conversion failed, which has been logged
+        converted = self.converted.pop(input_document, None)
+        if converted is not None:
+            yield converted
+
+    def _event_saved(self, sender, instance, created, **kwargs):
+        # RoadEvent's post_save during run(): as _bulk_save() does for a batch, once
+        # BaseImporter has saved an event passed on by convert()
+        unsaved = self.unsaved.pop('{}/{}'.format(instance.jurisdiction.id, instance.id), None)
+        if unsaved is None:
+            return
+        sid, converted = unsaved
+        self.saved_count += 1
+        content_hash = getattr(self, 'source_hashes', {}).pop(sid, None)
+        if content_hash:
+            EventSourceHash.objects.update_or_create(event_sid=sid,
+                defaults={'content_hash': content_hash})
+        if self.intervals_until:
+            self._index_intervals([converted])
+        if self.changes is not None:
+            self.changes.append((converted.findtext('id'),
+                change_feed.change_type(converted, created)))
 
@@ -0,0 +1,181 @@
+"""
+The parts of GeoTraficImporter's incremental imports that don't need the
+database, so that they can be tested on their own: the updated-since
+watermark, detecting events that Geo-Trafic re-sent unchanged, and
+spreading a full import over several cycles. Both work on the task's ImportTaskStatus and options dicts.
+"""
+
+import contextlib
+import datetime
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+
+from lxml import etree
+import pytz
+
+try:
+    from . import converter
+except ImportError:
+    # Run as a script, e.g. by tests.py
+    import converter
+
+def parse_aware_timestamp(s):
+    """Parses a Geo-Trafic timestamp, assuming Montreal time if there's no UTC offset."""
+    timestamp = converter.parse_timestamp(s)
+    if not timestamp.tzinfo:
+        timestamp = converter.TIMEZONE.localize(timestamp)
+    return timestamp
+
+def url_timestamp(timestamp):
+    """
+    Formats an aware datetime for the Geo-Trafic API's updated-since URL,
+    which expects a Montreal wall-clock time without a UTC offset.
+    """
+    local = timestamp.astimezone(converter.TIMEZONE).replace(tzinfo=None, microsecond=0)
+    try:
+        converter.TIMEZONE.localize(local, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        # In the hour repeated when DST ends, ask for an hour more rather than risk missing events
+        local -= datetime.timedelta(hours=1)
+    # The Geo-Trafic API has a very particular timestamp format
+    return local.isoformat().replace('T', '%20').replace(':', '%3A')
+
+class Watermark(object):
+    """
+    The latest of the last-update-times seen, which becomes max_updated.
+    They're compared as datetimes, since offsets vary between -04:00 and
+    -05:00, so that the latest string isn't always the latest time.
+    """
+
+    def __init__(self):
+        self.value = self.timestamp = None
+
+    def update(self, s):
+        """Takes a last-update-time into account, and returns it parsed."""
+        timestamp = parse_aware_timestamp(s)
+        if self.timestamp is None or timestamp > self.timestamp:
+            self.value, self.timestamp = s, timestamp
+        return timestamp
+
+# Source fields that change when Geo-Trafic re-sends an event,
+# without the event itself having changed
+VOLATILE_SOURCE_FIELDS = frozenset(['last-update-time', 'event-update-count'])
+
+def source_hash(src):
+    """
+    Returns a hash of a Geo-Trafic Event element, ignoring whitespace, attribute order
+    and VOLATILE_SOURCE_FIELDS.
+    """
+    h = hashlib.sha1()
+    for el in src.iter(tag=etree.Element):
+        if el.tag in VOLATILE_SOURCE_FIELDS:
+            continue
+        h.update('<{} {}>{}'.format(el.tag, sorted(el.attrib.items()),
+            (el.text or '').strip()).encode('utf8'))
+    return h.hexdigest()
+
+def changed_events(batch, stored_hashes, full_import=False):
+    """
+    Returns the Events of batch whose source_hash() isn't the one in
+    stored_hashes, a dict of event-sid to the hash stored when the event was
+    last imported, as a list of (Event, hash), and the number of the others.
+    On a full import, every event is considered changed.
+    """
+    changed = []
+    unchanged = 0
+    for ev in batch:
+        content_hash = source_hash(ev)
+        if not full_import and stored_hashes.get(ev.findtext('event-sid')) == content_hash:
+            unchanged += 1
+        else:
+            changed.append((ev, content_hash))
+    return changed, unchanged
+
+def backfill_spool_path(opts):
+    """Where a task's BACKFILL spool is kept: in BACKFILL_SPOOL_DIR, or the temporary directory."""
+    name = hashlib.sha1(opts['URL'].encode('utf8')).hexdigest()[:16]
+    return os.path.join(opts.get('BACKFILL_SPOOL_DIR') or tempfile.gettempdir(),
+        'geotrafic511-backfill-{}.sqlite'.format(name))
+
+class BackfillSpool(object):
+    """
+    With the BACKFILL option, a full import is downloaded once, into this
+    SQLite file, and then imported BACKFILL_TARGET_EVENTS events at a time,
+    oldest first, over several cycles, so that each cycle is bounded and a
+    failure only loses the current part. The Geo-Trafic API only filters on
+    a start time, so fetching each part separately would download everything
+    after it every time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def write(self, events):
+        """
+        Stores an iterable of Geo-Trafic Event elements, replacing any previous
+        ones. Returns their number and their latest last-update-time.
+        """
+        count = 0
+        watermark = Watermark()
+        with contextlib.closing(sqlite3.connect(self.filename)) as conn, conn:
+            conn.execute("DROP TABLE IF EXISTS events")
+            conn.execute("CREATE TABLE events (updated REAL, event BLOB)")
+            for batch in converter.batches(events, 1000):
+                rows = []
+                for ev in batch:
+                    updated = ev.findtext('last-update-time')
+                    timestamp = watermark.update(updated).timestamp() if updated else 0
+                    rows.append((timestamp, etree.tostring(ev)))
+                conn.executemany("INSERT INTO events VALUES (?, ?)", rows)
+                count += len(rows)
+            conn.execute("CREATE INDEX events_updated ON events (updated)")
+        return count, watermark.value
+
+    def read(self, start, count):
+        """Returns up to count Event elements, from position start in last-update-time order."""
+        with contextlib.closing(sqlite3.connect(self.filename)) as conn:
+            rows = conn.execute("SELECT event FROM events ORDER BY updated, rowid LIMIT ? OFFSET ?",
+                (count, start)).fetchall()
+        return [etree.fromstring(row[0]) for row in rows]
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+def start_backfill(status, spool, count, max_updated):
+    """
+    Records in status a backfill of the count events just written to spool.
+    max_updated isn't set until they've all been imported, so that a
+    failure before then carries on from the spool.
+    """
+    status.pop('max_updated', None)
+    status['backfill'] = {'spool': spool.filename, 'done': 0, 'total': count,
+        'max_updated': max_updated}
+
+def finish_backfill_part(status, count, seconds):
+    """
+    Records that the next count events of the backfill have been imported,
+    in seconds. Once they all have, max_updated is set to the latest of them
+    and the spool is removed, so that the next cycle fetches the events
+    updated since. Returns a progress message.
+    """
+    backfill = status['backfill']
+    backfill['done'] += count
+    remaining = backfill['total'] - backfill['done']
+    if count and remaining > 0:
+        return 'Backfill: {} of {} events imported, ETA {:.0f} s over {} cycles'.format(
+            backfill['done'], backfill['total'], remaining * seconds / count,
+            int(math.ceil(remaining / float(count))))
+    del status['backfill']
+    if backfill['max_updated']:
+        status['max_updated'] = backfill['max_updated']
+    BackfillSpool(backfill['spool']).remove()
+    return 'Backfill complete: {} events imported'.format(backfill['done'])
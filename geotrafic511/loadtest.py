@@ -0,0 +1,454 @@
+# coding: utf-8
+"""
+Load tests of GeoTraficImporter without the city's API.
+
+With the RECORD_DIR option of an import task, the importer saves each
+response of the Geo-Trafic API to that directory, with the updated-since
+value it was requested with (see Recorder). A local stand-in for the API
+then replays those responses, or serves a synthetic feed of any size, and a
+driver runs full import cycles against it:
+
+    python -m geotrafic511.loadtest serve --replay /home/open511/recordings --port 8511
+    python -m geotrafic511.loadtest serve --events 20000 --updates 200 --latency 0.5
+    python -m geotrafic511.loadtest run --cycles 10 --events 20000 --output results.json
+
+The stand-in answers GET <any path>/<updated-since>, the URL the importer
+requests, with the events last updated at or after that time. Each request
+moves it forward: with --replay, the next recording is applied (and served
+as recorded, if it was requested with the same updated-since); with
+--updates, that many random events are changed, as if just updated in
+Geo-Trafic. Its counters are served as JSON at /_stats.
+
+The driver starts the stand-in in a subprocess, runs the import task
+(--task, in OPEN511_IMPORT_TASKS) against it with the settings of
+DJANGO_SETTINGS_MODULE, and reports for each cycle its time, the events
+served and saved per second, the rows written to the database (from
+pg_stat_user_tables) and the peak RSS of the importer. It writes to the
+configured database: use a copy.
+"""
+
+import argparse
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from lxml import etree
+
+try:
+    from . import benchmarks, converter
+except ImportError:
+    # Run as a script
+    import benchmarks
+    import converter
+
+INDEX = 'index.jsonl'
+
+DOCUMENT_START = ("<?xml version='1.0' encoding='utf-8'?>\n<Events xmlns=\"{}\">".format(
+    converter.SOURCE_NAMESPACE)).encode('utf8')
+DOCUMENT_END = b'</Events>'
+
+# Seconds for the statistics of the importer's database connections to be reported
+STATS_DELAY = 0.5
+
+STATS_PATH = '/_stats'
+
+
+class Recorder(object):
+    """
+    Saves responses of the Geo-Trafic API to directory, decompressed, each in
+    its own file, listed in index.jsonl with the URL and updated-since value
+    they were requested with. Only complete responses are kept.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, url, updated_since):
+        """Returns a Recording, to which the body of the response is written as it's read."""
+        return Recording(self, url, updated_since)
+
+    def record(self, url, updated_since, body):
+        recording = self.start(url, updated_since)
+        recording.write(body)
+        recording.finish()
+
+    def _add(self, entry):
+        with open(os.path.join(self.directory, INDEX), 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+class Recording(object):
+
+    def __init__(self, recorder, url, updated_since):
+        self.recorder = recorder
+        self.url = url
+        self.updated_since = updated_since
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.size = 0
+        fd, self.tmp = tempfile.mkstemp(dir=recorder.directory, prefix='.recording-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        """Keeps the recording, once the whole response has been read."""
+        self.file.close()
+        filename = '{:%Y%m%dT%H%M%S%f}.xml'.format(self.started)
+        os.replace(self.tmp, os.path.join(self.recorder.directory, filename))
+        self.tmp = None
+        self.recorder._add({
+            'file': filename,
+            'url': self.url,
+            'updated_since': self.updated_since,
+            'recorded': self.started.isoformat(),
+            'bytes': self.size,
+        })
+
+    def discard(self):
+        if self.tmp is not None:
+            self.file.close()
+            os.unlink(self.tmp)
+            self.tmp = None
+
+class TeeReader(object):
+    """A binary file-like object that writes what's read from source to a Recording."""
+
+    def __init__(self, source, recording):
+        self.source = source
+        self.recording = recording
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.recording.write(data)
+        return data
+
+def load_recordings(directory):
+    """The entries of a Recorder's index, in the order they were recorded, with their 'path'."""
+    recordings = []
+    with open(os.path.join(directory, INDEX)) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry['path'] = os.path.join(directory, entry['file'])
+                recordings.append(entry)
+    return recordings
+
+
+def _aware(timestamp):
+    return timestamp if timestamp.tzinfo else converter.TIMEZONE.localize(timestamp)
+
+def parse_updated_since(value):
+    """
+    Parses the updated-since suffix of a request path, e.g. 2000-01-01 or
+    2015-11-16%2013%3A56%3A59, in Montreal time. Raises ValueError.
+    """
+    return _aware(converter.parse_timestamp(urllib.parse.unquote(value)))
+
+def _local_timestamp(dt):
+    return benchmarks._milliseconds_isoformat(dt.astimezone(converter.TIMEZONE))
+
+
+class EventStore(object):
+    """The latest version of each event, by event-sid, as the Geo-Trafic API would have it."""
+
+    def __init__(self, events=()):
+        self.events = {}
+        self.lock = threading.Lock()
+        self.add(events)
+
+    def add(self, events):
+        with self.lock:
+            for ev in events:
+                updated = ev.findtext('last-update-time')
+                updated = _aware(converter.parse_timestamp(updated)) if updated else None
+                self.events[ev.findtext('event-sid')] = (updated, etree.tostring(ev))
+
+    def document(self, since):
+        """Returns the bytes of a document of the events updated at or after since, and their number."""
+        with self.lock:
+            parts = [data for updated, data in self.events.values()
+                if updated is not None and updated >= since]
+        return DOCUMENT_START + b''.join(parts) + DOCUMENT_END, len(parts)
+
+    def update(self, count, rand):
+        """
+        Changes count random events as Geo-Trafic would when they're edited:
+        a later last-update-time and end time, and one more update.
+        """
+        now = datetime.datetime.now(converter.TIMEZONE)
+        with self.lock:
+            for sid in rand.sample(sorted(self.events), min(count, len(self.events))):
+                ev = etree.fromstring(self.events[sid][1])
+                ev.find('last-update-time').text = _local_timestamp(now)
+                update_count = ev.find('event-update-count')
+                update_count.text = str(int(update_count.text or 0) + 1)
+                end = ev.find('expected-end-time')
+                if end is not None and end.text:
+                    end.text = _local_timestamp(
+                        _aware(converter.parse_timestamp(end.text)) + datetime.timedelta(days=1))
+                self.events[sid] = (now, etree.tostring(ev))
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A local stand-in for the Geo-Trafic API; see the module docstring."""
+
+    daemon_threads = True
+
+    def __init__(self, address, store, recordings=(), updates=0, latency=0.0, seed=0):
+        HTTPServer.__init__(self, address, _StandInHandler)
+        self.store = store
+        self.recordings = list(recordings)
+        self.updates = updates
+        self.latency = latency
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'events': 0, 'bytes': 0}
+
+    def respond(self, updated_since):
+        """Returns the body of the response to a request with updated_since, and its number of events."""
+        since = parse_updated_since(updated_since)
+        with self.lock:
+            recording = self.recordings.pop(0) if self.recordings else None
+            if recording is not None:
+                with open(recording['path'], 'rb') as f:
+                    body = f.read()
+                events = list(converter.iter_geotrafic_events(io.BytesIO(body)))
+                self.store.add(events)
+            elif self.updates:
+                self.store.update(self.updates, self.rand)
+        if recording is not None and recording['updated_since'] == urllib.parse.unquote(
+                updated_since):
+            count = len(events)
+        else:
+            body, count = self.store.document(since)
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['events'] += count
+            self.stats['bytes'] += len(body)
+        return body, count
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == STATS_PATH:
+            with self.server.lock:
+                body = json.dumps(self.server.stats).encode('utf8')
+            return self._send(200, body, 'application/json')
+        try:
+            body, count = self.server.respond(path.rstrip('/').rsplit('/', 1)[-1])
+        except ValueError:
+            return self._send(400, b'Invalid updated-since', 'text/plain')
+        # Before the response headers, as the API takes time to query its database
+        time.sleep(self.server.latency)
+        headers = []
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            headers.append(('Content-Encoding', 'gzip'))
+        self._send(200, body, 'application/xml; charset=utf-8', headers)
+
+    def log_message(self, *args):
+        pass
+
+def make_server(args):
+    if args.replay:
+        store = EventStore()
+        recordings = load_recordings(args.replay)
+    else:
+        feed = benchmarks.generate_feed(args.events, args.links, seed=args.seed)
+        store = EventStore(converter.iter_geotrafic_events(io.BytesIO(feed)))
+        recordings = []
+    return StandInServer((args.host, args.port), store, recordings, args.updates, args.latency,
+        args.seed)
+
+def serve(args):
+    server = make_server(args)
+    # Read by run(), to find the port
+    print('Listening on http://{}:{}/'.format(*server.server_address), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _stand_in_stats(url):
+    with urllib.request.urlopen(url.rstrip('/') + STATS_PATH) as resp:
+        return json.loads(resp.read().decode('utf8'))
+
+def _db_counters():
+    # Rows written to every table, and committed transactions, so far
+    from django import db
+    with db.connection.cursor() as cursor:
+        cursor.execute('SELECT coalesce(sum(n_tup_ins), 0), coalesce(sum(n_tup_upd), 0), '
+            'coalesce(sum(n_tup_del), 0) FROM pg_stat_user_tables')
+        inserted, updated, deleted = cursor.fetchone()
+        cursor.execute('SELECT xact_commit FROM pg_stat_database WHERE datname = current_database()')
+        commits, = cursor.fetchone()
+    db.connections.close_all()
+    return {'rows_inserted': int(inserted), 'rows_updated': int(updated),
+        'rows_deleted': int(deleted), 'commits': int(commits)}
+
+def _start_stand_in(args):
+    options = ['--host', '127.0.0.1', '--port', '0', '--latency', str(args.latency),
+        '--seed', str(args.seed)]
+    if args.replay:
+        options += ['--replay', args.replay]
+    else:
+        options += ['--events', str(args.events), '--links', str(args.links),
+            '--updates', str(args.updates)]
+    cwd = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    process = subprocess.Popen([sys.executable, '-m', 'geotrafic511.loadtest', 'serve'] + options,
+        cwd=cwd, stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line.startswith('Listening on '):
+        process.kill()
+        process.wait()
+        raise Exception("The stand-in server didn't start")
+    return process, line.split()[-1]
+
+def run(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'geotrafic511.settings')
+    import django
+    django.setup()
+    from django import db
+    from django.conf import settings
+    from django.utils.module_loading import import_string
+
+    opts = dict(settings.OPEN511_IMPORT_TASKS[args.task])
+    importer_class = import_string(opts['IMPORTER'])
+    process = None
+    if args.url:
+        url = args.url
+    else:
+        process, url = _start_stand_in(args)
+    opts['URL'] = url + 'Events/'
+    # The importer prints its progress; the results go to stdout
+    log = sys.stderr if args.verbose else open(os.devnull, 'w')
+    cycles = []
+    try:
+        for i in range(args.cycles):
+            served_before = _stand_in_stats(url)
+            db_before = _db_counters()
+            start = time.time()
+            with contextlib.redirect_stdout(log):
+                importer = importer_class(opts)
+                importer.run()
+            seconds = time.time() - start
+            db.connections.close_all()
+            time.sleep(STATS_DELAY)
+            db_after = _db_counters()
+            served = _stand_in_stats(url)
+            cycle = {
+                'seconds': seconds,
+                'events_served': served['events'] - served_before['events'],
+                'bytes_served': served['bytes'] - served_before['bytes'],
+                'events_saved': getattr(importer, 'saved_count', None),
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+            cycle['events_per_second'] = cycle['events_served'] / seconds if seconds else 0
+            cycle.update((name, db_after[name] - db_before[name]) for name in db_after)
+            cycles.append(cycle)
+            sys.stderr.write('Cycle {}: {:.2f} s, {} events served, {} saved\n'.format(
+                i + 1, seconds, cycle['events_served'], cycle['events_saved']))
+            if i + 1 < args.cycles:
+                time.sleep(args.interval)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if log is not sys.stderr:
+            log.close()
+
+    total_seconds = sum(cycle['seconds'] for cycle in cycles)
+    total_events = sum(cycle['events_served'] for cycle in cycles)
+    return {
+        'commit': benchmarks._git_commit(),
+        'python': platform.python_version(),
+        'parameters': dict((name, getattr(args, name)) for name in ('task', 'cycles', 'interval',
+            'url', 'replay', 'events', 'links', 'updates', 'latency', 'seed')),
+        'cycles': cycles,
+        'events_per_second': total_events / total_seconds if total_seconds else 0,
+        'mean_cycle_seconds': total_seconds / len(cycles) if cycles else 0,
+        'max_cycle_seconds': max([cycle['seconds'] for cycle in cycles] or [0]),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _add_feed_arguments(parser):
+    parser.add_argument('--replay', metavar='REPERTOIRE',
+        help="Rejouer les reponses enregistrees dans ce repertoire (option RECORD_DIR)")
+    parser.add_argument('--events', type=int, default=1000,
+        help="Nombre d'evenements du flux synthetique")
+    parser.add_argument('--links', type=int, default=2, help="Nombre de liens par evenement")
+    parser.add_argument('--updates', type=int, default=0,
+        help="Nombre d'evenements modifies avant chaque reponse, sans --replay")
+    parser.add_argument('--latency', type=float, default=0.0,
+        help="Delai avant chaque reponse, en secondes")
+    parser.add_argument('--seed', type=int, default=0)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tests de charge de l'importateur, sans l'API Geo-Trafic")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve', help="Servir un flux comme l'API Geo-Trafic")
+    _add_feed_arguments(serve_parser)
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8511)
+
+    run_parser = subparsers.add_parser('run', help="Executer des cycles d'importation et mesurer")
+    _add_feed_arguments(run_parser)
+    run_parser.add_argument('--url',
+        help="URL d'un serveur deja demarre, plutot que d'en demarrer un")
+    run_parser.add_argument('--task', type=int, default=0,
+        help="Index de la tache de OPEN511_IMPORT_TASKS")
+    run_parser.add_argument('--cycles', type=int, default=5)
+    run_parser.add_argument('--interval', type=float, default=0.0,
+        help="Delai entre les cycles, en secondes")
+    run_parser.add_argument('--output', metavar='FICHIER', help="Fichier JSON ou ecrire les resultats")
+    run_parser.add_argument('-v', '--verbose', action='store_true',
+        help="Afficher la sortie de l'importateur")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        return serve(args)
+    output = json.dumps(run(args), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+A minimal set of Prometheus metrics (counters, gauges and histograms) for the
+converter and importer, rendered in the Prometheus text exposition format.
+
+Nothing is recorded until instrumentation is turned on, with
+converter.instrument(), so that there's no overhead otherwise.
+"""
+
+import bisect
+import os
+import tempfile
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds, in seconds, of the buckets of histograms. Conversion tasks
+# take well under a millisecond; import cycles take seconds to minutes.
+TASK_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0)
+CYCLE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+# The metrics of the importer and converter, in order
+registry = []
+# The metrics of the scheduler, which runs in its own process
+scheduler_registry = []
+enabled = False
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for v in values)
+    return '{' + ','.join('{}="{}"'.format(n, v) for n, v in zip(names, escaped)) + '}'
+
+
+class Metric(object):
+    """
+    Base class for metrics. Values are kept per tuple of label values,
+    given positionally in the order of labelnames.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        """Yields (name suffix, label names, label values, value) tuples."""
+        for labels, value in sorted(self.values.items()):
+            yield '', self.labelnames, labels, value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, names, values, value in samples:
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(names, values),
+                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=TASK_BUCKETS, registry=registry):
+        super(Histogram, self).__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            try:
+                counts, total = self.values[labels]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0.0
+            # Non-cumulative counts per bucket; the last is for values above all buckets
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels] = counts, total + value
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', names, labels + (_format_value(bound),), cumulative
+            yield '_sum', self.labelnames, labels, total
+            yield '_count', self.labelnames, labels, cumulative
+
+
+TASK_SECONDS = Histogram('geotrafic511_task_duration_seconds',
+    'Time taken by each step of the conversion of an event (of a batch, for batch_validation).',
+    ['task'])
+CYCLE_SECONDS = Histogram('geotrafic511_import_cycle_duration_seconds',
+    'Time taken by each import cycle, from fetching the feed to saving the last event.',
+    buckets=CYCLE_BUCKETS)
+EVENTS_CONVERTED = Counter('geotrafic511_events_converted_total',
+    'Events successfully converted to Open511.')
+EVENTS_FAILED = Counter('geotrafic511_events_failed_total',
+    'Events that could not be converted, or were invalid once converted.')
+FEED_LAG = Gauge('geotrafic511_feed_lag_seconds',
+    'Time between the end of the last import cycle and the latest last-update-time it saw.')
+LAST_CYCLE = Gauge('geotrafic511_last_import_cycle_timestamp_seconds',
+    'Unix time at which the last import cycle ended.')
+SCHEDULER_CYCLE_SECONDS = Histogram('geotrafic511_scheduler_cycle_duration_seconds',
+    'Time taken by each cycle of each import task, as seen by the scheduler, by outcome '
+    '(changed, unchanged or error).', ['task', 'outcome'], buckets=CYCLE_BUCKETS,
+    registry=scheduler_registry)
+SCHEDULER_INTERVAL = Gauge('geotrafic511_scheduler_interval_seconds',
+    'Current polling interval of each import task, before jitter.', ['task'],
+    registry=scheduler_registry)
+SCHEDULER_TIMEOUTS = Counter('geotrafic511_scheduler_timeouts_total',
+    'Import cycles killed for taking longer than CYCLE_TIMEOUT.', ['task'],
+    registry=scheduler_registry)
+
+
+def render(metrics=registry):
+    """Returns a list of metrics, by default the importer's, in the Prometheus text format."""
+    return ''.join(metric.render() for metric in metrics)
+
+def write(filename, metrics=registry):
+    """
+    Writes render(metrics) to filename, replacing it atomically so that readers
+    never see a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(render(metrics))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
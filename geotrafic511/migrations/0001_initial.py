@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventSourceHash',
+            fields=[
+                ('event_sid', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('content_hash', models.CharField(max_length=40)),
+            ],
+        ),
+    ]
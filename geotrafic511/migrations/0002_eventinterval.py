@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.ranges
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geotrafic511', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventInterval',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('event_id', models.CharField(max_length=100, db_index=True)),
+                ('period', django.contrib.postgres.fields.ranges.DateTimeRangeField()),
+            ],
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX geotrafic511_eventinterval_period_gist ON geotrafic511_eventinterval USING gist (period)',
+            'DROP INDEX geotrafic511_eventinterval_period_gist',
+        ),
+    ]
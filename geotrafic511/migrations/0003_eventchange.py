@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('geotrafic511', '0002_eventinterval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('event_id', models.CharField(max_length=100)),
+                ('change_type', models.CharField(max_length=10, choices=[('created', 'Created'), ('updated', 'Updated'), ('archived', 'Archived')])),
+                ('time', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
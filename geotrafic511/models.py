@@ -0,0 +1,65 @@
+from django.contrib.postgres.fields import DateTimeRangeField
+from django.db import models
+from psycopg2.extras import DateTimeTZRange
+
+
+class EventSourceHash(models.Model):
+    """
+    A hash of the Geo-Trafic source of each imported event, so that
+    GeoTraficImporter can skip events that come back unchanged.
+    """
+    event_sid = models.CharField(max_length=50, primary_key=True)
+    content_hash = models.CharField(max_length=40)
+
+    def __str__(self):
+        return self.event_sid
+
+
+class EventIntervalQuerySet(models.QuerySet):
+
+    def in_effect(self, start, end=None):
+        """
+        The intervals of events in effect at start, or at any time between
+        start and end, if provided (aware datetimes).
+        """
+        if end is None:
+            return self.filter(period__contains=start)
+        return self.filter(period__overlap=DateTimeTZRange(start, end, '[]'))
+
+    def event_ids(self):
+        return self.values_list('event_id', flat=True).distinct()
+
+class EventInterval(models.Model):
+    """
+    A period during which an active event is in effect, expanded from its
+    schedule by GeoTraficImporter up to a rolling horizon, so that
+    "in effect at T, or between T1 and T2" is a single (GiST) index scan.
+    """
+    # The Open511 ID, e.g. ville.montreal.qc.ca/123
+    event_id = models.CharField(max_length=100, db_index=True)
+    # Without an upper bound if the event has no end
+    period = DateTimeRangeField()
+
+    objects = EventIntervalQuerySet.as_manager()
+
+    def __str__(self):
+        return '{} {}'.format(self.event_id, self.period)
+
+
+class EventChange(models.Model):
+    """
+    An entry of the change feed: an event saved by GeoTraficImporter. Entries
+    are only appended, so that their ID is the cursor clients read from.
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    ARCHIVED = 'archived'
+    CHANGE_TYPES = [(CREATED, 'Created'), (UPDATED, 'Updated'), (ARCHIVED, 'Archived')]
+
+    # The Open511 ID, e.g. ville.montreal.qc.ca/123
+    event_id = models.CharField(max_length=100)
+    change_type = models.CharField(max_length=10, choices=CHANGE_TYPES)
+    time = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.id, self.change_type, self.event_id)
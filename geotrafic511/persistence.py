@@ -0,0 +1,163 @@
+"""
+Bulk persistence of converted events, for the BULK_SAVE option of
+GeoTraficImporter: rather than BaseImporter saving events one at a time
+through the ORM, each batch is written in a single transaction. Its rows are
+COPY'd into a temporary staging table with the columns of open511_roadevent,
+then merged into it with one INSERT ... ON CONFLICT.
+
+Requires PostgreSQL 9.5 or later.
+"""
+
+import datetime
+import io
+import json
+import logging
+import time
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connection, transaction
+
+from lxml import etree
+from open511.converter.o5json import gml_to_geojson
+
+from open511_server.models import Jurisdiction, RoadEvent
+from .models import EventSourceHash
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE = 'geotrafic511_roadevent_staging'
+
+# Columns kept from the existing row when an event is updated
+PRESERVED_FIELDS = frozenset(['created'])
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+def _copy_text(value):
+    # A value in the text format of COPY
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    elif isinstance(value, bytes):
+        value = value.decode('ascii')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class BulkEventWriter(object):
+    """
+    Saves batches of converted Open511 event elements to RoadEvent, creating
+    them or replacing the existing events with the same jurisdiction and ID,
+    and stores the source hashes of the events saved, as
+    GeoTraficImporter.convert() does in the same transaction.
+    """
+
+    def __init__(self, default_language=None):
+        # The importer's default_language, given to events without an xml:lang
+        self.default_language = default_language
+        self.jurisdictions = {}
+        # Every concrete column but the automatic primary key
+        self.fields = [f for f in RoadEvent._meta.concrete_fields
+            if not (f.primary_key and f.get_internal_type() == 'AutoField')]
+        key_fields = (RoadEvent._meta.unique_together or [('jurisdiction', 'id')])[0]
+        self.key_columns = [RoadEvent._meta.get_field(name).column for name in key_fields]
+        self.created = self.updated = self.batch_count = 0
+        self.seconds = 0.0
+        self.created_ids = set()
+
+    def _jurisdiction(self, jurisdiction_id):
+        if jurisdiction_id not in self.jurisdictions:
+            self.jurisdictions[jurisdiction_id] = Jurisdiction.objects.get(id=jurisdiction_id)
+        return self.jurisdictions[jurisdiction_id]
+
+    def road_event(self, xml_event):
+        """An unsaved RoadEvent with the values RoadEvent.save() would store for xml_event."""
+        jurisdiction_id, event_id = xml_event.findtext('id').split('/', 1)
+        if self.default_language and not xml_event.get(XML_LANG):
+            # Converted events are detached from the document that had the xml:lang
+            xml_event.set(XML_LANG, self.default_language)
+        geom = GEOSGeometry(json.dumps(gml_to_geojson(xml_event.find('geography')[0])),
+            srid=4326)
+        return RoadEvent(id=event_id, jurisdiction=self._jurisdiction(jurisdiction_id),
+            xml_data=etree.tostring(xml_event, encoding='unicode'), geom=geom)
+
+    def _row(self, road_event):
+        values = []
+        for field in self.fields:
+            # As the ORM does when inserting, e.g. for auto_now fields
+            value = field.pre_save(road_event, True)
+            if getattr(field, 'geom_type', None) and value is not None:
+                value = value.hexewkb
+            else:
+                value = field.get_db_prep_save(value, connection)
+            values.append(_copy_text(value))
+        return '\t'.join(values) + '\n'
+
+    def write(self, xml_events, source_hashes=None):
+        """
+        Saves a list of converted event elements, and a dict of their
+        event-sid to source_hash(), in one transaction.
+        Returns the number of events (created, updated); the Open511 IDs of
+        those created are left in self.created_ids.
+        """
+        # An INSERT ... ON CONFLICT can't update the same row twice; keep the last version
+        rows = {}
+        # The Open511 ID of each row's key, whose jurisdiction is the table's primary key
+        open511_ids = {}
+        self.created_ids = set()
+        for xml_event in xml_events:
+            road_event = self.road_event(xml_event)
+            key = (road_event.jurisdiction_id, road_event.id)
+            rows[key] = self._row(road_event)
+            open511_ids[key] = xml_event.findtext('id')
+        if not rows and not source_hashes:
+            return 0, 0
+
+        start = time.time()
+        qn = connection.ops.quote_name
+        table = qn(RoadEvent._meta.db_table)
+        columns = ', '.join(qn(f.column) for f in self.fields)
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(qn(f.column)) for f in self.fields
+            if f.column not in self.key_columns and f.name not in PRESERVED_FIELDS)
+        created = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            if rows:
+                cursor.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS '
+                    'SELECT {} FROM {} WITH NO DATA'.format(qn(STAGING_TABLE), columns, table))
+                cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(qn(STAGING_TABLE), columns),
+                    io.StringIO(''.join(rows.values())))
+                # xmax is 0 for rows that were inserted, rather than updated
+                cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} '
+                    'ON CONFLICT ({3}) DO UPDATE SET {4} RETURNING {5}, {6}, xmax = 0'.format(
+                        table, columns, qn(STAGING_TABLE),
+                        ', '.join(qn(c) for c in self.key_columns), updates,
+                        qn(RoadEvent._meta.get_field('jurisdiction').column),
+                        qn(RoadEvent._meta.get_field('id').column)))
+                self.created_ids = set(open511_ids[(jurisdiction_id, event_id)]
+                    for jurisdiction_id, event_id, inserted in cursor.fetchall() if inserted)
+                created = len(self.created_ids)
+            if source_hashes:
+                cursor.execute('INSERT INTO {} (event_sid, content_hash) '
+                    'SELECT * FROM unnest(%s::text[], %s::text[]) '
+                    'ON CONFLICT (event_sid) DO UPDATE SET content_hash = EXCLUDED.content_hash'
+                    .format(qn(EventSourceHash._meta.db_table)),
+                    [list(source_hashes), list(source_hashes.values())])
+        seconds = time.time() - start
+
+        updated = len(rows) - created
+        self.created += created
+        self.updated += updated
+        self.batch_count += 1
+        self.seconds += seconds
+        logger.debug("Saved %d events (%d created, %d updated) in %.3f s",
+            len(rows), created, updated, seconds)
+        return created, updated
+
+    def stats(self):
+        total = self.created + self.updated
+        return '{} events saved ({} created, {} updated) in {} batches, {:.2f} s, {:.0f} rows/s'.format(
+            total, self.created, self.updated, self.batch_count, self.seconds,
+            total / self.seconds if self.seconds else 0)
@@ -0,0 +1,155 @@
+# coding: utf-8
+"""
+In-process reprojection of Geo-Trafic GML geometries from MTM zone 8
+(EPSG:32188, NAD83) into WGS84 GeoJSON, without needing PostGIS.
+
+NAD83 and WGS84 are treated as equivalent, as PostGIS/PROJ do for this SRID.
+"""
+
+import json
+
+from lxml import etree
+import numpy as np
+
+# Number of decimal places kept in output coordinates; this matches the
+# 15 significant digits PostGIS's ST_AsGeoJSON produces for Montreal
+COORDINATE_DECIMALS = 13
+
+
+class TransverseMercator(object):
+    """
+    Inverse transverse Mercator projection, using Krüger's series in n
+    to sixth order (as in Karney 2011, and PROJ's default tmerc algorithm).
+    Accurate to well under a millimetre within a few thousand km of the
+    central meridian.
+    """
+
+    def __init__(self, lon0, k0, false_easting, false_northing,
+            a=6378137.0, f=1 / 298.257222101):
+        self.lon0 = np.radians(lon0)
+        self.k0 = k0
+        self.false_easting = false_easting
+        self.false_northing = false_northing
+        self.e = np.sqrt(f * (2 - f))
+
+        n = f / (2 - f)
+        self.A = a / (1 + n) * (1 + n**2 / 4 + n**4 / 64 + n**6 / 256)
+        self.beta = np.array([
+            n / 2 - 2 * n**2 / 3 + 37 * n**3 / 96 - n**4 / 360 - 81 * n**5 / 512
+                + 96199 * n**6 / 604800,
+            n**2 / 48 + n**3 / 15 - 437 * n**4 / 1440 + 46 * n**5 / 105
+                - 1118711 * n**6 / 3870720,
+            17 * n**3 / 480 - 37 * n**4 / 840 - 209 * n**5 / 4480 + 5569 * n**6 / 90720,
+            4397 * n**4 / 161280 - 11 * n**5 / 504 - 830251 * n**6 / 7257600,
+            4583 * n**5 / 161280 - 108847 * n**6 / 3991680,
+            20648693 * n**6 / 638668800,
+        ])
+
+    def inverse(self, x, y):
+        """
+        Takes arrays of projected eastings and northings, in metres.
+        Returns a tuple of (longitudes, latitudes) arrays, in degrees.
+        """
+        xi = (np.asarray(y, dtype=float) - self.false_northing) / (self.k0 * self.A)
+        eta = (np.asarray(x, dtype=float) - self.false_easting) / (self.k0 * self.A)
+
+        j2 = 2 * np.arange(1, len(self.beta) + 1)[:, np.newaxis]
+        xi_p = xi - np.sum(self.beta[:, np.newaxis] * np.sin(j2 * xi) * np.cosh(j2 * eta), axis=0)
+        eta_p = eta - np.sum(self.beta[:, np.newaxis] * np.cos(j2 * xi) * np.sinh(j2 * eta), axis=0)
+
+        lon = self.lon0 + np.arctan2(np.sinh(eta_p), np.cos(xi_p))
+        # tan of the conformal latitude
+        tau_p = np.sin(xi_p) / np.hypot(np.sinh(eta_p), np.cos(xi_p))
+        lat = np.arctan(self._tau(tau_p))
+        return np.degrees(lon), np.degrees(lat)
+
+    def _tau(self, tau_p):
+        # Converts tan(conformal latitude) into tan(geographic latitude)
+        # by Newton's method, see Karney 2011 eqs. 7-9 and 19-21.
+        e = self.e
+        e2m = 1 - e**2
+        tau = tau_p / e2m
+        for _ in range(5):
+            sig = np.sinh(e * np.arctanh(e * tau / np.hypot(1, tau)))
+            tau_p_i = tau * np.hypot(1, sig) - sig * np.hypot(1, tau)
+            dtau = ((tau_p - tau_p_i) / np.hypot(1, tau_p_i)
+                * (1 + e2m * tau**2) / (e2m * np.hypot(1, tau)))
+            tau = tau + dtau
+        return tau
+
+# NAD83 / MTM zone 8
+MTM_ZONE_8 = TransverseMercator(lon0=-73.5, k0=0.9999,
+    false_easting=304800.0, false_northing=0.0)
+
+
+def _localname(el):
+    return etree.QName(el).localname
+
+def _parse_coordinates(el):
+    # Returns a flat list of x, y, x, y... from a posList, pos or coordinates element
+    name = _localname(el)
+    if name == 'coordinates':
+        return [float(v) for v in el.text.replace(',', ' ').split()]
+    if name in ('posList', 'pos'):
+        values = [float(v) for v in el.text.split()]
+        dim = int(el.get('srsDimension', 2))
+        if dim != 2:
+            values = [v for i, v in enumerate(values) if i % dim < 2]
+        return values
+    raise ValueError("Unsupported GML coordinates element %s" % name)
+
+def _coordinates_child(el):
+    for child in el:
+        if _localname(child) in ('posList', 'pos', 'coordinates'):
+            return child
+    raise ValueError("No coordinates in GML element %s" % _localname(el))
+
+def parse_gml(gml):
+    """
+    Parses a GML Point, LineString or Polygon.
+    Returns a tuple of (GeoJSON geometry type, list of flat coordinate lists),
+    with one coordinate list per ring for polygons.
+    """
+    el = etree.fromstring(gml) if isinstance(gml, str) else gml
+    name = _localname(el)
+    if name in ('Point', 'LineString'):
+        return name, [_parse_coordinates(_coordinates_child(el))]
+    if name == 'Polygon':
+        rings = []
+        for boundary in el:
+            if _localname(boundary) in ('exterior', 'interior', 'outerBoundaryIs', 'innerBoundaryIs'):
+                for ring in boundary:
+                    rings.append(_parse_coordinates(_coordinates_child(ring)))
+        return name, rings
+    raise ValueError("Unsupported GML geometry %s" % name)
+
+def reproject_gml(gml_strings, projection=MTM_ZONE_8):
+    """
+    Reprojects an iterable of GML strings into WGS84, transforming the
+    coordinates of all of them in a single vectorized operation.
+    Returns a dict mapping each GML string to a GeoJSON string.
+    """
+    parsed = [(gml,) + parse_gml(gml) for gml in gml_strings]
+    flat = [coords for _, _, parts in parsed for coords in parts]
+    if not flat:
+        return {}
+    xy = np.concatenate([np.asarray(coords, dtype=float) for coords in flat])
+    lon, lat = projection.inverse(xy[0::2], xy[1::2])
+    lonlat = np.round(np.column_stack((lon, lat)), COORDINATE_DECIMALS).tolist()
+
+    result = {}
+    offset = 0
+    for gml, geom_type, parts in parsed:
+        rings = []
+        for coords in parts:
+            count = len(coords) // 2
+            rings.append(lonlat[offset:offset + count])
+            offset += count
+        if geom_type == 'Point':
+            coordinates = rings[0][0]
+        elif geom_type == 'LineString':
+            coordinates = rings[0]
+        else:
+            coordinates = rings
+        result[gml] = json.dumps({'type': geom_type, 'coordinates': coordinates})
+    return result
@@ -0,0 +1,159 @@
+"""
+A cache of the responses of the Open511 events API (the list and detail
+endpoints), which only change when events have been saved.
+
+The importer, which runs in another process, increments a generation
+counter kept in GEOTRAFIC511_GENERATION_FILE after each import that saved
+events, once it's committed; so do events saved or deleted elsewhere (the
+admin, the map's editing), through RoadEvent's signals. Responses are
+cached, in each web process, under their path, normalized query string and
+format, for the current generation; they're also given an ETag derived from
+those, so that clients polling with If-None-Match get a 304 without the cache
+even being consulted. Queries whose results depend on the current time, and
+not only on the events saved, aren't cached.
+
+Nothing is cached unless GEOTRAFIC511_GENERATION_FILE is set.
+"""
+
+import contextlib
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+# Request headers the format or language of the response depends on
+VARY_HEADERS = ('Accept', 'Accept-Language')
+
+# Query parameters whose results can change with the time of the request, e.g.
+# in_effect_on=today or an open-ended range, even if no event has: never cached
+TIME_RELATIVE_PARAMETERS = frozenset(['in_effect_on'])
+
+# (inode, mtime) of the generation file, and the generation read from it
+_generation = (None, 0)
+# Whether event_changed() is suspended in this thread, by deferred_bumps()
+_deferred = threading.local()
+
+
+def get_generation(filename):
+    """
+    Returns the generation counter stored in filename, or 0 if there isn't one.
+    The file is only read again when it's been replaced.
+    """
+    global _generation
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return 0
+    version = (stat.st_ino, stat.st_mtime_ns)
+    if _generation[0] != version:
+        try:
+            with open(filename) as f:
+                _generation = version, int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+    return _generation[1]
+
+def bump_generation(filename):
+    """
+    Increments the generation counter stored in filename, invalidating cached
+    responses. The file is replaced atomically, as in metrics.write().
+    """
+    generation = get_generation(filename) + 1
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.generation-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}\n'.format(generation))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+    return generation
+
+@contextlib.contextmanager
+def deferred_bumps():
+    """
+    Within it, events saved or deleted in this thread don't each increment the
+    generation: the caller does it once, like the importer after each import.
+    """
+    _deferred.depth = getattr(_deferred, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _deferred.depth -= 1
+
+def event_changed(sender, **kwargs):
+    # Receiver of RoadEvent's post_save and post_delete signals, connected in apps.py
+    filename = getattr(settings, 'GEOTRAFIC511_GENERATION_FILE', None)
+    if filename and not getattr(_deferred, 'depth', 0):
+        transaction.on_commit(lambda: bump_generation(filename))
+
+def _normalized_query(request):
+    # Parameters sorted by name, keeping the order of repeated ones
+    return '&'.join('{}={}'.format(name, value)
+        for name, values in sorted(request.GET.lists()) for value in values)
+
+
+class EventsCacheMiddleware(object):
+    """
+    Answers GET requests to the events endpoints from the cache, or with a 304
+    if the client already has the current version, and caches successful
+    responses. Requests from logged-in users (with a session cookie) are
+    never cached, since the admin and the map's editing may differ for them.
+    """
+
+    def __init__(self):
+        self.filename = getattr(settings, 'GEOTRAFIC511_GENERATION_FILE', None)
+        self.cache = caches[getattr(settings, 'GEOTRAFIC511_RESPONSE_CACHE', 'default')]
+        self.timeout = getattr(settings, 'GEOTRAFIC511_RESPONSE_CACHE_TIMEOUT', 3600)
+        self.path_re = re.compile(r'^/{}events/'.format(
+            re.escape(getattr(settings, 'URL_PREFIX', None) or '')))
+
+    def _cache_key(self, request):
+        # Returns (cache key, ETag) for the request, or None if it shouldn't be cached
+        if (not self.filename or request.method not in ('GET', 'HEAD')
+                or not self.path_re.match(request.path_info)
+                or settings.SESSION_COOKIE_NAME in request.COOKIES
+                or TIME_RELATIVE_PARAMETERS.intersection(request.GET)):
+            return None
+        generation = get_generation(self.filename)
+        variant = '\n'.join([request.path_info, _normalized_query(request)]
+            + [request.META.get('HTTP_' + h.upper().replace('-', '_'), '') for h in VARY_HEADERS])
+        digest = hashlib.sha1(variant.encode('utf8')).hexdigest()
+        return 'geotrafic511.response.{}.{}'.format(generation, digest), \
+            '"{}-{}"'.format(generation, digest[:16])
+
+    def process_request(self, request):
+        key = self._cache_key(request)
+        request._events_cache_key = key
+        if key is None:
+            return None
+        cache_key, etag = key
+        if etag in [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            patch_vary_headers(response, VARY_HEADERS)
+            return response
+        response = self.cache.get(cache_key)
+        if response is not None:
+            request._events_cache_key = None
+        return response
+
+    def process_response(self, request, response):
+        key = getattr(request, '_events_cache_key', None)
+        if key is None or response.status_code != 200 or response.streaming:
+            return response
+        cache_key, etag = key
+        response['ETag'] = etag
+        patch_vary_headers(response, VARY_HEADERS)
+        if request.method == 'GET':
+            self.cache.set(cache_key, response, self.timeout)
+        return response
@@ -0,0 +1,211 @@
+"""
+A scheduler for OPEN511_IMPORT_TASKS, used by import_runner.py instead of
+open511_server's task runner.
+
+Each task runs in its own worker process, so that a slow or hung import can't
+delay the others, and can be killed if a cycle takes longer than its
+CYCLE_TIMEOUT; the worker is then replaced. Workers last between cycles, so
+that importers' caches (reprojection cache, conditional fetching) do too.
+
+The delay between the end of a cycle and the start of the next adapts to
+the feed: it's halved, down to MIN_INTERVAL, after a cycle that saved
+events, and grows by half, up to MAX_INTERVAL, after a cycle that saved none;
+it's doubled after an error or a timeout. Delays are jittered by
++/- JITTER (a fraction of the interval). Tasks without these options keep
+polling every INTERVAL seconds, give or take the jitter.
+
+Cycle timings are logged, and with GEOTRAFIC511_SCHEDULER_METRICS_FILE,
+written in the Prometheus format after each cycle.
+"""
+
+import logging
+import logging.config
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import random
+import signal
+import sys
+import time
+
+try:
+    from . import metrics
+except ImportError:
+    # Run as a script, e.g. by tests.py
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 60
+DEFAULT_JITTER = 0.1
+
+
+def _worker(conn, opts):
+    # Runs import cycles of one task, when asked by the scheduler, until told to stop
+    from django import db
+    from django.utils.module_loading import import_string
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Connections inherited from the parent can't be shared
+    db.connections.close_all()
+    importer_class = import_string(opts['IMPORTER'])
+    while True:
+        if conn.recv() is None:
+            return
+        start = time.time()
+        result = {}
+        try:
+            importer = importer_class(opts)
+            importer.run()
+            # Importers that don't count the events they save are assumed to always have changes
+            result['saved'] = getattr(importer, 'saved_count', None)
+        except Exception as e:
+            logger.exception("Error in import task %s", opts.get('NAME', opts['IMPORTER']))
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            db.close_old_connections()
+        result['seconds'] = time.time() - start
+        conn.send(result)
+
+
+class ScheduledTask(object):
+    """The schedule and worker process of one of OPEN511_IMPORT_TASKS."""
+
+    def __init__(self, name, opts):
+        self.name = name
+        self.opts = opts
+        self.base_interval = opts.get('INTERVAL', DEFAULT_INTERVAL)
+        self.min_interval = opts.get('MIN_INTERVAL', self.base_interval)
+        self.max_interval = opts.get('MAX_INTERVAL', self.base_interval)
+        self.jitter = opts.get('JITTER', DEFAULT_JITTER)
+        self.timeout = opts.get('CYCLE_TIMEOUT', max(10 * self.base_interval, 300))
+        self.interval = self.base_interval
+        self.next_run = time.time()
+        self.started = None
+        self.process = self.conn = None
+
+    def _start_worker(self):
+        context = multiprocessing.get_context('fork')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker, args=(child_conn, self.opts),
+            name='import-' + self.name, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def _kill(self):
+        # Process.kill() is only in Python 3.7+
+        try:
+            os.kill(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # Already exited
+            pass
+
+    def stop_worker(self, kill=False):
+        if self.process is None:
+            return
+        if kill:
+            self._kill()
+        else:
+            try:
+                self.conn.send(None)
+            except (IOError, OSError):
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self._kill()
+            self.process.join()
+        self.conn.close()
+        self.process = self.conn = None
+
+    def start_cycle(self):
+        if self.process is None or not self.process.is_alive():
+            self.stop_worker()
+            self._start_worker()
+        self.started = time.time()
+        self.conn.send('run')
+
+    @property
+    def deadline(self):
+        """When the scheduler next needs to do something for this task."""
+        if self.started is None:
+            return self.next_run
+        return self.started + self.timeout
+
+    def finish_cycle(self, result):
+        """
+        Records the result of a cycle, a dict with 'seconds', and 'saved'
+        (the number of events saved, or None if unknown) or 'error'.
+        """
+        seconds = result.get('seconds', time.time() - self.started)
+        self.started = None
+        if 'error' in result:
+            outcome = 'error'
+            self.interval = min(self.max_interval, self.interval * 2)
+        elif result.get('saved') == 0:
+            outcome = 'unchanged'
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        else:
+            outcome = 'changed'
+            self.interval = max(self.min_interval, self.interval / 2.0)
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_run = time.time() + delay
+        metrics.SCHEDULER_CYCLE_SECONDS.observe(seconds, self.name, outcome)
+        metrics.SCHEDULER_INTERVAL.set(self.interval, self.name)
+        logger.info("Task %s: %s cycle in %.2f s%s; next in %.0f s", self.name, outcome, seconds,
+            '' if result.get('saved') is None else ', {} events saved'.format(result['saved']),
+            delay)
+
+    def time_out(self):
+        logger.error("Task %s: cycle timed out after %.0f s; restarting its worker",
+            self.name, time.time() - self.started)
+        self.stop_worker(kill=True)
+        metrics.SCHEDULER_TIMEOUTS.inc(1, self.name)
+        self.finish_cycle({'error': 'timeout', 'seconds': time.time() - self.started})
+
+
+def _task_name(index, opts):
+    return opts.get('NAME', str(index))
+
+def run(tasks, metrics_file=None):
+    """Runs a list of import task option dicts, forever."""
+    scheduled = [ScheduledTask(_task_name(i, opts), opts) for i, opts in enumerate(tasks)]
+    if not scheduled:
+        logger.error("No import tasks in OPEN511_IMPORT_TASKS")
+        return
+    try:
+        while True:
+            now = time.time()
+            for task in scheduled:
+                if task.started is None and now >= task.next_run:
+                    task.start_cycle()
+                elif task.started is not None and now >= task.deadline:
+                    task.time_out()
+                    if metrics_file:
+                        metrics.write(metrics_file, metrics.scheduler_registry)
+
+            running = dict((task.conn, task) for task in scheduled if task.started is not None)
+            timeout = max(0, min(task.deadline for task in scheduled) - time.time())
+            for conn in wait(list(running), timeout):
+                task = running[conn]
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    # The worker died
+                    task.stop_worker(kill=True)
+                    result = {'error': 'worker exited'}
+                task.finish_cycle(result)
+                if metrics_file:
+                    metrics.write(metrics_file, metrics.scheduler_registry)
+    finally:
+        for task in scheduled:
+            task.stop_worker(kill=task.started is not None)
+
+def main():
+    from django import db
+    from django.conf import settings
+    logging.config.dictConfig(settings.OPEN511_IMPORTER_LOGGING)
+    # So that workers are stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Connections would be shared with the workers
+    db.connections.close_all()
+    run(settings.OPEN511_IMPORT_TASKS,
+        getattr(settings, 'GEOTRAFIC511_SCHEDULER_METRICS_FILE', None))
@@ -0,0 +1,198 @@
+"""
+Pre-rendered snapshots of the feed of active events, in JSON and XML, with
+gzip and (if the brotli module is installed) brotli variants.
+
+The importer writes them to GEOTRAFIC511_SNAPSHOT_DIR after each cycle that
+saved events, and SnapshotFiles, in wsgi.py, serves them at events.json and
+events.xml, choosing the variant from Accept-Encoding, without going through
+Django: no database queries and no serialization in the web processes.
+"""
+
+import email.utils
+import gzip
+import io
+import os
+import tempfile
+import urllib.parse
+
+from lxml import etree
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from open511.converter.o5json import xml_to_json
+
+try:
+    from . import converter
+except ImportError:
+    # Run as a script
+    import converter
+
+CONTENT_TYPES = {
+    'json': 'application/json; charset=utf-8',
+    'xml': 'application/xml; charset=utf-8',
+}
+
+# (Content-Encoding, file suffix) of the compressed variants, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def snapshot_path(directory, format):
+    return os.path.join(directory, 'events.' + format)
+
+def exist(directory):
+    return all(os.path.exists(snapshot_path(directory, format)) for format in CONTENT_TYPES)
+
+def add_links(ev, self_url, jurisdiction_url):
+    """
+    Adds the self and jurisdiction links, which aren't stored in xml_data, to
+    an <event> Element, as the API does when it serves it.
+    """
+    if not ev.xpath('link[@rel="self"]'):
+        ev.insert(0, etree.Element('link', rel='self', href=self_url))
+    if not ev.xpath('link[@rel="jurisdiction"]'):
+        ev.insert(1, etree.Element('link', rel='jurisdiction', href=jurisdiction_url))
+    return ev
+
+def load_active_events():
+    """Yields the <event> Elements of the active events in the database, with their links."""
+    from django.conf import settings
+    from open511_server.models import RoadEvent
+    # Jurisdiction links must be absolute
+    jurisdiction_urls = {}
+    for event in RoadEvent.objects.select_related('jurisdiction').iterator():
+        ev = etree.fromstring(event.xml_data)
+        if ev.findtext('status') != 'ACTIVE':
+            continue
+        if event.jurisdiction_id not in jurisdiction_urls:
+            jurisdiction_urls[event.jurisdiction_id] = urllib.parse.urljoin(
+                settings.OPEN511_BASE_URL, event.jurisdiction.get_absolute_url())
+        yield add_links(ev, event.get_absolute_url(), jurisdiction_urls[event.jurisdiction_id])
+
+def render_snapshots(events):
+    """Returns a dict of format to the bytes of a document of a list of <event> Elements."""
+    json_out = io.StringIO()
+    # Before write_xml_document, which indents the events
+    converter.write_json_document([xml_to_json(ev) for ev in events], json_out)
+    xml_out = io.BytesIO()
+    converter.write_xml_document(events, xml_out)
+    return {'json': json_out.getvalue().encode('utf8'), 'xml': xml_out.getvalue()}
+
+def _write_atomically(filename, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+        prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+def write_snapshots(directory, events):
+    """
+    Writes the snapshots of a list of <event> Elements, and their compressed
+    variants, to directory. Each file is replaced atomically, so that it's
+    never served partially written. Returns a dict of filename to size.
+    """
+    sizes = {}
+    for format, data in render_snapshots(events).items():
+        filename = snapshot_path(directory, format)
+        variants = [('', data), ('.gz', _gzip(data))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data)))
+        else:
+            # Don't leave a stale variant behind
+            try:
+                os.unlink(filename + '.br')
+            except OSError:
+                pass
+        # The uncompressed file last, since its presence is what's checked for
+        for suffix, variant in reversed(variants):
+            _write_atomically(filename + suffix, variant)
+            sizes[os.path.basename(filename + suffix)] = len(variant)
+    return sizes
+
+def _gzip(data):
+    # Without a timestamp, so that the same events always give the same bytes
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def _accepted_encodings(header):
+    encodings = set()
+    for part in header.split(','):
+        params = [p.strip() for p in part.split(';')]
+        if any(p.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for p in params[1:]):
+            continue
+        encodings.add(params[0].lower())
+    return encodings
+
+
+class SnapshotFiles(object):
+    """
+    WSGI middleware serving the snapshots in directory at prefix + events.json
+    and prefix + events.xml, with ETag and Last-Modified validators, and passing
+    other requests (or all of them, until the snapshots have been written) on
+    to application.
+    """
+
+    def __init__(self, application, directory, prefix='/', max_age=60):
+        self.application = application
+        self.max_age = max_age
+        self.urls = dict((prefix + 'events.' + format, (snapshot_path(directory, format), format))
+            for format in CONTENT_TYPES)
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if method not in ('GET', 'HEAD') or environ.get('PATH_INFO') not in self.urls:
+            return self.application(environ, start_response)
+        filename, format = self.urls[environ['PATH_INFO']]
+
+        accepted = _accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding, suffix in ENCODINGS + [(None, '')]:
+            if encoding is not None and encoding not in accepted:
+                continue
+            try:
+                # Opened before being stat'ed, so that the headers match the content
+                # even if the file is replaced in between
+                f = open(filename + suffix, 'rb')
+                break
+            except IOError:
+                continue
+        else:
+            return self.application(environ, start_response)
+
+        stat = os.fstat(f.fileno())
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        headers = [
+            ('Content-Type', CONTENT_TYPES[format]),
+            ('Cache-Control', 'public, max-age={}'.format(self.max_age)),
+            ('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)),
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        if etag in [t.strip() for t in environ.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            f.close()
+            start_response('304 Not Modified', headers)
+            return []
+        headers.append(('Content-Length', str(stat.st_size)))
+        start_response('200 OK', headers)
+        if method == 'HEAD':
+            f.close()
+            return []
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(f, 64 * 1024)
+        return _iter_file(f)
+
+def _iter_file(f, block_size=64 * 1024):
+    with f:
+        for block in iter(lambda: f.read(block_size), b''):
+            yield block
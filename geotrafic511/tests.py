@@ -1,19 +1,45 @@
 from __future__ import print_function
 
+import contextlib
+import datetime
 import glob
+import gzip
+import io
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import os
+import re
+import tempfile
+import threading
+import time
 import unittest
 
+from lxml import etree
+import pytz
+
 try:
     from django.core.exceptions import ImproperlyConfigured
 except ImportError:
     ImproperlyConfigured = Exception
 
 import converter
+import metrics
 
 from open511.converter.o5json import xml_to_json
 
+def _setup_django():
+    # The tests of the importer's database writes need the whole application and
+    # a PostGIS database: run them with DJANGO_SETTINGS_MODULE=geotrafic511.settings
+    if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        return False
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    import django
+    django.setup()
+    return True
+
+DJANGO_CONFIGURED = _setup_django()
+
 class GeoTraficIntegrationTests(unittest.TestCase):
 
     maxDiff = None
@@ -28,8 +54,7 @@ class GeoTraficIntegrationTests(unittest.TestCase):
             return psycopg2.connect(
                 os.environ.get('POSTGRES_DSN', 'dbname=open511 user=postgres'))
 
-    def test_outputs(self):
-        db_conn = self._get_db_conn()
+    def _fixtures(self):
         my_dir = os.path.dirname(os.path.realpath(__file__))
         fixtures_dir = os.path.join(my_dir, 'fixtures')
         input_files = glob.glob(fixtures_dir + '/*.input.xml')
@@ -38,14 +63,963 @@ class GeoTraficIntegrationTests(unittest.TestCase):
             print("Processing file %s" % os.path.basename(input_file))
             with open(input_file) as f:
                 input_data = f.read()
+            output_fixture = input_file.replace('.input.xml', '.output.json')
+            with open(output_fixture) as f:
+                valid_json = json.load(f)
+            yield input_data, valid_json
+
+    def test_outputs(self):
+        db_conn = self._get_db_conn()
+        for input_data, valid_json in self._fixtures():
             xml = converter.geotrafic_to_xml(input_data, db_conn)
             json_result = xml_to_json(xml)
             json_result = json.loads(json.dumps(json_result)) # normalize it
+            self.assertEqual(json_result, valid_json)
 
-            output_fixture = input_file.replace('.input.xml', '.output.json')
-            with open(output_fixture) as f:
-                valid_json = json.load(f)
+    def _assertCoordinatesAlmostEqual(self, coords, valid_coords):
+        if isinstance(valid_coords, list):
+            self.assertEqual(len(coords), len(valid_coords))
+            for c, valid_c in zip(coords, valid_coords):
+                self._assertCoordinatesAlmostEqual(c, valid_c)
+        else:
+            self.assertAlmostEqual(coords, valid_coords, delta=1e-7)
+
+    def test_local_reprojection(self):
+        for input_data, valid_json in self._fixtures():
+            xml = converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector())
+            json_result = xml_to_json(xml)
+            json_result = json.loads(json.dumps(json_result)) # normalize it
+            self.assertEqual(len(json_result['events']), len(valid_json['events']))
+            for ev, valid_ev in zip(json_result['events'], valid_json['events']):
+                geom, valid_geom = ev.pop('geography'), valid_ev.pop('geography')
+                self.assertEqual(geom['type'], valid_geom['type'])
+                self._assertCoordinatesAlmostEqual(geom['coordinates'], valid_geom['coordinates'])
             self.assertEqual(json_result, valid_json)
 
+    def test_synthetic_feed(self):
+        import benchmarks
+        feed = benchmarks.generate_feed(events=50, links=3, seed=1)
+        self.assertEqual(feed, benchmarks.generate_feed(events=50, links=3, seed=1))
+        xml = converter.geotrafic_to_xml(io.BytesIO(feed), None,
+            reprojector=converter.LocalReprojector())
+        self.assertEqual(len(xml.xpath('events/event')), 50)
+
+    def test_daemon_stdio(self):
+        import base64
+        import subprocess
+        import sys
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        inputs = sorted(glob.glob(os.path.join(my_dir, 'fixtures', '*.input.xml')))
+        documents = []
+        for filename in inputs:
+            with open(filename, 'rb') as f:
+                documents.append({'name': os.path.basename(filename),
+                    'data': base64.b64encode(f.read()).decode('ascii')})
+        request = json.dumps({'documents': documents, 'format': 'json'}) + '\n'
+        output = subprocess.check_output([sys.executable, os.path.join(my_dir, 'daemon.py'),
+            '--serve', '--stdio', '--reprojection', 'local'],
+            input=(request * 2).encode('utf8'), stderr=subprocess.DEVNULL)
+        responses = [json.loads(line) for line in output.decode('utf8').splitlines()]
+        self.assertEqual(len(responses), 2)
+        session = converter.ConversionSession('local')
+        expected = converter.render_document(session.convert_files(
+            converter._file_sources(inputs), log=io.StringIO(), format='json'), 'json')
+        for response in responses:
+            self.assertEqual(response['output'], expected)
+
+    def test_parallel_conversion(self):
+        import subprocess
+        import sys
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        inputs = sorted(glob.glob(os.path.join(my_dir, 'fixtures', '*.input.xml')))
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, 'cache.sqlite')
+            def convert(*options):
+                return subprocess.check_output([sys.executable,
+                    os.path.join(my_dir, 'converter.py'), '--reprojection', 'local',
+                    '--batch-size', '2'] + list(options) + inputs, stderr=subprocess.DEVNULL)
+            serial = convert()
+            self.assertEqual(convert('-j', '3', '--reprojection-cache', cache_file), serial)
+            # The geometries reprojected by the workers are saved
+            cache = converter.ReprojectionCache(filename=cache_file)
+            srcevents = [ev for filename in inputs for ev in converter.iter_geotrafic_events(filename)]
+            self.assertEqual(len(cache), len(set(converter.ReprojectionCache.key(g, converter._gml(g))
+                for g in converter.link_geometries(srcevents))))
+            self.assertEqual(convert('-j', '3', '--reprojection-cache', cache_file), serial)
+
+    def test_json_output(self):
+        import benchmarks
+        inputs = [input_data for input_data, _ in self._fixtures()]
+        inputs.append(benchmarks.generate_feed(events=200, links=2).decode('utf8'))
+        for input_data in inputs:
+            xml = converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector())
+            doc = converter.geotrafic_to_json(input_data, None,
+                reprojector=converter.LocalReprojector())
+            self.assertEqual(json.dumps(doc, indent=4), json.dumps(xml_to_json(xml), indent=4))
+
+    def test_streaming_xml_output(self):
+        import benchmarks
+        inputs = [input_data for input_data, _ in self._fixtures()]
+        inputs.append(benchmarks.generate_feed(events=0).decode('utf8'))
+        for input_data in inputs:
+            doc = converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector())
+            expected = etree.tostring(doc, encoding='unicode', pretty_print=True)
+            out = io.BytesIO()
+            converter.write_xml_document(doc.find('events'), out)
+            self.assertEqual(out.getvalue().decode('utf8').replace(
+                '<event xmlns:gml="http://www.opengis.net/gml">', '<event>'), expected)
+
+    def test_threaded_map(self):
+        import benchmarks
+        feed = benchmarks.generate_feed(events=300, links=2)
+        serial = converter.geotrafic_to_xml(feed.decode('utf8'), None,
+            reprojector=converter.LocalReprojector())
+        cache = converter.ReprojectionCache(max_size=1000)
+        in_flight = [0, 0]
+        lock = threading.Lock()
+        def source():
+            for batch in converter.batches(converter.iter_geotrafic_events(io.BytesIO(feed)), 20):
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                yield batch
+        def convert(reprojector, batch):
+            return converter.convert_batch(batch, None, reprojector)
+        events = []
+        for results in converter.threaded_map(convert, source(), workers=3, max_pending=4,
+                setup=lambda: converter.LocalReprojector(cache=cache)):
+            with lock:
+                in_flight[0] -= 1
+            events.extend(ev for _, ev in results if ev is not None)
+        self.assertLessEqual(in_flight[1], 5)
+        self.assertEqual([etree.tostring(ev) for ev in events],
+            [etree.tostring(ev) for ev in serial.find('events')])
+
+        def fail(item):
+            if item == 5:
+                raise ValueError(item)
+            return item
+        with self.assertRaises(ValueError):
+            list(converter.threaded_map(fail, range(100), workers=2))
+
+    def test_reprojection_cache(self):
+        cache = converter.ReprojectionCache(max_size=100)
+        for i in range(2):
+            for input_data, _ in self._fixtures():
+                converter.geotrafic_to_xml(input_data, None,
+                    reprojector=converter.LocalReprojector(cache=cache))
+            if i == 0:
+                hits, misses = cache.hits, cache.misses
+        # Everything is in the cache the second time around
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(cache.hits, 2 * hits + misses)
+
+        cache = converter.ReprojectionCache(max_size=2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        with tempfile.TemporaryDirectory() as directory:
+            cache.filename = os.path.join(directory, 'cache.sqlite')
+            cache.save()
+            cache.save()
+            self.assertEqual(list(converter.ReprojectionCache(filename=cache.filename).entries.items()),
+                [('a', '1'), ('c', '3')])
+
+    def test_batch_reprojection(self):
+        import benchmarks
+        feed = benchmarks.generate_feed(events=30, links=3, seed=2)
+
+        class _CountingReprojector(converter.LocalReprojector):
+            def __init__(self, fail_batches=False):
+                super(_CountingReprojector, self).__init__()
+                self.batches = []
+                self.fail_batches = fail_batches
+
+            def reproject_batch(self, gml_strings):
+                self.batches.append(len(gml_strings))
+                if self.fail_batches and len(gml_strings) > 1:
+                    raise ValueError("Batch failed")
+                return super(_CountingReprojector, self).reproject_batch(gml_strings)
+
+        def convert(reprojector):
+            srcevents = converter.iter_geotrafic_events(io.BytesIO(feed))
+            return [etree.tostring(ev) for ev in converter.convert_events(srcevents, None,
+                reprojector, batch_size=10)]
+
+        batched = _CountingReprojector()
+        output = convert(batched)
+        self.assertEqual(len(output), 30)
+        # A single reprojection per batch, of all its distinct link-geometries
+        srcevents = list(converter.iter_geotrafic_events(io.BytesIO(feed)))
+        self.assertEqual(batched.batches, [len(set(converter._gml(g)
+            for g in converter.link_geometries(srcevents[i:i + 10]))) for i in (0, 10, 20)])
+        # The same events as reprojecting each geometry on its own, which is
+        # what happens when a batch fails
+        single = _CountingReprojector(fail_batches=True)
+        with self.assertLogs(converter.logger, 'ERROR'):
+            self.assertEqual(convert(single), output)
+        self.assertEqual([n for n in single.batches if n > 1], batched.batches)
+        self.assertEqual(single.batches.count(1), sum(batched.batches))
+
+    def test_postgis_batch_reprojection(self):
+        import psycopg2
+        try:
+            db_conn = self._get_db_conn()
+        except psycopg2.OperationalError:
+            self.skipTest("Needs a PostGIS database")
+        srcevents = [ev for input_data, _ in self._fixtures()
+            for ev in converter.iter_geotrafic_events(io.BytesIO(input_data.encode('utf8')))]
+        link_geometries = converter.link_geometries(srcevents)
+        batch = converter._reproject_gml([converter._gml(g) for g in link_geometries], db_conn)
+        for link_geometry in link_geometries:
+            self.assertEqual(json.loads(batch[converter._gml(link_geometry)]),
+                converter.reproject_geometry(link_geometry, db_conn))
+
+    def test_event_fields(self):
+        # The record read by field tasks matches the lookups they made on the element
+        import benchmarks
+        feed = benchmarks.generate_feed(events=50, links=3, seed=3)
+        srcevents = list(converter.iter_geotrafic_events(io.BytesIO(feed)))
+        for input_data, _ in self._fixtures():
+            srcevents.extend(converter.iter_geotrafic_events(io.BytesIO(input_data.encode('utf8'))))
+        for src in srcevents:
+            fields = converter.EventFields(src)
+            for tag, slot in converter.EventFields.TEXT_FIELDS.items():
+                self.assertEqual(getattr(fields, slot), src.findtext(tag))
+            self.assertEqual(fields.description, src.findtext('project_references/project-description'))
+            self.assertEqual(fields.itis_codes,
+                src.xpath('event-descriptions/event-cause/ITIS-event-category-id/text()'))
+            self.assertEqual(fields.schedule_times,
+                src.xpath('recurent-times/recurent-time/schedule-times/text()'))
+            for bad_location in src.xpath(
+                    'event-locations/event-location[location-on-link/effective-end-date/text()]'):
+                bad_location.getparent().remove(bad_location)
+            self.assertEqual([g for link in fields.links for g in link.geometries],
+                src.xpath('event-locations/event-location/location-on-link/link-geometry'))
+            self.assertEqual(
+                set(name for link in fields.links
+                    for name in (link.left_jurisdiction_name, link.right_jurisdiction_name) if name),
+                set(src.xpath('event-locations/event-location/location-on-link/'
+                    'link-left-jurisdiction-name/text()') + src.xpath('event-locations/'
+                    'event-location/location-on-link/link-right-jurisdiction-name/text()')))
+
+    def test_reprojection_results_per_batch(self):
+        import benchmarks
+        feed = benchmarks.generate_feed(events=100, links=2)
+        reprojector = converter.LocalReprojector()
+        events = list(converter.convert_events(converter.iter_geotrafic_events(io.BytesIO(feed)),
+            None, reprojector, batch_size=10))
+        self.assertEqual(len(events), 100)
+        # Only the geometries of the last batch are kept
+        self.assertLessEqual(len(reprojector.results), 10 * 3)
+
+    def test_parse_timestamp(self):
+        import dateutil.parser
+        for ts in ('2015-11-16T13:56:59.320-05:00', '2015-07-02T08:00:00-04:00',
+                '2015-07-02T08:00:00Z', '2015-07-02 08:00', '2015-07-02T08:00:00.5+0100',
+                '2015-07-02', 'Jul 2 2015 8:00'):
+            self.assertEqual(converter.parse_timestamp(ts), dateutil.parser.parse(ts))
+        # Every timestamp of the fixtures and of a synthetic feed, as dateutil parses them
+        import benchmarks
+        sources = [benchmarks.generate_feed(events=500)]
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        for filename in glob.glob(os.path.join(my_dir, 'fixtures', '*.input.xml')):
+            with open(filename, 'rb') as f:
+                sources.append(f.read())
+        timestamps = set()
+        for source in sources:
+            root = etree.fromstring(source)
+            timestamps.update(root.xpath('//*[local-name()="last-update-time" or '
+                'local-name()="start-date" or local-name()="end-date"]/text()'))
+        self.assertGreater(len(timestamps), 500)
+        for ts in timestamps:
+            self.assertEqual(converter.parse_timestamp(ts), dateutil.parser.parse(ts), ts)
+
+    def test_schedule_intervals(self):
+        schedule = etree.fromstring('<schedule><intervals>'
+            '<interval>2015-07-02T08:00/2015-07-02T17:00</interval>'
+            '<interval>2015-07-10T08:00/</interval></intervals></schedule>')
+        start = converter.TIMEZONE.localize(datetime.datetime(2015, 7, 1))
+        end = converter.TIMEZONE.localize(datetime.datetime(2015, 7, 5))
+        periods = converter.schedule_intervals(schedule, start, end)
+        self.assertEqual(periods, [(converter.TIMEZONE.localize(datetime.datetime(2015, 7, 2, 8)),
+            converter.TIMEZONE.localize(datetime.datetime(2015, 7, 2, 17)))])
+        self.assertEqual(periods[0][0].utcoffset(), datetime.timedelta(hours=-4))
+
+    def test_batch_validation(self):
+        input_data = next(self._fixtures())[0]
+        start, end = input_data.index('<Event>'), input_data.rindex('</Event>') + len('</Event>')
+        src_event = re.sub(r'<event-sid>\d+', '<event-sid>{}', input_data[start:end])
+        input_data = (input_data[:start] + src_event.format(1) + src_event.format(2)
+            + input_data[end:])
+
+        def _invalid_severity(src, ev):
+            if ev['id'].endswith('/2'):
+                ev['severity'] = 'BOGUS'
+        converter.conv_funcs.append(_invalid_severity)
+        try:
+            validator = converter.EventValidator('batch')
+            xml = converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector(), validator=validator)
+        finally:
+            converter.conv_funcs.remove(_invalid_severity)
+        self.assertEqual(xml.xpath('events/event/id/text()'), ['ville.montreal.qc.ca/1'])
+        # The batch failed, so both events were then validated individually
+        self.assertEqual(validator.validated, 2)
+
+class _FeedHandler(BaseHTTPRequestHandler):
+    body = gzip.compress(b'<Events xmlns="GeoTrafic"></Events>')
+    requests = []
+    # Number of requests still to answer with a 503
+    failures = 0
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if _FeedHandler.failures:
+            _FeedHandler.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '11')
+            self.end_headers()
+            self.wfile.write(b'Unavailable')
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+class FeedFetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _FeedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%s/Events/' % self.server.server_port
+        _FeedHandler.requests = []
+        _FeedHandler.failures = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_conditional_compressed_fetch(self):
+        from fetching import FeedFetcher
+        fetcher = FeedFetcher()
+        resp = fetcher.get(self.url, stream=True)
+        resp.raw.decode_content = True
+        self.assertEqual(list(converter.iter_geotrafic_events(resp.raw)), [])
+        self.assertIn('gzip', _FeedHandler.requests[0]['Accept-Encoding'])
+        self.assertIn('{} bytes'.format(len(_FeedHandler.body)), fetcher.stats(resp))
+
+        # Not conditional until the previous response has been processed
+        fetcher.get(self.url).close()
+        self.assertNotIn('If-None-Match', _FeedHandler.requests[1])
+        fetcher.mark_processed(resp)
+        self.assertIsNone(fetcher.get(self.url))
+        self.assertIsNotNone(fetcher.get(self.url + '2016-01-01'))
+
+    def test_retries(self):
+        import requests
+        from fetching import FeedFetcher
+        responses = []
+        class _RecordingSession(requests.Session):
+            def get(self, *args, **kwargs):
+                responses.append(super(_RecordingSession, self).get(*args, **kwargs))
+                return responses[-1]
+        _FeedHandler.failures = 2
+        fetcher = FeedFetcher(retries=2, backoff=0, session=_RecordingSession())
+        resp = fetcher.get(self.url, stream=True)
+        self.assertEqual([r.status_code for r in responses], [503, 503, 200])
+        # The failed responses were closed, releasing their connections
+        self.assertTrue(all(r.raw.closed for r in responses[:2]))
+        self.assertFalse(resp.raw.closed)
+        resp.close()
+        _FeedHandler.failures = 3
+        with self.assertRaises(requests.HTTPError):
+            fetcher.get(self.url, stream=True)
+        self.assertTrue(responses[-1].raw.closed)
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conv_funcs = list(converter.conv_funcs)
+        self.serialize = converter._serialize
+
+    def tearDown(self):
+        converter.uninstrument()
+        self.assertFalse(metrics.enabled)
+        self.assertEqual(converter.conv_funcs, self.conv_funcs)
+        self.assertIs(converter._serialize, self.serialize)
+
+    def test_task_histograms(self):
+        converter.instrument()
+        before = metrics.EVENTS_CONVERTED.values.get((), 0)
+        for input_data, _ in GeoTraficIntegrationTests._fixtures(self):
+            converter.geotrafic_to_xml(input_data, None, reprojector=converter.LocalReprojector())
+        self.assertEqual(metrics.EVENTS_CONVERTED.values[()] - before, 5)
+        text = metrics.render()
+        self.assertIn('# TYPE geotrafic511_task_duration_seconds histogram', text)
+        count = re.search(r'^geotrafic511_task_duration_seconds_count\{task="geography"\} (\d+)$',
+            text, re.M)
+        self.assertGreaterEqual(int(count.group(1)), 5)
+        self.assertIn('geotrafic511_task_duration_seconds_bucket{task="serialization",le="+Inf"}', text)
+
+    def test_benchmark_stages(self):
+        import benchmarks
+        feed = benchmarks.generate_feed(events=20)
+        converted, stages = benchmarks._convert_event_stages(feed)
+        self.assertEqual(converted, 20)
+        self.assertFalse(metrics.enabled)
+        for stage in ('reprojection', 'fields', 'geography', 'serialization'):
+            self.assertGreater(stages[stage], 0)
+
+class SchedulerTests(unittest.TestCase):
+
+    def test_adaptive_interval(self):
+        import scheduler
+        task = scheduler.ScheduledTask('test', {'IMPORTER': 'geotrafic511.importer.GeoTraficImporter',
+            'INTERVAL': 60, 'MIN_INTERVAL': 10, 'MAX_INTERVAL': 300, 'JITTER': 0})
+        def finish(**result):
+            task.started = 0
+            task.finish_cycle(dict(result, seconds=1))
+            return task.interval
+        self.assertEqual(finish(saved=0), 90)
+        self.assertEqual(finish(saved=0), 135)
+        self.assertEqual(finish(saved=2), 67.5)
+        self.assertEqual(finish(error='timeout'), 135)
+        self.assertEqual([finish(error='timeout') for _ in range(3)], [270, 300, 300])
+        # Importers that don't count the events they save
+        self.assertEqual(finish(saved=None), 150)
+        self.assertEqual([finish(saved=1) for _ in range(4)], [75, 37.5, 18.75, 10])
+        self.assertIsNone(task.started)
+        self.assertAlmostEqual(task.next_run, time.time() + 10, delta=1)
+
+    def test_kill_worker(self):
+        import multiprocessing
+        import signal
+        import scheduler
+        task = scheduler.ScheduledTask('test', {'IMPORTER': 'geotrafic511.importer.GeoTraficImporter'})
+        context = multiprocessing.get_context('fork')
+        task.conn, child_conn = context.Pipe()
+        process = task.process = context.Process(target=time.sleep, args=(60,), daemon=True)
+        process.start()
+        child_conn.close()
+        task.stop_worker(kill=True)
+        self.assertEqual(process.exitcode, -signal.SIGKILL)
+        self.assertIsNone(task.process)
+
+class SnapshotTests(unittest.TestCase):
+
+    def test_serve_snapshots(self):
+        import snapshots
+        events = []
+        for input_data, _ in GeoTraficIntegrationTests._fixtures(self):
+            events.extend(converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector()).find('events'))
+        with tempfile.TemporaryDirectory() as directory:
+            snapshots.write_snapshots(directory, events)
+            app = snapshots.SnapshotFiles(lambda environ, start_response: [b'django'], directory)
+            def get(path, **headers):
+                environ = dict(('HTTP_' + k, v) for k, v in headers.items())
+                environ.update(REQUEST_METHOD='GET', PATH_INFO=path)
+                response = {}
+                def start_response(status, response_headers):
+                    response.update(response_headers, status=status)
+                body = b''.join(app(environ, start_response))
+                return response, body
+
+            response, body = get('/events.json')
+            self.assertEqual(response['status'], '200 OK')
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(len(json.loads(body.decode('utf8'))['events']), len(events))
+            gzipped, gzipped_body = get('/events.json', ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(gzipped_body), body)
+            # No timestamp in the gzip header
+            self.assertEqual(gzipped_body[4:8], b'\0\0\0\0')
+            self.assertNotEqual(gzipped['ETag'], response['ETag'])
+            not_modified, _ = get('/events.json', ACCEPT_ENCODING='gzip', IF_NONE_MATCH=gzipped['ETag'])
+            self.assertEqual(not_modified['status'], '304 Not Modified')
+            response, body = get('/events.xml')
+            self.assertEqual(body.count(b'<event '), len(events))
+            self.assertEqual(get('/events/')[1], b'django')
+
+    def test_valid_snapshots(self):
+        import snapshots
+        from open511.validator import Open511ValidationError, validate
+        events = []
+        for input_data, _ in GeoTraficIntegrationTests._fixtures(self):
+            for ev in converter.geotrafic_to_xml(input_data, None,
+                    reprojector=converter.LocalReprojector()).find('events'):
+                events.append(snapshots.add_links(ev,
+                    '/events/ville.montreal.qc.ca/{}/'.format(ev.findtext('id').split('/')[-1]),
+                    'https://example.com/jurisdictions/ville.montreal.qc.ca/'))
+        rendered = snapshots.render_snapshots(events)
+        self.assertTrue(validate(etree.fromstring(rendered['xml'])))
+        for ev in json.loads(rendered['json'].decode('utf8'))['events']:
+            self.assertTrue(ev['url'].startswith('/events/ville.montreal.qc.ca/'))
+            self.assertEqual(ev['jurisdiction_url'],
+                'https://example.com/jurisdictions/ville.montreal.qc.ca/')
+        # Without the links, the snapshot isn't valid Open511
+        for ev in events:
+            for link in ev.findall('link'):
+                ev.remove(link)
+        with self.assertRaises(Open511ValidationError):
+            validate(etree.fromstring(snapshots.render_snapshots(events)['xml']))
+
+class TileTests(unittest.TestCase):
+
+    def test_clip_and_simplify(self):
+        import tiles
+        line = [(0.0, 0.5), (0.25, 0.5001), (0.5, 0.5), (1.0, 0.5)]
+        self.assertEqual(tiles.simplify(line, 0.001), [(0.0, 0.5), (1.0, 0.5)])
+        self.assertEqual(tiles.clip_line(line, (0.2, 0.4, 0.3, 0.6)),
+            [[(0.2, 0.50008), (0.25, 0.5001), (0.3, 0.50008)]])
+        square = [(0, 0), (2, 0), (2, 2), (0, 2), (0, 0)]
+        self.assertEqual(sorted(tiles.clip_ring(square, (1, 1, 3, 3))[:-1]),
+            [(1, 1), (1, 2), (2, 1), (2, 2)])
+
+    def test_event_tiles(self):
+        import tiles
+        events = []
+        for input_data, _ in GeoTraficIntegrationTests._fixtures(self):
+            events.extend(converter.geotrafic_to_xml(input_data, None,
+                reprojector=converter.LocalReprojector()).find('events'))
+        index = tiles.TileIndex(events)
+        world = index.tile(0, 0, 0)
+        self.assertEqual(len(world['features']), len(events))
+        # Montreal, at zoom 12
+        features = index.tile(12, 1210, 1465)['features'] + index.tile(12, 1211, 1465)['features']
+        self.assertTrue(features)
+        for feature in features:
+            self.assertEqual(feature['geometry']['type'], 'LineString')
+            for lon, lat in feature['geometry']['coordinates']:
+                self.assertLessEqual(len(repr(lon).split('.')[1]), 5)
+
+class StandInServerTests(unittest.TestCase):
+
+    def _serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%s/Events/' % server.server_port
+
+    def test_record_and_replay(self):
+        import benchmarks
+        import loadtest
+        from fetching import FeedFetcher
+        feed = benchmarks.generate_feed(events=50)
+        store = loadtest.EventStore(converter.iter_geotrafic_events(io.BytesIO(feed)))
+        url = self._serve(loadtest.StandInServer(('127.0.0.1', 0), store, updates=3))
+        fetcher = FeedFetcher()
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = loadtest.Recorder(directory)
+            updated = []
+            for since in ('2000-01-01', '2030-01-01'):
+                resp = fetcher.get(url + since, stream=True)
+                resp.raw.decode_content = True
+                recording = recorder.start(url + since, since)
+                events = list(converter.iter_geotrafic_events(loadtest.TeeReader(resp.raw, recording)))
+                recording.finish()
+                updated.append(len(events))
+            # The events changed before the first response, and none since 2030
+            self.assertEqual(updated, [50, 0])
+
+            recordings = loadtest.load_recordings(directory)
+            self.assertEqual([r['updated_since'] for r in recordings], ['2000-01-01', '2030-01-01'])
+            replay = loadtest.StandInServer(('127.0.0.1', 0), loadtest.EventStore(), recordings)
+            url = self._serve(replay)
+            body = fetcher.get(url + '2000-01-01').content
+            with open(recordings[0]['path'], 'rb') as f:
+                self.assertEqual(body, f.read())
+            # Not the updated-since of the recording, so answered from the events replayed
+            since = '2015-06-01%2000%3A00%3A00'
+            events = list(converter.iter_geotrafic_events(io.BytesIO(fetcher.get(url + since).content)))
+            self.assertTrue(0 < len(events) < 50)
+            self.assertTrue(all(converter.parse_timestamp(ev.findtext('last-update-time'))
+                >= loadtest.parse_updated_since(since) for ev in events))
+            self.assertEqual(replay.stats['requests'], 2)
+
+class IncrementalImportTests(unittest.TestCase):
+
+    def _events(self):
+        import benchmarks
+        return list(converter.iter_geotrafic_events(io.BytesIO(
+            benchmarks.generate_feed(events=5, links=1))))
+
+    def test_changed_events(self):
+        import incremental
+        events = self._events()
+        stored = dict((ev.findtext('event-sid'), incremental.source_hash(ev)) for ev in events)
+        # Re-sent with only volatile fields changed, and with different whitespace
+        events[0].find('last-update-time').text = '2016-01-01T00:00:00.000-05:00'
+        events[0].find('event-update-count').text = '99'
+        events[1].find('event-name').text = '  ' + events[1].find('event-name').text + '\n'
+        # Really changed
+        events[2].find('event-severity-tmdd-id').text = '9'
+        # Never imported
+        del stored[events[3].findtext('event-sid')]
+
+        changed, unchanged = incremental.changed_events(events, stored)
+        self.assertEqual([ev for ev, _ in changed], [events[2], events[3]])
+        self.assertEqual(unchanged, 3)
+        self.assertEqual(changed[0][1], incremental.source_hash(events[2]))
+        self.assertNotEqual(changed[0][1], stored[events[2].findtext('event-sid')])
+
+        # A full import ignores the stored hashes
+        changed, unchanged = incremental.changed_events(events, stored, full_import=True)
+        self.assertEqual([ev for ev, _ in changed], events)
+        self.assertEqual(unchanged, 0)
+
+    def test_watermark(self):
+        import incremental
+        watermark = incremental.Watermark()
+        self.assertIsNone(watermark.value)
+        # Around the end of DST, the latest string isn't the latest time:
+        # 01:30-05:00 is after 01:45-04:00, the first time through the repeated hour
+        for updated in ('2015-11-01T01:45:00.000-04:00', '2015-11-01T01:30:00.000-05:00',
+                '2015-11-01T01:15:00.000-04:00'):
+            watermark.update(updated)
+        self.assertEqual(watermark.value, '2015-11-01T01:30:00.000-05:00')
+        self.assertEqual(watermark.timestamp,
+            datetime.datetime(2015, 11, 1, 6, 30, tzinfo=pytz.utc))
+        # Without an offset, Montreal time
+        self.assertEqual(incremental.parse_aware_timestamp('2015-07-02T08:00:00'),
+            datetime.datetime(2015, 7, 2, 12, tzinfo=pytz.utc))
+
+    def test_url_timestamp(self):
+        from incremental import url_timestamp
+        self.assertEqual(url_timestamp(datetime.datetime(2015, 7, 2, 12, 0, 30, 500, tzinfo=pytz.utc)),
+            '2015-07-02%2008%3A00%3A30')
+        # In the hour repeated when DST ends, both times through it ask for an hour earlier
+        for utc_hour in (5, 6):
+            self.assertEqual(url_timestamp(datetime.datetime(2015, 11, 1, utc_hour, 30, tzinfo=pytz.utc)),
+                '2015-11-01%2000%3A30%3A00')
+        # Just after it, the wall-clock time
+        self.assertEqual(url_timestamp(datetime.datetime(2015, 11, 1, 7, 0, tzinfo=pytz.utc)),
+            '2015-11-01%2002%3A00%3A00')
+
+    def test_backfill_spool(self):
+        import incremental
+        events = self._events()
+        timestamps = ['2000-01-11T00:00:00.000-05:00', '2000-01-05T00:00:00.000-05:00',
+            '2000-06-01T00:00:00.000-04:00', '2000-06-01T00:30:00.000-05:00', None]
+        for ev, timestamp in zip(events, timestamps):
+            ev.find('last-update-time').text = timestamp
+        with tempfile.TemporaryDirectory() as spool_dir:
+            opts = {'URL': 'http://example.com/events?', 'BACKFILL_SPOOL_DIR': spool_dir}
+            spool = incremental.BackfillSpool(incremental.backfill_spool_path(opts))
+            status = {'max_updated': timestamps[0]}
+            count, max_updated = spool.write(iter(events))
+            # Compared as datetimes: 00:30-05:00 is after 00:00-04:00
+            self.assertEqual((count, max_updated), (5, timestamps[3]))
+            incremental.start_backfill(status, spool, count, max_updated)
+            self.assertNotIn('max_updated', status)
+
+            # Read back oldest first, events without a timestamp before the others
+            order = [4, 1, 0, 2, 3]
+            part = spool.read(status['backfill']['done'], 2)
+            self.assertEqual([etree.tostring(ev) for ev in part],
+                [etree.tostring(events[i]) for i in order[:2]])
+            message = incremental.finish_backfill_part(status, len(part), 1.0)
+            self.assertIn('2 of 5', message)
+            self.assertIn('over 2 cycles', message)
+            self.assertNotIn('max_updated', status)
+
+            part = spool.read(status['backfill']['done'], 2)
+            self.assertEqual([etree.tostring(ev) for ev in part],
+                [etree.tostring(events[i]) for i in order[2:4]])
+            incremental.finish_backfill_part(status, len(part), 1.0)
+            part = spool.read(status['backfill']['done'], 2)
+            self.assertEqual(len(part), 1)
+            message = incremental.finish_backfill_part(status, len(part), 1.0)
+
+            # Done: back to regular imports from the latest event, and the spool is removed
+            self.assertEqual(message, 'Backfill complete: 5 events imported')
+            self.assertEqual(status, {'max_updated': timestamps[3]})
+            self.assertFalse(spool.exists())
+
+@unittest.skipUnless(DJANGO_CONFIGURED, "Needs DJANGO_SETTINGS_MODULE and a PostGIS database")
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from django.core.cache import caches
+        from django.test.utils import override_settings
+        fd, self.generation_file = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.generation_file)
+        overridden = override_settings(GEOTRAFIC511_GENERATION_FILE=self.generation_file,
+            GEOTRAFIC511_RESPONSE_CACHE='default', URL_PREFIX='')
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        caches['default'].clear()
+
+    def _middleware(self):
+        from geotrafic511.response_cache import EventsCacheMiddleware
+        return EventsCacheMiddleware()
+
+    def test_cache_key(self):
+        from django.conf import settings
+        from django.test import RequestFactory
+        from geotrafic511.response_cache import bump_generation
+        middleware = self._middleware()
+        factory = RequestFactory()
+        key = middleware._cache_key(factory.get('/events/?status=ACTIVE&b=2&a=1&b=1'))
+        self.assertEqual(middleware._cache_key(factory.get('/events/?a=1&b=2&b=1&status=ACTIVE')),
+            key)
+        # The order of repeated parameters is kept
+        self.assertNotEqual(middleware._cache_key(factory.get('/events/?a=1&b=1&b=2&status=ACTIVE')),
+            key)
+        self.assertNotEqual(middleware._cache_key(factory.get('/events/?status=ACTIVE&b=2&a=1&b=1',
+            HTTP_ACCEPT='application/json')), key)
+        self.assertIsNone(middleware._cache_key(factory.post('/events/')))
+        self.assertIsNone(middleware._cache_key(factory.get('/map/')))
+        # Results that depend on the time of the request
+        self.assertIsNone(middleware._cache_key(factory.get('/events/?in_effect_on=today')))
+        logged_in = factory.get('/events/')
+        logged_in.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        self.assertIsNone(middleware._cache_key(logged_in))
+        bump_generation(self.generation_file)
+        self.assertNotEqual(middleware._cache_key(factory.get('/events/?a=1&b=2&b=1&status=ACTIVE')),
+            key)
+
+    def test_etag_and_invalidation(self):
+        from django.conf import settings
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from geotrafic511.response_cache import deferred_bumps, event_changed
+        middleware = self._middleware()
+        factory = RequestFactory()
+        request = factory.get('/events/')
+        self.assertIsNone(middleware.process_request(request))
+        etag = middleware.process_response(request, HttpResponse('<events/>'))['ETag']
+        self.assertEqual(middleware.process_request(factory.get('/events/')).content, b'<events/>')
+        not_modified = middleware.process_request(factory.get('/events/', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], etag)
+        # Neither read from nor written to the cache with a session
+        logged_in = factory.get('/events/', HTTP_IF_NONE_MATCH=etag)
+        logged_in.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        self.assertIsNone(middleware.process_request(logged_in))
+        self.assertNotIn('ETag', middleware.process_response(logged_in, HttpResponse('<events/>')))
+        # Events saved by the importer only increment the generation once it's done
+        with deferred_bumps():
+            event_changed(None)
+        self.assertEqual(middleware.process_request(
+            factory.get('/events/', HTTP_IF_NONE_MATCH=etag)).status_code, 304)
+        # Events saved elsewhere (outside of a transaction) do immediately
+        event_changed(None)
+        self.assertIsNone(middleware.process_request(factory.get('/events/', HTTP_IF_NONE_MATCH=etag)))
+
+@unittest.skipUnless(DJANGO_CONFIGURED, "Needs DJANGO_SETTINGS_MODULE and a PostGIS database")
+class MetricsPageTests(unittest.TestCase):
+
+    def test_allowed_ips(self):
+        from django.core.exceptions import PermissionDenied
+        from django.test import RequestFactory
+        from django.test.utils import override_settings
+        from geotrafic511.views import metrics_page
+        with tempfile.NamedTemporaryFile('w', suffix='.prom') as f:
+            f.write(metrics.render())
+            f.flush()
+            factory = RequestFactory()
+            with override_settings(GEOTRAFIC511_METRICS_FILE=f.name):
+                self.assertEqual(metrics_page(factory.get('/metrics')).status_code, 200)
+                with self.assertRaises(PermissionDenied):
+                    metrics_page(factory.get('/metrics', REMOTE_ADDR='192.0.2.1'))
+                with override_settings(GEOTRAFIC511_METRICS_ALLOWED_IPS=['192.0.2.0/24']):
+                    response = metrics_page(factory.get('/metrics', REMOTE_ADDR='192.0.2.1'))
+                    self.assertIn(b'geotrafic511_task_duration_seconds', response.content)
+                    with self.assertRaises(PermissionDenied):
+                        metrics_page(factory.get('/metrics'))
+
+class _DatabaseTests(unittest.TestCase):
+    # A test database with the Montreal jurisdiction, and a stand-in for the
+    # Geo-Trafic API serving the fixtures
+
+    @classmethod
+    def setUpClass(cls):
+        from django.core.management import call_command
+        from django.db import connection
+        from django.test.utils import setup_test_environment
+        import loadtest
+        setup_test_environment()
+        cls.database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        my_dir = os.path.dirname(os.path.realpath(__file__))
+        call_command('loaddata', os.path.join(os.path.dirname(my_dir), 'juridiction_mtl.json'),
+            verbosity=0)
+        events = []
+        for filename in sorted(glob.glob(os.path.join(my_dir, 'fixtures', '*.input.xml'))):
+            events.extend(converter.iter_geotrafic_events(filename))
+        cls.server = loadtest.StandInServer(('127.0.0.1', 0), loadtest.EventStore(events))
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connection
+        from django.test.utils import teardown_test_environment
+        cls.server.shutdown()
+        cls.server.server_close()
+        connection.creation.destroy_test_db(cls.database_name, verbosity=0)
+        teardown_test_environment()
+
+    def _import(self, clear=True, **opts):
+        # Runs a full import from the fixtures; returns the stored events and source hashes
+        from open511_server.models import ImportTaskStatus, RoadEvent
+        from geotrafic511.importer import GeoTraficImporter
+        from geotrafic511.models import EventSourceHash
+        ImportTaskStatus.objects.all().delete()
+        if clear:
+            RoadEvent.objects.all().delete()
+            EventSourceHash.objects.all().delete()
+        opts.update(URL='http://127.0.0.1:%s/Events/' % self.server.server_port,
+            IMPORTER='geotrafic511.importer.GeoTraficImporter', REPROJECTION='local')
+        self.importer = GeoTraficImporter(opts)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.importer.run()
+        fields = [f for f in RoadEvent._meta.concrete_fields
+            if not f.primary_key and f.name not in ('created', 'updated')]
+        rows = dict(((ev.jurisdiction_id, ev.id), dict((f.attname, getattr(ev, f.attname))
+            for f in fields)) for ev in RoadEvent.objects.all())
+        return rows, dict(EventSourceHash.objects.values_list('event_sid', 'content_hash'))
+
+
+@unittest.skipUnless(DJANGO_CONFIGURED, "Needs DJANGO_SETTINGS_MODULE and a PostGIS database")
+class BulkSaveTests(_DatabaseTests):
+
+    def _assertSameRows(self, rows, expected):
+        self.assertEqual(sorted(rows), sorted(expected))
+        for key, row in expected.items():
+            row, other = dict(row), dict(rows[key])
+            for name, value in list(row.items()):
+                if hasattr(value, 'equals_exact'):
+                    self.assertTrue(value.equals_exact(other.pop(name), 1e-9), key)
+                    del row[name]
+            self.assertEqual(other, row)
+
+    def test_bulk_save_matches_per_event_save(self):
+        per_event, per_event_hashes = self._import()
+        self.assertTrue(per_event)
+        bulk, bulk_hashes = self._import(BULK_SAVE=True)
+        self._assertSameRows(bulk, per_event)
+        self.assertEqual(bulk_hashes, per_event_hashes)
+        # Over the existing events, which are then updated
+        updated, _ = self._import(clear=False, BULK_SAVE=True)
+        self._assertSameRows(updated, per_event)
+
+@unittest.skipUnless(DJANGO_CONFIGURED, "Needs DJANGO_SETTINGS_MODULE and a PostGIS database")
+class PerEventSaveTests(_DatabaseTests):
+
+    def test_bookkeeping(self):
+        # Done for each event BaseImporter saves, and only then
+        from django.test.utils import override_settings
+        from geotrafic511.models import EventChange, EventInterval
+        EventChange.objects.all().delete()
+        with override_settings(GEOTRAFIC511_CHANGE_FEED=True):
+            rows, hashes = self._import(IN_EFFECT_HORIZON_DAYS=30)
+        self.assertTrue(rows)
+        self.assertEqual(self.importer.saved_count, len(rows))
+        self.assertEqual(self.importer.unsaved, {})
+        self.assertEqual(self.importer.converted, {})
+        sids = list(self.server.store.events)
+        self.assertEqual(sorted(hashes), sorted(sids))
+        ids = set('ville.montreal.qc.ca/' + sid for sid in sids)
+        self.assertEqual(set(EventChange.objects.values_list('event_id', flat=True)), ids)
+        self.assertLessEqual(set(EventInterval.objects.values_list('event_id', flat=True)), ids)
+
+
+@unittest.skipUnless(DJANGO_CONFIGURED, "Needs DJANGO_SETTINGS_MODULE and a PostGIS database")
+class ChangeFeedTests(_DatabaseTests):
+
+    def setUp(self):
+        from geotrafic511.models import EventChange
+        EventChange.objects.all().delete()
+
+    def test_cursors(self):
+        from django.utils import timezone
+        from geotrafic511 import change_feed
+        from geotrafic511.models import EventChange
+        self.assertEqual(change_feed.current_cursor(), 0)
+        change_feed.check_cursor(0)
+        with self.assertRaises(change_feed.CursorExpired):
+            change_feed.check_cursor(1)
+        change_feed.append([('ville.montreal.qc.ca/1', EventChange.CREATED),
+            ('ville.montreal.qc.ca/2', EventChange.UPDATED)])
+        first, second = change_feed.read(0)
+        self.assertEqual((first.event_id, first.change_type), ('ville.montreal.qc.ca/1', 'created'))
+        self.assertEqual(change_feed.current_cursor(), second.id)
+        self.assertEqual(change_feed.read(first.id), [second])
+        self.assertEqual(change_feed.read(second.id), [])
+        self.assertEqual(change_feed.read(0, limit=1), [first])
+        for since in (first.id - 1, first.id, second.id):
+            change_feed.check_cursor(since)
+        with self.assertRaises(change_feed.CursorExpired):
+            change_feed.check_cursor(second.id + 1)
+        # Once the first entry has been pruned, clients that haven't read it must start over
+        EventChange.objects.filter(id=first.id).update(
+            time=timezone.now() - datetime.timedelta(days=30))
+        change_feed.append([('ville.montreal.qc.ca/1', EventChange.ARCHIVED)])
+        self.assertEqual([entry.event_id for entry in change_feed.read(0)],
+            ['ville.montreal.qc.ca/2', 'ville.montreal.qc.ca/1'])
+        with self.assertRaises(change_feed.CursorExpired):
+            change_feed.check_cursor(first.id - 1)
+        change_feed.check_cursor(first.id)
+
+    def test_serialization(self):
+        from geotrafic511 import change_feed
+        from geotrafic511.models import EventChange
+        change_feed.append([('ville.montreal.qc.ca/1', EventChange.CREATED)])
+        entry, = change_feed.read(0)
+        data = change_feed.as_json(entry)
+        self.assertEqual(data, {'cursor': entry.id, 'id': 'ville.montreal.qc.ca/1',
+            'type': 'created', 'time': entry.time.isoformat()})
+        chunks = list(change_feed.stream(0, 0.5, heartbeat=0.2))
+        self.assertEqual(chunks[0], 'retry: {}\n\n'.format(change_feed.STREAM_RETRY))
+        self.assertEqual(chunks[1], 'id: {}\ndata: {}\n\n'.format(entry.id,
+            json.dumps(data, separators=(',', ':'))))
+        # Then only heartbeats
+        self.assertTrue(chunks[2:])
+        self.assertEqual(set(chunks[2:]), set([':\n\n']))
+
+    def _import_changes(self, **opts):
+        # The change feed entries of an import from scratch, then of one over its events
+        from django.test.utils import override_settings
+        from geotrafic511 import change_feed
+        with override_settings(GEOTRAFIC511_CHANGE_FEED=True):
+            self._import(**opts)
+            created = change_feed.read(0)
+            self._import(clear=False, SKIP_UNCHANGED=False, **opts)
+            updated = change_feed.read(created[-1].id)
+        return created, updated
+
+    def _assertChanges(self, created, updated):
+        from open511_server.models import RoadEvent
+        ids = set('{}/{}'.format(jurisdiction, event_id) for jurisdiction, event_id
+            in RoadEvent.objects.values_list('jurisdiction__id', 'id'))
+        self.assertEqual(set(entry.event_id for entry in created), ids)
+        self.assertEqual(set(entry.event_id for entry in updated), ids)
+        # The fixtures' events are all active
+        self.assertEqual(set(entry.change_type for entry in created), set(['created']))
+        self.assertEqual(set(entry.change_type for entry in updated), set(['updated']))
+
+    def test_changes(self):
+        self._assertChanges(*self._import_changes())
+
+    def test_bulk_save_changes(self):
+        self._assertChanges(*self._import_changes(BULK_SAVE=True))
+
 if __name__ == '__main__':
     unittest.main()
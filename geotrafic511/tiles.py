@@ -0,0 +1,271 @@
+"""
+GeoJSON tiles of the active events, for the map: at each zoom level, event
+geometries are simplified to about a pixel, clipped to the tile (plus a small
+buffer), and their coordinates rounded to the precision the zoom level can show.
+
+Tiles use the usual z/x/y Web Mercator scheme, with 256-pixel tiles.
+Geometries are kept in Web Mercator world coordinates, from 0 to 1, so that
+simplification tolerances and clipping are in pixels.
+"""
+
+import math
+
+from open511.converter.o5json import gml_to_geojson
+
+TILE_SIZE = 256
+# Pixels around each tile included in it, so that lines don't end at tile edges
+BUFFER = 8
+MAX_ZOOM = 22
+# Simplification tolerance, in pixels
+TOLERANCE = 0.5
+
+PROPERTIES = ('id', 'status', 'headline', 'event_type', 'severity')
+
+
+def _project(lon, lat):
+    # To Web Mercator world coordinates
+    lat = max(min(lat, 85.0511), -85.0511)
+    sin = math.sin(math.radians(lat))
+    return (lon + 180.0) / 360.0, 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+
+def _unproject(x, y):
+    return x * 360.0 - 180.0, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+def _decimals(z):
+    # Enough decimal places of a degree for a tenth of a pixel
+    return max(0, int(math.ceil(math.log10(TILE_SIZE * 2 ** z / 36.0))))
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a list of (x, y) points."""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    sq_tolerance = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        max_distance, index = 0.0, None
+        for i in range(first + 1, last):
+            px, py = points[i]
+            if length:
+                t = max(0.0, min(1.0, ((px - x1) * dx + (py - y1) * dy) / length))
+                ex, ey = x1 + t * dx - px, y1 + t * dy - py
+            else:
+                ex, ey = x1 - px, y1 - py
+            distance = ex * ex + ey * ey
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > sq_tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+def _clip_segment(p1, p2, bounds):
+    # Liang-Barsky; returns the clipped segment, or None
+    (x1, y1), (x2, y2) = p1, p2
+    xmin, ymin, xmax, ymax = bounds
+    dx, dy = x2 - x1, y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - xmin), (dx, xmax - x1), (-dy, y1 - ymin), (dy, ymax - y1)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return (x1 + t0 * dx, y1 + t0 * dy), (x1 + t1 * dx, y1 + t1 * dy)
+
+def clip_line(points, bounds):
+    """Returns the list of parts of a line inside bounds (xmin, ymin, xmax, ymax)."""
+    parts = []
+    current = None
+    for p1, p2 in zip(points, points[1:]):
+        segment = _clip_segment(p1, p2, bounds)
+        if segment is None:
+            current = None
+            continue
+        if current is None or current[-1] != segment[0]:
+            current = [segment[0]]
+            parts.append(current)
+        current.append(segment[1])
+        if segment[1] != p2:
+            # Left the tile
+            current = None
+    return parts
+
+def clip_ring(points, bounds):
+    """Sutherland-Hodgman clipping of a closed ring to bounds; returns [] if nothing is left."""
+    xmin, ymin, xmax, ymax = bounds
+    edges = (
+        (lambda p: p[0] >= xmin, lambda p, q: (xmin, p[1] + (q[1] - p[1]) * (xmin - p[0]) / (q[0] - p[0]))),
+        (lambda p: p[0] <= xmax, lambda p, q: (xmax, p[1] + (q[1] - p[1]) * (xmax - p[0]) / (q[0] - p[0]))),
+        (lambda p: p[1] >= ymin, lambda p, q: (p[0] + (q[0] - p[0]) * (ymin - p[1]) / (q[1] - p[1]), ymin)),
+        (lambda p: p[1] <= ymax, lambda p, q: (p[0] + (q[0] - p[0]) * (ymax - p[1]) / (q[1] - p[1]), ymax)),
+    )
+    output = points[:-1]
+    for inside, intersection in edges:
+        if not output:
+            return []
+        ring, output = output, []
+        previous = ring[-1]
+        for point in ring:
+            if inside(point):
+                if not inside(previous):
+                    output.append(intersection(previous, point))
+                output.append(point)
+            elif inside(previous):
+                output.append(intersection(previous, point))
+            previous = point
+    if len(output) < 3:
+        return []
+    return output + [output[0]]
+
+
+class _Feature(object):
+
+    __slots__ = ('properties', 'type', 'parts', 'bbox', 'simplified')
+
+    def __init__(self, properties, geometry):
+        self.properties = properties
+        geom_type = geometry['type']
+        coordinates = geometry['coordinates']
+        # Everything as a list of polygons (lists of rings), of lines, or of points
+        if geom_type == 'Point':
+            self.type, parts = 'Point', [[coordinates]]
+        elif geom_type == 'MultiPoint':
+            self.type, parts = 'Point', [coordinates]
+        elif geom_type == 'LineString':
+            self.type, parts = 'LineString', [coordinates]
+        elif geom_type == 'MultiLineString':
+            self.type, parts = 'LineString', coordinates
+        elif geom_type == 'Polygon':
+            self.type, parts = 'Polygon', [coordinates]
+        elif geom_type == 'MultiPolygon':
+            self.type, parts = 'Polygon', coordinates
+        else:
+            raise NotImplementedError("Unsupported geometry type %s" % geom_type)
+        project = lambda line: [_project(float(c[0]), float(c[1])) for c in line]
+        if self.type == 'Polygon':
+            self.parts = [[project(ring) for ring in polygon] for polygon in parts]
+            points = [p for polygon in self.parts for ring in polygon for p in ring]
+        else:
+            self.parts = [project(line) for line in parts]
+            points = [p for line in self.parts for p in line]
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        self.bbox = min(xs), min(ys), max(xs), max(ys)
+        self.simplified = {}
+
+    def parts_at(self, z):
+        # Simplified for zoom level z, in world coordinates
+        if self.type == 'Point':
+            return self.parts
+        if z not in self.simplified:
+            tolerance = TOLERANCE / (TILE_SIZE * 2 ** z)
+            if self.type == 'Polygon':
+                self.simplified[z] = [[simplify(ring, tolerance) for ring in polygon]
+                    for polygon in self.parts]
+            else:
+                self.simplified[z] = [simplify(line, tolerance) for line in self.parts]
+        return self.simplified[z]
+
+    def clipped(self, z, bounds):
+        """Returns the GeoJSON geometry of this feature inside bounds at zoom z, or None."""
+        decimals = _decimals(z)
+        def coords(points):
+            result = []
+            for point in points:
+                lon, lat = _unproject(*point)
+                point = [round(lon, decimals), round(lat, decimals)]
+                if not result or result[-1] != point:
+                    result.append(point)
+            return result
+
+        xmin, ymin, xmax, ymax = bounds
+        if self.type == 'Point':
+            points = [coords([p])[0] for line in self.parts for p in line
+                if xmin <= p[0] <= xmax and ymin <= p[1] <= ymax]
+            if not points:
+                return None
+            if len(points) == 1:
+                return {'type': 'Point', 'coordinates': points[0]}
+            return {'type': 'MultiPoint', 'coordinates': points}
+        if self.type == 'LineString':
+            lines = [coords(part) for line in self.parts_at(z) for part in clip_line(line, bounds)]
+            if not lines:
+                return None
+            if all(len(line) == 1 for line in lines):
+                # Smaller than the precision at this zoom level
+                return {'type': 'Point', 'coordinates': lines[0][0]}
+            lines = [line for line in lines if len(line) > 1]
+            if len(lines) == 1:
+                return {'type': 'LineString', 'coordinates': lines[0]}
+            return {'type': 'MultiLineString', 'coordinates': lines}
+        polygons = []
+        collapsed = None
+        for polygon in self.parts_at(z):
+            rings = [coords(clip_ring(ring, bounds)) for ring in polygon]
+            if len(rings[0]) < 4:
+                collapsed = collapsed or rings[0]
+                continue
+            polygons.append([rings[0]] + [ring for ring in rings[1:] if len(ring) >= 4])
+        if not polygons:
+            if collapsed:
+                return {'type': 'Point', 'coordinates': collapsed[0]}
+            return None
+        if len(polygons) == 1:
+            return {'type': 'Polygon', 'coordinates': polygons[0]}
+        return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def tile_bounds(z, x, y, buffer=BUFFER):
+    """The (xmin, ymin, xmax, ymax) world coordinates of a tile, with buffer pixels around it."""
+    size = 1.0 / 2 ** z
+    margin = size * buffer / TILE_SIZE
+    return x * size - margin, y * size - margin, (x + 1) * size + margin, (y + 1) * size + margin
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+class TileIndex(object):
+    """
+    The geometries of a set of events, from which tiles are rendered.
+    Simplified geometries are kept for each zoom level as they're needed.
+    """
+
+    def __init__(self, events):
+        """events is an iterable of Open511 <event> Elements."""
+        self.features = []
+        for ev in events:
+            geography = ev.find('geography')
+            if geography is None or not len(geography):
+                continue
+            properties = dict((name, ev.findtext(name)) for name in PROPERTIES)
+            self.features.append(_Feature(properties, gml_to_geojson(geography[0])))
+
+    def tile(self, z, x, y):
+        """Returns the GeoJSON FeatureCollection of tile z/x/y."""
+        bounds = tile_bounds(z, x, y)
+        xmin, ymin, xmax, ymax = bounds
+        features = []
+        for feature in self.features:
+            fxmin, fymin, fxmax, fymax = feature.bbox
+            if fxmin > xmax or fxmax < xmin or fymin > ymax or fymax < ymin:
+                continue
+            geometry = feature.clipped(z, bounds)
+            if geometry is not None:
+                features.append({'type': 'Feature', 'properties': feature.properties,
+                    'geometry': geometry})
+        return {'type': 'FeatureCollection', 'features': features}
@@ -2,10 +2,18 @@ from django.conf import settings
 from django.conf.urls import include, url
 from django.contrib import admin
 
-from .views import simple_index_page
+from .views import (event_change_stream, event_changes, event_tile, metrics_page,
+    simple_index_page)
 
 urlpatterns = [
     url(r'^carte/', include('django_open511_ui.urls')),
+
+    url(r'^metrics$', metrics_page),
+
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.geojson$', event_tile),
+
+    url(r'^changes$', event_changes),
+    url(r'^changes/stream$', event_change_stream),
     
     url(r'', include('open511_server.urls')),
 
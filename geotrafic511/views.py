@@ -1,4 +1,166 @@
+import ipaddress
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count, Max
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+    JsonResponse, StreamingHttpResponse)
 from django.shortcuts import render
+from django.views.decorators.cache import never_cache
+from open511_server.models import RoadEvent
+
+from . import change_feed, metrics, response_cache, snapshots, tiles
+
+# (version, TileIndex) of the active events
+_tile_index = (None, None)
 
 def simple_index_page(request):
     return render(request, 'geotrafic_index.html')
+
+def _metrics_allowed(request):
+    # Whether the client's address is in GEOTRAFIC511_METRICS_ALLOWED_IPS,
+    # addresses or networks, by default only this machine
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(allowed) for allowed in
+        getattr(settings, 'GEOTRAFIC511_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']))
+
+def metrics_page(request):
+    """
+    Serves the metrics written by the importer and its scheduler, which run in
+    other processes, to GEOTRAFIC511_METRICS_FILE and
+    GEOTRAFIC511_SCHEDULER_METRICS_FILE, for Prometheus to scrape from one of
+    GEOTRAFIC511_METRICS_ALLOWED_IPS.
+    """
+    filenames = [getattr(settings, name, None) for name in
+        ('GEOTRAFIC511_METRICS_FILE', 'GEOTRAFIC511_SCHEDULER_METRICS_FILE')]
+    if not any(filenames):
+        raise Http404
+    if not _metrics_allowed(request):
+        raise PermissionDenied
+    content = ''
+    for filename in filenames:
+        if filename:
+            try:
+                with open(filename) as f:
+                    content += f.read()
+            except IOError:
+                # No import cycle has finished yet
+                pass
+    return HttpResponse(content, content_type=metrics.CONTENT_TYPE)
+
+def _get_tile_index(generation):
+    # Rebuilt when events have changed: when the generation has, or without
+    # GEOTRAFIC511_GENERATION_FILE, when the latest update time or number of events has
+    global _tile_index
+    version = generation
+    if version is None:
+        version = RoadEvent.objects.aggregate(Max('updated'), Count('id'))
+    if _tile_index[0] != version:
+        _tile_index = version, tiles.TileIndex(snapshots.load_active_events())
+    return _tile_index[1]
+
+def event_tile(request, z, x, y):
+    """
+    Serves a GeoJSON tile of the active events, simplified and clipped for
+    its zoom level. Tiles are cached until the importer changes events.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not tiles.valid_tile(z, x, y):
+        raise Http404
+    filename = getattr(settings, 'GEOTRAFIC511_GENERATION_FILE', None)
+    generation = response_cache.get_generation(filename) if filename else None
+    if generation is None:
+        content = None
+    else:
+        etag = '"{}-{}-{}-{}"'.format(generation, z, x, y)
+        if etag in [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        cache = caches[getattr(settings, 'GEOTRAFIC511_RESPONSE_CACHE', 'default')]
+        cache_key = 'geotrafic511.tile.{}.{}.{}.{}'.format(generation, z, x, y)
+        content = cache.get(cache_key)
+    if content is None:
+        content = json.dumps(_get_tile_index(generation).tile(z, x, y), separators=(',', ':'))
+        if generation is not None:
+            cache.set(cache_key, content,
+                getattr(settings, 'GEOTRAFIC511_RESPONSE_CACHE_TIMEOUT', 3600))
+    response = HttpResponse(content, content_type='application/geo+json')
+    if generation is not None:
+        response['ETag'] = etag
+    return response
+
+def _cursor(value):
+    # A cursor from the query string or Last-Event-ID, or None
+    if value is None or value == '':
+        return None
+    cursor = int(value)
+    if cursor < 0:
+        raise ValueError(value)
+    return cursor
+
+def _expired_cursor():
+    return JsonResponse({'error': 'Cursor expired; fetch the events list again'}, status=410)
+
+@never_cache
+def event_changes(request):
+    """
+    The change feed. Without since, returns the current cursor; with
+    since=<cursor>, the changes after it, waiting up to timeout seconds
+    (GEOTRAFIC511_CHANGE_FEED_TIMEOUT at most) for there to be some.
+    """
+    if not change_feed.enabled():
+        raise Http404
+    max_timeout = getattr(settings, 'GEOTRAFIC511_CHANGE_FEED_TIMEOUT', 30)
+    try:
+        since = _cursor(request.GET.get('since'))
+        timeout = float(request.GET.get('timeout', max_timeout))
+        if math.isnan(timeout):
+            raise ValueError(timeout)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid since or timeout')
+    if since is None:
+        return JsonResponse({'cursor': change_feed.current_cursor(), 'changes': []})
+    try:
+        change_feed.check_cursor(since)
+    except change_feed.CursorExpired:
+        return _expired_cursor()
+    entries = change_feed.wait(since, min(max(timeout, 0), max_timeout))
+    return JsonResponse({
+        'cursor': entries[-1].id if entries else since,
+        'changes': [change_feed.as_json(entry) for entry in entries],
+        # More entries can be read right away
+        'more': len(entries) == change_feed.PAGE_SIZE,
+    })
+
+def event_change_stream(request):
+    """
+    The change feed as Server-Sent Events, from the Last-Event-ID header or
+    since, or else from now on.
+    """
+    if not change_feed.enabled():
+        raise Http404
+    try:
+        since = _cursor(request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('since')))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid since or Last-Event-ID')
+    if since is None:
+        since = change_feed.current_cursor()
+    else:
+        try:
+            change_feed.check_cursor(since)
+        except change_feed.CursorExpired:
+            return _expired_cursor()
+    response = StreamingHttpResponse(change_feed.stream(since,
+            getattr(settings, 'GEOTRAFIC511_CHANGE_STREAM_DURATION', 300)),
+        content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # Not buffered by nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -9,10 +9,18 @@ https://docs.djangoproject.com/en/dev/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 from whitenoise.django import DjangoWhiteNoise
 
+from geotrafic511.snapshots import SnapshotFiles
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "geotrafic511.settings")
 
 application = get_wsgi_application()
+if getattr(settings, 'GEOTRAFIC511_SNAPSHOT_DIR', None):
+    # Served outside of WhiteNoise, which only knows about the files present at startup
+    application = SnapshotFiles(application, settings.GEOTRAFIC511_SNAPSHOT_DIR,
+        prefix='/' + (getattr(settings, 'URL_PREFIX', None) or ''),
+        max_age=getattr(settings, 'GEOTRAFIC511_SNAPSHOT_MAX_AGE', 60))
 application = DjangoWhiteNoise(application)